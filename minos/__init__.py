@@ -8,18 +8,26 @@ except:
 
 __all__ = [
     "adjudicator",
+    "allele_coverage",
     "bam_read_extract",
     "dependencies",
+    "disk_cache",
+    "gcp_table",
     "genotyper",
     "genotype_confidence_simulator",
+    "genotyping_inputs",
     "gramtools",
+    "json_stream",
     "mapping_based_verifier",
+    "multi_sample_genotyper",
     "multi_sample_pipeline",
     "plots",
+    "regenotyper",
     "tasks",
     "utils",
     "vcf_chunker",
     "vcf_file_split_deletions",
+    "vcf_writer",
 ]
 
 from minos import *
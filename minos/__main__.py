@@ -99,6 +99,11 @@ def main(args=None):
         action="store_true",
         help="When using splitting (with --total_splits, --variants_per_split, or --alleles_per_split), use the unmapped reads with each split. Default is to ignore them. Using this option may add huge increase to run time, with little benefit to variant call accuracy",
     )
+    subparser_adjudicate.add_argument(
+        "--save_genotyping_inputs",
+        action="store_true",
+        help="Save the per-site coverage used for genotyping in genotyping_inputs.jsonl in the output directory, so that minos regenotype can be run later",
+    )
     subparser_adjudicate.add_argument(
         "--filter_min_dp",
         type=int,
@@ -111,6 +116,75 @@ def main(args=None):
         help="Minimum genotype confidence percentile to be used for MIN_GCP filter in output VCF file [%(default)s]",
         default=5.0,
     )
+    subparser_adjudicate.add_argument(
+        "--prune_het_pairs",
+        action="store_true",
+        help="When genotyping, skip heterozygous genotypes that cannot be one of the two most likely genotypes. Does not change the output, but is faster on sites with many alleles",
+    )
+    subparser_adjudicate.add_argument(
+        "--ploidy",
+        type=int,
+        choices=[1, 2],
+        help="Ploidy of the sample. If 1, heterozygous genotypes are not considered, and GT_CONF is from the two most likely alleles [%(default)s]",
+        default=2,
+        metavar="INT",
+    )
+    subparser_adjudicate.add_argument(
+        "--stream_gramtools_output",
+        action="store_true",
+        help="Read the gramtools output files a window of sites at a time while genotyping, instead of loading them all into memory. Uses much less RAM on large VCF files, without needing to split the VCF. Does not change the output",
+    )
+    subparser_adjudicate.add_argument(
+        "--slow_sites",
+        type=int,
+        help="Write the INT sites that took the longest time to genotype to the file slow_sites.tsv in the output directory. Is a TSV file of CHROM, POS, number of alleles, number of allele groups, heterozygous genotypes calculated, and time taken. Default is to not write the file",
+        metavar="INT",
+    )
+    subparser_adjudicate.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads to use for genotyping and genotype confidence simulations. Does not change the output [%(default)s]",
+        default=1,
+        metavar="INT",
+    )
+    subparser_adjudicate.add_argument(
+        "--simulation_tolerance",
+        type=float,
+        help="Run the genotype confidence simulations in batches of 10,000 iterations, stopping when the simulated GT_CONF at each of --simulation_quantiles changes by less than FLOAT after a batch. The number of iterations and the achieved change are put in the VCF header. Default is to run 10,000 iterations",
+        metavar="FLOAT",
+    )
+    subparser_adjudicate.add_argument(
+        "--simulation_quantiles",
+        type=lambda s: [float(x) for x in s.split(",")],
+        help="Comma-separated list of percentiles of the simulated GT_CONF values that must converge when using --simulation_tolerance [%(default)s]",
+        default=",".join(
+            str(x)
+            for x in minos.genotype_confidence_simulator.DEFAULT_CONVERGENCE_QUANTILES
+        ),
+        metavar="FLOAT,FLOAT,...",
+    )
+    subparser_adjudicate.add_argument(
+        "--max_simulation_iterations",
+        type=int,
+        help="Maximum number of genotype confidence simulations when using --simulation_tolerance [%(default)s]",
+        default=minos.genotype_confidence_simulator.DEFAULT_MAX_ADAPTIVE_ITERATIONS,
+        metavar="INT",
+    )
+    subparser_adjudicate.add_argument(
+        "--exact_gcp",
+        action="store_true",
+        help="Calculate GT_CONF_PERCENTILE from the exact distribution of GT_CONF, instead of by simulation. Is faster and does not depend on the number of simulation iterations",
+    )
+    subparser_adjudicate.add_argument(
+        "--gcp_table",
+        help="File made by minos build_gcp_table. If used, GT_CONF_PERCENTILE is interpolated from the table, instead of running simulations",
+        metavar="FILENAME",
+    )
+    subparser_adjudicate.add_argument(
+        "--cache_dir",
+        help="Directory of cached genotype confidence simulations and gramtools builds, which are reused by runs with the same depth, error rate and ploidy (simulations), or the same VCF, reference, max read length and kmer size (builds). Is safe to share between runs at the same time. Default is to use the environment variable MINOS_CACHE_DIR, or if that is not set, to not cache anything",
+        metavar="DIRNAME",
+    )
     subparser_adjudicate.add_argument("outdir", help="Name of output directory")
     subparser_adjudicate.add_argument(
         "ref_fasta", help="Reference FASTA filename (must match VCF file(s))"
@@ -364,6 +438,112 @@ def main(args=None):
     )
     subparser_cluster_vcfs.set_defaults(func=minos.tasks.cluster_vcfs.run)
 
+    # ----------------- build_gcp_table -------------------------------------------
+    subparser_build_gcp_table = subparsers.add_parser(
+        "build_gcp_table",
+        help="Make table of genotype confidence percentiles, for adjudicate --gcp_table",
+        usage="minos build_gcp_table [options] <outfile>",
+        description="Runs the genotype confidence simulations over a grid of mean read depth, ratio of depth variance to mean depth, and read error rate. Saves the GT_CONF_PERCENTILE of each GT_CONF value at each point in a NumPy file, which can be used with adjudicate --gcp_table, so that each sample does not need its own simulations",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--mean_depths",
+        type=lambda s: [float(x) for x in s.split(",")],
+        help="Comma-separated list of mean read depths, in increasing order [%(default)s]",
+        default=",".join(str(x) for x in minos.gcp_table.DEFAULT_MEAN_DEPTHS),
+        metavar="FLOAT,FLOAT,...",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--variance_ratios",
+        type=lambda s: [float(x) for x in s.split(",")],
+        help="Comma-separated list of ratios of read depth variance to mean read depth, in increasing order. Must all be > 1 [%(default)s]",
+        default=",".join(str(x) for x in minos.gcp_table.DEFAULT_VARIANCE_RATIOS),
+        metavar="FLOAT,FLOAT,...",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--error_rates",
+        type=lambda s: [float(x) for x in s.split(",")],
+        help="Comma-separated list of read error rates, in increasing order [%(default)s]",
+        default=",".join(str(x) for x in minos.gcp_table.DEFAULT_ERROR_RATES),
+        metavar="FLOAT,FLOAT,...",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--iterations",
+        type=int,
+        help="Number of simulations at each point of the grid [%(default)s]",
+        default=10000,
+        metavar="INT",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--exact",
+        action="store_true",
+        help="Use the exact distribution of GT_CONF at each point of the grid, instead of simulations. Is much faster, and --iterations is ignored",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--ploidy",
+        type=int,
+        choices=[1, 2],
+        help="Ploidy of the samples. Must match the ploidy used by adjudicate [%(default)s]",
+        default=2,
+        metavar="INT",
+    )
+    subparser_build_gcp_table.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads to use for the simulations. Does not change the output [%(default)s]",
+        default=1,
+        metavar="INT",
+    )
+    subparser_build_gcp_table.add_argument("outfile", help="Name of output file")
+    subparser_build_gcp_table.set_defaults(func=minos.tasks.build_gcp_table.run)
+
+    # ------------------------ genotype_samples -----------------------------------
+    subparser_genotype_samples = subparsers.add_parser(
+        "genotype_samples",
+        help="Genotype many samples mapped to the same gramtools build",
+        usage="minos genotype_samples [options] <--read_error_rate FLOAT> <vcf_file> <outdir> <quasimap_dir_1> [quasimap_dir_2 ...]",
+        description="Genotypes many samples that were all mapped with gramtools quasimap to the same gramtools build, all at once. Writes one VCF file with all the samples, so that single-sample VCF files do not need to be merged afterwards",
+        epilog="IMPORTANT: the --read_error_rate option is required",
+    )
+    subparser_genotype_samples.add_argument(
+        "--read_error_rate",
+        type=float,
+        required=True,
+        help="REQUIRED. Read error rate, used for all the samples",
+        metavar="FLOAT",
+    )
+    subparser_genotype_samples.add_argument(
+        "--sample_names",
+        help="Comma-separated list of sample names, in the same order as the quasimap directories. Default is to use the name of each quasimap directory",
+        metavar="STRING,STRING,...",
+    )
+    subparser_genotype_samples.add_argument(
+        "--ploidy",
+        type=int,
+        choices=[1, 2],
+        help="Ploidy of the samples [%(default)s]",
+        default=2,
+        metavar="INT",
+    )
+    subparser_genotype_samples.add_argument(
+        "--per_sample_vcfs",
+        action="store_true",
+        help="Also write the unfiltered and filtered VCF files of each sample, the same as made by adjudicate. They are called N.debug.calls_with_zero_cov_alleles.vcf and N.final.vcf, where N is the index (starting at zero) of the sample",
+    )
+    subparser_genotype_samples.add_argument(
+        "--force", action="store_true", help="Replace outdir, if it already exists"
+    )
+    subparser_genotype_samples.add_argument(
+        "vcf_file", help="VCF file used to make the gramtools build"
+    )
+    subparser_genotype_samples.add_argument("outdir", help="Name of output directory")
+    subparser_genotype_samples.add_argument(
+        "quasimap_dirs",
+        nargs="+",
+        help="Output directory of gramtools quasimap of each sample",
+        metavar="quasimap_dir",
+    )
+    subparser_genotype_samples.set_defaults(func=minos.tasks.genotype_samples.run)
+
     # ----------------- make_split_gramtools_build --------------------------------
     subparser_make_split_gramtools_build = subparsers.add_parser(
         "make_split_gramtools_build",
@@ -559,6 +739,104 @@ def main(args=None):
         func=minos.tasks.multi_sample_pipeline.run
     )
 
+    # ------------------------ regenotype -----------------------------------------
+    subparser_regenotype = subparsers.add_parser(
+        "regenotype",
+        help="Genotype again the output of adjudicate, without the reads",
+        usage="minos regenotype [options] <adjudicate_dir> <outdir>",
+        description="Genotype again the variants in the output directory of adjudicate, using the per-site coverage it saved in genotyping_inputs.jsonl (adjudicate must have been run with --save_genotyping_inputs). Much faster than running adjudicate again, because the reads are not mapped",
+    )
+    subparser_regenotype.add_argument(
+        "--read_error_rate",
+        type=float,
+        help="Read error rate. If not given, the one used by adjudicate is used",
+        metavar="FLOAT",
+    )
+    subparser_regenotype.add_argument(
+        "--ploidy",
+        type=int,
+        choices=[1, 2],
+        help="Ploidy of the sample. If not given, the one used by adjudicate is used",
+        metavar="INT",
+    )
+    subparser_regenotype.add_argument(
+        "--genotype_simulation_iterations",
+        type=int,
+        help="Number of simulations used to calculate GT_CONF_PERCENTILE [%(default)s]",
+        default=10000,
+        metavar="INT",
+    )
+    subparser_regenotype.add_argument(
+        "--filter_min_dp",
+        type=int,
+        help="Minimum depth to be used for MIN_DP filter in output VCF file [%(default)s]",
+        default=5,
+    )
+    subparser_regenotype.add_argument(
+        "--filter_min_gcp",
+        type=float,
+        help="Minimum genotype confidence percentile to be used for MIN_GCP filter in output VCF file [%(default)s]",
+        default=5.0,
+    )
+    subparser_regenotype.add_argument(
+        "--prune_het_pairs",
+        action="store_true",
+        help="When genotyping, skip heterozygous genotypes that cannot be one of the two most likely genotypes. Does not change the output, but is faster on sites with many alleles",
+    )
+    subparser_regenotype.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads to use for genotype confidence simulations. Does not change the output [%(default)s]",
+        default=1,
+        metavar="INT",
+    )
+    subparser_regenotype.add_argument(
+        "--simulation_tolerance",
+        type=float,
+        help="Run the genotype confidence simulations in batches of 10,000 iterations, stopping when the simulated GT_CONF at each of --simulation_quantiles changes by less than FLOAT after a batch. The number of iterations and the achieved change are put in the VCF header. Default is to run 10,000 iterations",
+        metavar="FLOAT",
+    )
+    subparser_regenotype.add_argument(
+        "--simulation_quantiles",
+        type=lambda s: [float(x) for x in s.split(",")],
+        help="Comma-separated list of percentiles of the simulated GT_CONF values that must converge when using --simulation_tolerance [%(default)s]",
+        default=",".join(
+            str(x)
+            for x in minos.genotype_confidence_simulator.DEFAULT_CONVERGENCE_QUANTILES
+        ),
+        metavar="FLOAT,FLOAT,...",
+    )
+    subparser_regenotype.add_argument(
+        "--max_simulation_iterations",
+        type=int,
+        help="Maximum number of genotype confidence simulations when using --simulation_tolerance [%(default)s]",
+        default=minos.genotype_confidence_simulator.DEFAULT_MAX_ADAPTIVE_ITERATIONS,
+        metavar="INT",
+    )
+    subparser_regenotype.add_argument(
+        "--exact_gcp",
+        action="store_true",
+        help="Calculate GT_CONF_PERCENTILE from the exact distribution of GT_CONF, instead of by simulation. Is faster and does not depend on the number of simulation iterations",
+    )
+    subparser_regenotype.add_argument(
+        "--gcp_table",
+        help="File made by minos build_gcp_table. If used, GT_CONF_PERCENTILE is interpolated from the table, instead of running simulations",
+        metavar="FILENAME",
+    )
+    subparser_regenotype.add_argument(
+        "--cache_dir",
+        help="Directory of cached genotype confidence simulations, which are reused by runs with the same depth, error rate and ploidy. Is safe to share between runs at the same time. Default is to use the environment variable MINOS_CACHE_DIR, or if that is not set, to not cache anything",
+        metavar="DIRNAME",
+    )
+    subparser_regenotype.add_argument(
+        "--force", action="store_true", help="Replace outdir, if it already exists"
+    )
+    subparser_regenotype.add_argument(
+        "adjudicate_dir", help="Output directory of minos adjudicate"
+    )
+    subparser_regenotype.add_argument("outdir", help="Name of output directory")
+    subparser_regenotype.set_defaults(func=minos.tasks.regenotype.run)
+
     # ------------------------ versions -------------------------------------------
     subparser_versions = subparsers.add_parser(
         "versions",
@@ -1,3 +1,4 @@
+import contextlib
 import json
 import logging
 import os
@@ -10,11 +11,16 @@ from cluster_vcf_records import vcf_clusterer, vcf_file_read
 from minos import (
     bam_read_extract,
     dependencies,
+    disk_cache,
+    gcp_table,
     genotype_confidence_simulator,
+    genotyper,
+    genotyping_inputs,
     gramtools,
     plots,
     utils,
     vcf_chunker,
+    vcf_writer,
 )
 
 
@@ -46,8 +52,20 @@ class Adjudicator:
         clean=True,
         genotype_simulation_iterations=10000,
         use_unmapped_reads=False,
+        save_genotyping_inputs=False,
         filter_min_dp=5,
         filter_min_gcp=5,
+        prune_het_pairs=False,
+        ploidy=2,
+        slow_sites=None,
+        cache_dir=None,
+        threads=1,
+        simulation_tolerance=None,
+        simulation_quantiles=genotype_confidence_simulator.DEFAULT_CONVERGENCE_QUANTILES,
+        max_simulation_iterations=genotype_confidence_simulator.DEFAULT_MAX_ADAPTIVE_ITERATIONS,
+        gcp_table=None,
+        exact_gcp=False,
+        stream_gramtools_output=False,
     ):
         self.ref_fasta = os.path.abspath(ref_fasta)
         self.reads_files = [os.path.abspath(x) for x in reads_files]
@@ -63,7 +81,14 @@ class Adjudicator:
             self.outdir, "debug.calls_with_zero_cov_alleles.vcf"
         )
         self.final_vcf = os.path.join(self.outdir, "final.vcf")
+        if save_genotyping_inputs:
+            self.genotyping_inputs_file = os.path.join(
+                self.outdir, "genotyping_inputs.jsonl"
+            )
+        else:
+            self.genotyping_inputs_file = None
         self.plots_prefix = os.path.join(self.outdir, "final.vcf.plots")
+        self.slow_sites_tsv = os.path.join(self.outdir, "slow_sites.tsv")
 
         if gramtools_build_dir is None:
             self.split_input_dir = os.path.join(self.outdir, "split.in")
@@ -106,6 +131,36 @@ class Adjudicator:
         self.use_unmapped_reads = use_unmapped_reads
         self.filter_min_dp = filter_min_dp
         self.filter_min_gcp = filter_min_gcp
+        self.prune_het_pairs = prune_het_pairs
+        self.ploidy = ploidy
+        # If slow_sites is not None, that many of the sites that took the
+        # longest to genotype are reported in slow_sites.tsv
+        if slow_sites is None:
+            self.slow_sites_report = None
+        else:
+            self.slow_sites_report = genotyper.SlowSiteReport(max_sites=slow_sites)
+        # Directory of cached genotype confidence simulations and gramtools
+        # builds. If not given, is taken from the environment variable
+        # MINOS_CACHE_DIR
+        self.cache_dir = disk_cache.cache_dir_from_options(cache_dir)
+        # Number of processes used to genotype the sites, and threads used
+        # for the simulations
+        self.threads = threads
+        # If simulation_tolerance is not None, the genotype confidence
+        # simulations are run in batches of genotype_simulation_iterations
+        # until they converge (see GenotypeConfidenceSimulator)
+        self.simulation_tolerance = simulation_tolerance
+        self.simulation_quantiles = simulation_quantiles
+        self.max_simulation_iterations = max_simulation_iterations
+        # File made by "minos build_gcp_table". If given, GT_CONF_PERCENTILE
+        # is interpolated from the table instead of running simulations
+        self.gcp_table = None if gcp_table is None else os.path.abspath(gcp_table)
+        # If True, GT_CONF_PERCENTILE is calculated from the exact
+        # distribution of the confidences, instead of by simulation
+        self.exact_gcp = exact_gcp
+        # If True, the gramtools output is read and genotyped a window of
+        # sites at a time, instead of all loaded into memory
+        self.stream_gramtools_output = stream_gramtools_output
 
     def build_output_dir(self):
         try:
@@ -228,6 +283,12 @@ class Adjudicator:
         else:
             self._run_gramtools_not_split_vcf()
 
+        if self.slow_sites_report is not None:
+            logging.info(
+                f"Writing the {len(self.slow_sites_report)} slowest sites to genotype to {self.slow_sites_tsv}. Total genotyping time of all {self.slow_sites_report.sites_added} sites: {round(self.slow_sites_report.total_seconds, 2)}s"
+            )
+            self.slow_sites_report.write_tsv(self.slow_sites_tsv)
+
         logging.info("Making plots from final.vcf")
         plots.plots_from_minos_vcf(self.final_vcf, self.plots_prefix)
 
@@ -245,6 +306,7 @@ class Adjudicator:
             self.reads_files,
             self.final_vcf,
             self.unfiltered_vcf_file,
+            self.genotyping_inputs_file,
         )
         self.run_gt_conf()
 
@@ -260,6 +322,7 @@ class Adjudicator:
             total_splits=self.total_splits,
             flank_length=self.max_read_length,
             gramtools_kmer_size=self.gramtools_kmer_size,
+            cache_dir=self.cache_dir,
         )
         chunker.make_split_files()
         self.gramtools_kmer_size = chunker.gramtools_kmer_size
@@ -284,10 +347,12 @@ class Adjudicator:
 
         split_vcf_outfiles = {}
         split_vcf_outfiles_unfiltered = {}
+        split_genotyping_inputs_files = {}
 
         for ref_name, split_file_list in chunker.vcf_split_files.items():
             split_vcf_outfiles[ref_name] = []
             split_vcf_outfiles_unfiltered[ref_name] = []
+            split_genotyping_inputs_files[ref_name] = []
             for split_file in split_file_list:
                 logging.info(
                     "===== Start analysing variants in VCF split file "
@@ -325,6 +390,15 @@ class Adjudicator:
                     + str(split_file.file_number)
                     + ".out.debug.calls_with_zero_cov_alleles.vcf",
                 )
+                if self.genotyping_inputs_file is None:
+                    genotyping_inputs_out = None
+                else:
+                    genotyping_inputs_out = os.path.join(
+                        self.split_output_dir,
+                        "split."
+                        + str(split_file.file_number)
+                        + ".genotyping_inputs.jsonl",
+                    )
 
                 self.run_adjudicate(
                     split_file.gramtools_build_dir,
@@ -333,6 +407,7 @@ class Adjudicator:
                     reads_files,
                     split_vcf_out,
                     unfiltered_vcf_out,
+                    genotyping_inputs_out,
                 )
 
                 if self.clean:
@@ -342,6 +417,10 @@ class Adjudicator:
 
                 split_vcf_outfiles[ref_name].append(split_vcf_out)
                 split_vcf_outfiles_unfiltered[ref_name].append(unfiltered_vcf_out)
+                if genotyping_inputs_out is not None:
+                    split_genotyping_inputs_files[ref_name].append(
+                        genotyping_inputs_out
+                    )
 
                 logging.info(
                     "===== Finish analysing variants in VCF split file "
@@ -352,12 +431,20 @@ class Adjudicator:
         logging.info("Merging VCF files into one output file " + self.final_vcf)
         chunker.merge_files(split_vcf_outfiles, self.final_vcf)
         chunker.merge_files(split_vcf_outfiles_unfiltered, self.unfiltered_vcf_file)
+        if self.genotyping_inputs_file is not None:
+            genotyping_inputs.merge_files(
+                chunker, split_genotyping_inputs_files, self.genotyping_inputs_file
+            )
 
         self.run_gt_conf()
 
         if self.clean:
             logging.info("Deleting temp split VCF files")
-            for d in split_vcf_outfiles, split_vcf_outfiles_unfiltered:
+            for d in (
+                split_vcf_outfiles,
+                split_vcf_outfiles_unfiltered,
+                split_genotyping_inputs_files,
+            ):
                 for file_list in d.values():
                     for filename in file_list:
                         os.unlink(filename)
@@ -365,7 +452,14 @@ class Adjudicator:
                 os.unlink(unmapped_reads_file)
 
     def run_adjudicate(
-        self, build_dir, quasimap_dir, vcf, reads_files, final_vcf, debug_vcf
+        self,
+        build_dir,
+        quasimap_dir,
+        vcf,
+        reads_files,
+        final_vcf,
+        debug_vcf,
+        genotyping_inputs_file,
     ):
         build_report, quasimap_report = gramtools.run_gramtools(
             build_dir,
@@ -375,19 +469,64 @@ class Adjudicator:
             reads_files,
             self.max_read_length,
             kmer_size=self.gramtools_kmer_size,
+            cache_dir=self.cache_dir,
         )
 
         build_vcf = os.path.join(build_dir, "build.vcf")
 
         logging.info("Loading gramtools quasimap output files " + quasimap_dir)
-        mean_depth, variance_depth, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(
-            build_vcf, quasimap_dir
-        )
+        if self.stream_gramtools_output:
+            mean_depth, variance_depth, vcf_header, windows, allele_groups = gramtools.load_gramtools_files_streaming(
+                build_vcf, quasimap_dir
+            )
+        else:
+            mean_depth, variance_depth, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(
+                build_vcf, quasimap_dir, ragged=True
+            )
+            windows = [(vcf_records, allele_coverage)]
         Adjudicator.mean_depths.append(mean_depth)
         Adjudicator.variance_depths.append(variance_depth)
 
         logging.info("Finished loading gramtools files")
 
+        if self.sample_name is None:
+            sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(
+                vcf_header
+            )
+        else:
+            sample_name = self.sample_name
+
+        with contextlib.ExitStack() as stack:
+            if genotyping_inputs_file is not None:
+                logging.info("Writing genotyping inputs file " + genotyping_inputs_file)
+                f = stack.enter_context(open(genotyping_inputs_file, "w"))
+                genotyping_inputs.write_header(
+                    f,
+                    mean_depth,
+                    variance_depth,
+                    read_error_rate=self.read_error_rate,
+                    max_read_length=self.max_read_length,
+                    ploidy=self.ploidy,
+                )
+                windows = genotyping_inputs.write_windows(f, windows, allele_groups)
+
+            gramtools.write_vcf_annotated_using_coverage_windows_from_gramtools(
+                mean_depth,
+                windows,
+                allele_groups,
+                self.read_error_rate,
+                debug_vcf,
+                sample_name=sample_name,
+                max_read_length=self.max_read_length,
+                filtered_outfile=final_vcf,
+                prune_het_pairs=self.prune_het_pairs,
+                ploidy=self.ploidy,
+                slow_sites=self.slow_sites_report,
+                threads=self.threads,
+            )
+
+        # When streaming, the gramtools files are read while genotyping, so
+        # can only be deleted afterwards
         if self.clean:
             os.rename(
                 os.path.join(quasimap_dir, "quasimap_outputs", "quasimap_report.json"),
@@ -402,25 +541,6 @@ class Adjudicator:
                 )
                 shutil.rmtree(build_dir)
 
-        if self.sample_name is None:
-            sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(
-                vcf_header
-            )
-        else:
-            sample_name = self.sample_name
-
-        gramtools.write_vcf_annotated_using_coverage_from_gramtools(
-            mean_depth,
-            vcf_records,
-            allele_coverage,
-            allele_groups,
-            self.read_error_rate,
-            debug_vcf,
-            sample_name=sample_name,
-            max_read_length=self.max_read_length,
-            filtered_outfile=final_vcf,
-        )
-
     def run_gt_conf(self):
         """
         """
@@ -428,11 +548,24 @@ class Adjudicator:
         mean_depth = statistics.mean(Adjudicator.mean_depths)
         variance_depth = statistics.mean(Adjudicator.variance_depths)
 
-        logging.info(
-            f"Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf} & its debug counterpart, "
-            f"using mean depth {mean_depth}, variance depth {variance_depth}, error rate {self.read_error_rate}, "
-            f"and {self.genotype_simulation_iterations} simulation iterations"
-        )
+        if self.gcp_table is None:
+            table = None
+            logging.info(
+                f"Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf} & its debug counterpart, "
+                f"using mean depth {mean_depth}, variance depth {variance_depth}, error rate {self.read_error_rate}, "
+                + (
+                    "and the exact distribution of GT_CONF"
+                    if self.exact_gcp
+                    else f"and {self.genotype_simulation_iterations} simulation iterations"
+                )
+            )
+        else:
+            table = gcp_table.GcpTable.load(self.gcp_table)
+            logging.info(
+                f"Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf} & its debug counterpart, "
+                f"using mean depth {mean_depth}, variance depth {variance_depth}, error rate {self.read_error_rate}, "
+                f"and table {self.gcp_table}"
+            )
 
         for f in [self.unfiltered_vcf_file, self.final_vcf]:
             Adjudicator._add_gt_conf_percentile_and_filters_to_vcf_file(
@@ -443,6 +576,14 @@ class Adjudicator:
                 self.genotype_simulation_iterations,
                 min_dp=self.filter_min_dp,
                 min_gcp=self.filter_min_gcp,
+                ploidy=self.ploidy,
+                cache_dir=self.cache_dir,
+                threads=self.threads,
+                tolerance=self.simulation_tolerance,
+                quantiles=self.simulation_quantiles,
+                max_iterations=self.max_simulation_iterations,
+                table=table,
+                exact=self.exact_gcp,
             )
 
     @classmethod
@@ -455,16 +596,52 @@ class Adjudicator:
         iterations,
         min_dp=5,
         min_gcp=5,
+        ploidy=2,
+        cache_dir=None,
+        threads=1,
+        tolerance=None,
+        quantiles=genotype_confidence_simulator.DEFAULT_CONVERGENCE_QUANTILES,
+        max_iterations=genotype_confidence_simulator.DEFAULT_MAX_ADAPTIVE_ITERATIONS,
+        table=None,
+        exact=False,
     ):
         """Overwrites vcf_file, with new version that has GT_CONF_PERCENTILE added,
-        and filter for DP and GT_CONF_PERCENTILE"""
-        if mean_depth > 0:
+        and filter for DP and GT_CONF_PERCENTILE.
+        If cache_dir is given, the simulated genotype confidences are
+        cached there (see disk_cache.DiskCache). The simulations are run
+        using this many threads. If tolerance is not None, the simulations
+        are run in batches of iterations until they converge, and the
+        number of iterations and the convergence are added to the header.
+        If table is given (a gcp_table.GcpTable), the percentiles are
+        interpolated from it instead of running simulations. If exact is
+        True, the percentiles are calculated from the exact distribution of
+        the confidences instead of by simulation"""
+        if mean_depth > 0 and table is not None:
+            if table.ploidy != ploidy:
+                raise Exception(
+                    f"GT_CONF_PERCENTILE table was made with ploidy {table.ploidy}, but ploidy is {ploidy}. Cannot continue"
+                )
+            simulations = table.interpolate(mean_depth, depth_variance, error_rate)
+        elif mean_depth > 0:
+            if cache_dir is None:
+                cache = None
+            else:
+                cache = disk_cache.DiskCache(
+                    os.path.join(cache_dir, "genotype_confidence_simulations")
+                )
             simulations = genotype_confidence_simulator.GenotypeConfidenceSimulator(
                 mean_depth,
                 depth_variance,
                 error_rate,
                 allele_length=1,
                 iterations=iterations,
+                ploidy=ploidy,
+                cache=cache,
+                threads=threads,
+                tolerance=tolerance,
+                quantiles=quantiles,
+                max_iterations=max_iterations,
+                exact=exact,
             )
             simulations.run_simulations()
         vcf_header, vcf_lines = vcf_file_read.vcf_file_to_list(vcf_file)
@@ -487,30 +664,56 @@ class Adjudicator:
             i + 1,
             f'##FILTER=<ID=MIN_GCP,Description="Minimum GT_CONF_PERCENTILE of {min_gcp}">',
         )
+        if mean_depth > 0 and tolerance is not None and table is None and not exact:
+            quantiles_string = ";".join(str(x) for x in quantiles)
+            error = (
+                "."
+                if simulations.convergence_error is None
+                else simulations.convergence_error
+            )
+            vcf_header.insert(
+                i + 1,
+                f"##minos_gt_conf_simulation_convergence=<Tolerance={tolerance},Quantiles={quantiles_string},Error={error}>",
+            )
+            vcf_header.insert(
+                i + 1,
+                f"##minos_gt_conf_simulation_iterations={simulations.iterations_used}",
+            )
 
-        with open(vcf_file, "w") as f:
-            print(*vcf_header, sep="\n", file=f)
-
-            for vcf_record in vcf_lines:
+        # Get the percentiles of all the called genotypes in one go
+        called = [
+            "GT" in x.FORMAT and "GT_CONF" in x.FORMAT and "." not in x.FORMAT["GT"]
+            for x in vcf_lines
+        ]
+        confidences = [
+            int(round(float(x.FORMAT["GT_CONF"])))
+            for x, is_called in zip(vcf_lines, called)
+            if is_called
+        ]
+        if len(confidences) > 0:
+            percentiles = iter(simulations.get_percentiles(confidences).tolist())
+
+        with vcf_writer.VcfWriter(vcf_file) as writer:
+            writer.write_header(vcf_header)
+
+            for vcf_record, is_called in zip(vcf_lines, called):
                 vcf_record.FILTER = set()
 
-                if "GT" in vcf_record.FORMAT and "GT_CONF" in vcf_record.FORMAT:
-                    if "." not in vcf_record.FORMAT["GT"]:
-                        conf = int(round(float(vcf_record.FORMAT["GT_CONF"])))
-                        vcf_record.set_format_key_value(
-                            "GT_CONF_PERCENTILE", str(simulations.get_percentile(conf))
-                        )
-                        if (
-                            "DP" in vcf_record.FORMAT
-                            and float(vcf_record.FORMAT["DP"]) < min_dp
-                        ):
-                            vcf_record.FILTER.add("MIN_DP")
-                        if float(vcf_record.FORMAT["GT_CONF_PERCENTILE"]) < min_gcp:
-                            vcf_record.FILTER.add("MIN_GCP")
-                        if len(vcf_record.FILTER) == 0:
-                            vcf_record.FILTER.add("PASS")
-                    else:
-                        # Add a default null percentile
-                        vcf_record.set_format_key_value("GT_CONF_PERCENTILE", "0.0")
-
-                print(vcf_record, file=f)
+                if is_called:
+                    vcf_record.set_format_key_value(
+                        "GT_CONF_PERCENTILE", str(next(percentiles))
+                    )
+                    if (
+                        "DP" in vcf_record.FORMAT
+                        and float(vcf_record.FORMAT["DP"]) < min_dp
+                    ):
+                        vcf_record.FILTER.add("MIN_DP")
+                    if float(vcf_record.FORMAT["GT_CONF_PERCENTILE"]) < min_gcp:
+                        vcf_record.FILTER.add("MIN_GCP")
+                    if len(vcf_record.FILTER) == 0:
+                        vcf_record.FILTER.add("PASS")
+                elif "GT" in vcf_record.FORMAT and "GT_CONF" in vcf_record.FORMAT:
+                    # Add a default null percentile
+                    vcf_record.set_format_key_value("GT_CONF_PERCENTILE", "0.0")
+
+                writer.write(vcf_record)
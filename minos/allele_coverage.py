@@ -0,0 +1,121 @@
+import array
+
+import numpy as np
+
+
+class AlleleCoverage:
+    """Holds the coverage output by gramtools quasimap for all the sites
+    in a graph. site_counts is a list with one dict per site of
+    allele group -> coverage (ie allele_combination_cov). The per-base
+    coverage of every allele is stored in one flat numpy array, instead
+    of a list of lists of ints per site. The per-base coverage of allele
+    j of site i is
+    base_counts[allele_offsets[site_offsets[i] + j]:allele_offsets[site_offsets[i] + j + 1]]
+
+    Indexing and iterating give the same (allele_combination_cov,
+    allele_per_base_cov) tuples as the list returned by
+    gramtools.load_allele_files(), so this can be used in its place"""
+
+    def __init__(self, site_counts, base_counts, allele_offsets, site_offsets):
+        assert len(site_counts) + 1 == len(site_offsets)
+        assert site_offsets[-1] + 1 == len(allele_offsets)
+        assert allele_offsets[-1] == len(base_counts)
+        self.site_counts = site_counts
+        self.base_counts = base_counts
+        self.allele_offsets = allele_offsets
+        self.site_offsets = site_offsets
+
+    @classmethod
+    def from_lists(cls, site_counts, allele_base_counts):
+        """site_counts and allele_base_counts should be as found in the json
+        files made by gramtools quasimap: a list of dicts, and a list (one
+        element per site) of lists (one per allele) of per-base coverage.
+        allele_base_counts can be any iterable of sites, eg from
+        json_stream.iter_array(), so that the per-base coverage of all
+        sites is never held as lists at the same time"""
+        base_counts = array.array("q")
+        allele_offsets = array.array("q", [0])
+        site_offsets = array.array("q", [0])
+        for allele_per_base_cov in allele_base_counts:
+            for per_base_cov in allele_per_base_cov:
+                base_counts.extend(per_base_cov)
+                allele_offsets.append(len(base_counts))
+            site_offsets.append(len(allele_offsets) - 1)
+
+        if len(site_counts) != len(site_offsets) - 1:
+            raise Exception(
+                f"Mismatch in number of sites in site counts ({len(site_counts)}) and allele base counts ({len(site_offsets) - 1})"
+            )
+        return cls(
+            site_counts,
+            np.frombuffer(base_counts, dtype=np.int64),
+            np.frombuffer(allele_offsets, dtype=np.int64),
+            np.frombuffer(site_offsets, dtype=np.int64),
+        )
+
+    @classmethod
+    def from_all_allele_coverage(cls, all_allele_coverage):
+        """Makes a new AlleleCoverage from a list of
+        (allele_combination_cov, allele_per_base_cov) tuples, as returned
+        by gramtools.load_allele_files(). If all_allele_coverage is already
+        an AlleleCoverage, it is returned unchanged"""
+        if isinstance(all_allele_coverage, AlleleCoverage):
+            return all_allele_coverage
+        return cls.from_lists(
+            [x[0] for x in all_allele_coverage], [x[1] for x in all_allele_coverage]
+        )
+
+    def __len__(self):
+        return len(self.site_counts)
+
+    def __getitem__(self, site):
+        return self.site_counts[site], self.allele_per_base_cov(site)
+
+    def __iter__(self):
+        for site in range(len(self)):
+            yield self[site]
+
+    def number_of_alleles(self):
+        """Returns array of the number of alleles at each site"""
+        return np.diff(self.site_offsets)
+
+    def total_coverages(self):
+        """Returns list of the total coverage (summed over all allele groups)
+        of each site"""
+        return [sum(x.values()) for x in self.site_counts]
+
+    def allele_per_base_cov(self, site):
+        """Returns list of lists of per-base coverage of the alleles of one site"""
+        return [
+            self.base_counts[start:end].tolist()
+            for start, end in zip(
+                self.allele_offsets[
+                    self.site_offsets[site] : self.site_offsets[site + 1]
+                ],
+                self.allele_offsets[
+                    self.site_offsets[site] + 1 : self.site_offsets[site + 1] + 1
+                ],
+            )
+        ]
+
+    def allele_lengths(self):
+        """Returns array of the length of every allele of every site"""
+        return np.diff(self.allele_offsets)
+
+    def allele_non_zeros(self, min_cov):
+        """Returns array of the number of positions with coverage at least
+        min_cov, for every allele of every site"""
+        at_least_min_cov = np.zeros(len(self.base_counts) + 1, dtype=np.int64)
+        np.cumsum(self.base_counts >= min_cov, out=at_least_min_cov[1:])
+        return (
+            at_least_min_cov[self.allele_offsets[1:]]
+            - at_least_min_cov[self.allele_offsets[:-1]]
+        )
+
+    def site_slices(self, allele_values):
+        """Splits an array with one value per allele (eg from
+        allele_lengths() or allele_non_zeros()) into one list per site"""
+        if isinstance(allele_values, np.ndarray):
+            allele_values = allele_values.tolist()
+        offsets = self.site_offsets.tolist()
+        return [allele_values[start:end] for start, end in zip(offsets, offsets[1:])]
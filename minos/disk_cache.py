@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+# Environment variable that sets the cache directory, if it is not set
+# on the command line
+CACHE_DIR_ENV_VARIABLE = "MINOS_CACHE_DIR"
+
+# Default maximum total size of the files in one cache directory
+DEFAULT_MAX_CACHE_BYTES = 1_000_000_000
+
+# Default maximum total size of the directories in one DirectoryCache
+DEFAULT_MAX_DIRECTORY_CACHE_BYTES = 10_000_000_000
+
+
+def cache_dir_from_options(cache_dir):
+    """Returns cache_dir if it is not None, otherwise the value of the
+    environment variable MINOS_CACHE_DIR (or None if that is not set)"""
+    if cache_dir is not None:
+        return cache_dir
+    return os.environ.get(CACHE_DIR_ENV_VARIABLE, None)
+
+
+def file_sha256(filename):
+    """Returns the sha256 of the contents of a file"""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1_048_576), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DiskCache:
+    """Cache of files in a directory, where each file is named by the
+    sha256 of the values that made its contents (see key()). Can be shared
+    by minos processes running at the same time: each file is written to a
+    temporary file and then renamed, so readers only ever see complete
+    files. Reading a file updates its modification time. After adding a
+    file, the least recently used files are deleted until the total size
+    is at most max_bytes"""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def key(cls, *values):
+        """Returns the key of a cache entry made from values, which must
+        be serializable to JSON"""
+        return hashlib.sha256(
+            json.dumps(values, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """Returns contents (as bytes) of the file with the given key, or
+        None if it is not in the cache"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Adds data (bytes) to the cache with the given key"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp.")
+        replaced = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+            replaced = True
+        finally:
+            if not replaced and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.evict()
+
+    def remove(self, key):
+        """Removes the entry with the given key from the cache, if it is
+        there"""
+        try:
+            self._remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        """Returns list of (modification time, size, path) of the files in
+        the cache"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith(".tmp."):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def total_bytes(self):
+        return sum(x[1] for x in self._entries())
+
+    def evict(self):
+        """Deletes least recently used files until the total size of the
+        cache is at most max_bytes"""
+        entries = self._entries()
+        total = sum(x[1] for x in entries)
+        if total <= self.max_bytes:
+            return
+
+        for mtime, size, path in sorted(entries):
+            try:
+                self._remove(path)
+                logging.debug(f"Removed {path} from cache")
+            except FileNotFoundError:
+                # Another process removed it first
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _remove(self, path):
+        os.unlink(path)
+
+
+class DirectoryCache(DiskCache):
+    """Same as DiskCache, but each entry is a directory instead of a file.
+    get() and put() copy the directory out of and into the cache. A
+    directory is copied to a temporary directory in the cache and then
+    renamed, so readers only ever see complete directories. Directories
+    are renamed before being deleted when they are evicted, for the
+    same reason"""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_DIRECTORY_CACHE_BYTES):
+        super().__init__(cache_dir, max_bytes=max_bytes)
+
+    def get(self, key, outdir):
+        """Copies the directory with the given key to outdir, which must
+        not exist. Returns True if it was in the cache, otherwise False"""
+        path = self.path(key)
+        try:
+            shutil.copytree(path, outdir)
+        except (FileNotFoundError, shutil.Error):
+            # Not in the cache, or another process evicted it while it was
+            # being copied
+            if os.path.exists(outdir):
+                shutil.rmtree(outdir)
+            self.misses += 1
+            return False
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return True
+
+    def put(self, key, directory):
+        """Adds a copy of directory to the cache with the given key. Does
+        nothing if the key is already in the cache"""
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp.")
+        try:
+            tmp_copy = os.path.join(tmp_dir, "copy")
+            shutil.copytree(directory, tmp_copy)
+            try:
+                os.rename(tmp_copy, self.path(key))
+            except OSError:
+                # Another process added the same key first
+                if not os.path.isdir(self.path(key)):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith(".tmp."):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                mtime = os.stat(path).st_mtime
+                size = 0
+                for root, dirs, files in os.walk(path):
+                    for x in files:
+                        size += os.path.getsize(os.path.join(root, x))
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, size, path))
+        return entries
+
+    def _remove(self, path):
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp.")
+        try:
+            os.rename(path, os.path.join(tmp_dir, "evicted"))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,228 @@
+import logging
+import math
+
+import numpy as np
+
+from minos import genotype_confidence_simulator
+
+# Change this when the format of the table file changes
+TABLE_VERSION = 1
+
+# Default grid of the table made by "minos build_gcp_table"
+DEFAULT_MEAN_DEPTHS = [5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200]
+DEFAULT_VARIANCE_RATIOS = [1.5, 2, 3, 5, 10]
+DEFAULT_ERROR_RATES = [0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02]
+
+
+class InterpolatedPercentiles:
+    """Percentiles of genotype confidences of one sample, interpolated from
+    a GcpTable (see GcpTable.interpolate()). Can be used in place of a
+    GenotypeConfidenceSimulator that has run its simulations"""
+
+    def __init__(self, percentiles):
+        # percentiles[i] = percentile of confidence i
+        self.percentiles = percentiles
+
+    def get_percentiles(self, confidences):
+        """Returns array of the percentile of each of the confidences,
+        rounded to 2 decimal places. Confidences bigger than all the ones
+        in the table get 100"""
+        confidences = np.asarray(confidences, dtype=np.float64)
+        return np.round(
+            np.interp(
+                confidences,
+                np.arange(len(self.percentiles)),
+                self.percentiles,
+                right=100.0,
+            ),
+            2,
+        )
+
+    def get_percentile(self, confidence):
+        """Returns the percentile of one confidence. See get_percentiles()"""
+        return float(self.get_percentiles([confidence])[0])
+
+
+class GcpTable:
+    """Table of genotype confidence percentiles (GT_CONF_PERCENTILE), made
+    by running GenotypeConfidenceSimulator at each point of a grid of mean
+    depth, ratio of depth variance to mean depth, and read error rate.
+    percentiles has shape (mean depths, variance ratios, error rates, max
+    confidence + 1), where percentiles[i, j, k, c] is 100 times the
+    percentile of confidence c at the grid point (i, j, k). Storing
+    integers in hundredths makes the table compact and exact, because
+    percentiles are rounded to 2 decimal places. iterations is 0 if the
+    table was made using the exact distribution of the confidences"""
+
+    def __init__(
+        self,
+        mean_depths,
+        variance_ratios,
+        error_rates,
+        percentiles,
+        ploidy=2,
+        iterations=10000,
+    ):
+        self.mean_depths = np.array(mean_depths, dtype=np.float64)
+        self.variance_ratios = np.array(variance_ratios, dtype=np.float64)
+        self.error_rates = np.array(error_rates, dtype=np.float64)
+        self.percentiles = percentiles
+        self.ploidy = ploidy
+        self.iterations = iterations
+        assert self.percentiles.shape[:3] == (
+            len(self.mean_depths),
+            len(self.variance_ratios),
+            len(self.error_rates),
+        )
+
+    @classmethod
+    def build(
+        cls,
+        mean_depths=DEFAULT_MEAN_DEPTHS,
+        variance_ratios=DEFAULT_VARIANCE_RATIOS,
+        error_rates=DEFAULT_ERROR_RATES,
+        iterations=10000,
+        ploidy=2,
+        threads=1,
+        exact=False,
+    ):
+        """Returns a new GcpTable, made by running the simulations at every
+        point of the grid. If exact is True, uses the exact distribution of
+        the confidences instead of simulations (see
+        GenotypeConfidenceSimulator)"""
+        for name, values in (
+            ("mean_depths", mean_depths),
+            ("variance_ratios", variance_ratios),
+            ("error_rates", error_rates),
+        ):
+            if len(values) == 0 or list(values) != sorted(set(values)):
+                raise Exception(
+                    f"{name} must be a non-empty list of increasing numbers. Got: {values}"
+                )
+        if mean_depths[0] <= 0:
+            raise Exception(f"mean_depths must all be > 0. Got: {mean_depths}")
+        if variance_ratios[0] <= 1:
+            raise Exception(
+                f"variance_ratios must all be > 1, because the simulations need depth variance > mean depth. Got: {variance_ratios}"
+            )
+        if error_rates[0] <= 0 or error_rates[-1] >= 1:
+            raise Exception(f"error_rates must all be > 0 and < 1. Got: {error_rates}")
+
+        simulations = {}
+        for i, mean_depth in enumerate(mean_depths):
+            for j, variance_ratio in enumerate(variance_ratios):
+                for k, error_rate in enumerate(error_rates):
+                    logging.info(
+                        f"Run simulation, mean_depth={mean_depth}, depth_variance={mean_depth * variance_ratio}, error_rate={error_rate}, "
+                        + ("exact" if exact else f"iterations={iterations}")
+                    )
+                    simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+                        mean_depth,
+                        mean_depth * variance_ratio,
+                        error_rate,
+                        iterations=iterations,
+                        ploidy=ploidy,
+                        threads=threads,
+                        exact=exact,
+                    )
+                    simulator.run_simulations()
+                    simulations[(i, j, k)] = simulator
+
+        max_conf = max(x.max_conf_score for x in simulations.values())
+        percentiles = np.zeros(
+            (len(mean_depths), len(variance_ratios), len(error_rates), max_conf + 1),
+            dtype=np.uint16,
+        )
+        confidences = np.arange(max_conf + 1)
+        for (i, j, k), simulator in simulations.items():
+            percentiles[i, j, k] = np.round(
+                100 * simulator.get_percentiles(confidences)
+            )
+        return cls(
+            mean_depths,
+            variance_ratios,
+            error_rates,
+            percentiles,
+            ploidy=ploidy,
+            iterations=0 if exact else iterations,
+        )
+
+    def save(self, outfile):
+        with open(outfile, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=TABLE_VERSION,
+                mean_depths=self.mean_depths,
+                variance_ratios=self.variance_ratios,
+                error_rates=self.error_rates,
+                percentiles=self.percentiles,
+                ploidy=self.ploidy,
+                iterations=self.iterations,
+            )
+
+    @classmethod
+    def load(cls, infile):
+        with np.load(infile) as data:
+            if int(data["version"]) != TABLE_VERSION:
+                raise Exception(
+                    f"Table file {infile} has version {int(data['version'])}, but this version of minos needs version {TABLE_VERSION}. Make the table again with minos build_gcp_table"
+                )
+            return cls(
+                data["mean_depths"],
+                data["variance_ratios"],
+                data["error_rates"],
+                data["percentiles"],
+                ploidy=int(data["ploidy"]),
+                iterations=int(data["iterations"]),
+            )
+
+    @classmethod
+    def _axis_weights(cls, grid, value, name):
+        """Returns tuple (i, j, weight of j), for linear interpolation of
+        value between grid[i] and grid[j]. grid and value must already be
+        on the scale used for interpolation. Values outside the grid use
+        the nearest end of the grid"""
+        if value <= grid[0] or value >= grid[-1]:
+            if not math.isclose(value, grid[0] if value <= grid[0] else grid[-1]):
+                logging.warning(
+                    f"{name} is outside the range of the GT_CONF_PERCENTILE table. Using the nearest value in the table instead"
+                )
+            i = 0 if value <= grid[0] else len(grid) - 1
+            return i, i, 0.0
+        j = int(np.searchsorted(grid, value, side="right"))
+        i = j - 1
+        return i, j, (value - grid[i]) / (grid[j] - grid[i])
+
+    def interpolate(self, mean_depth, depth_variance, error_rate):
+        """Returns InterpolatedPercentiles for a sample with the given depth
+        and error rate. Interpolates linearly between the nearest grid
+        points, using log mean depth, variance ratio, and log error rate"""
+        # Same as GenotypeConfidenceSimulator._simulate_confidence_scores()
+        if depth_variance < mean_depth:
+            depth_variance = 2 * mean_depth
+        axes = [
+            GcpTable._axis_weights(
+                np.log(self.mean_depths), math.log(mean_depth), "Mean depth"
+            ),
+            GcpTable._axis_weights(
+                self.variance_ratios, depth_variance / mean_depth, "Variance ratio"
+            ),
+            GcpTable._axis_weights(
+                np.log(self.error_rates), math.log(error_rate), "Error rate"
+            ),
+        ]
+
+        percentiles = np.zeros(self.percentiles.shape[3], dtype=np.float64)
+        for corner in range(8):
+            index = []
+            weight = 1.0
+            for axis, (i, j, w) in enumerate(axes):
+                if (corner >> axis) & 1:
+                    index.append(j)
+                    weight *= w
+                else:
+                    index.append(i)
+                    weight *= 1 - w
+            if weight > 0:
+                percentiles += weight * self.percentiles[tuple(index)]
+        return InterpolatedPercentiles(percentiles / 100)
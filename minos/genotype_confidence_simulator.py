@@ -1,38 +1,169 @@
+import concurrent.futures
+import io
 import logging
 import numpy as np
 from scipy import stats
 
 from minos import genotyper
 
+# Change this when the simulations change, so that old results in a
+# disk_cache.DiskCache are not used
+SIMULATION_VERSION = 3
+
+# Simulations are run in chunks of this many iterations, each with its own
+# random number generator made from the seed and the index of the chunk.
+# This means that the results only depend on the seed, and not on the
+# number of threads used to run the chunks
+SIMULATION_CHUNK_SIZE = 10000
+
+# In adaptive mode (see GenotypeConfidenceSimulator), these percentiles of
+# the simulated scores are checked for convergence
+DEFAULT_CONVERGENCE_QUANTILES = [5, 25, 50, 75, 95]
+
+# Default maximum number of iterations in adaptive mode
+DEFAULT_MAX_ADAPTIVE_ITERATIONS = 1000000
+
+# When calculating the exact distribution of confidence scores (see
+# GenotypeConfidenceSimulator), coverages are ignored if they are in the
+# tails of the coverage distributions, which together have at most this
+# much probability
+DEFAULT_EXACT_TAIL_MASS = 1e-9
+
 
 class GenotypeConfidenceSimulator:
     def __init__(
-        self, mean_depth, depth_variance, error_rate, allele_length=1, iterations=10000
+        self,
+        mean_depth,
+        depth_variance,
+        error_rate,
+        allele_length=1,
+        iterations=10000,
+        model=None,
+        ploidy=2,
+        cache=None,
+        threads=1,
+        tolerance=None,
+        quantiles=DEFAULT_CONVERGENCE_QUANTILES,
+        max_iterations=DEFAULT_MAX_ADAPTIVE_ITERATIONS,
+        exact=False,
+        exact_tail_mass=DEFAULT_EXACT_TAIL_MASS,
     ):
         self.mean_depth = mean_depth
         self.depth_variance = depth_variance
         self.error_rate = error_rate
         self.iterations = iterations
         self.allele_length = allele_length
+        self.model = model
+        self.ploidy = ploidy
+        # If cache is a disk_cache.DiskCache, simulated scores are saved in
+        # it, and reused by later runs with the same parameters
+        self.cache = cache
+        self.threads = threads
+        # If tolerance is not None, use adaptive mode: simulate in batches
+        # of iterations, and stop when no score at the given quantiles
+        # changes by tolerance or more after adding a batch, or when
+        # max_iterations is reached. The number of iterations run and the
+        # biggest change of the last batch are put in iterations_used and
+        # convergence_error
+        self.tolerance = tolerance
+        # Floats, so that the cache key is the same for eg 5 and 5.0
+        self.quantiles = [float(x) for x in quantiles]
+        self.max_iterations = max_iterations
+        self.iterations_used = None
+        self.convergence_error = None
+        # If exact is True, the percentiles are calculated from the
+        # probability of every pair of correct and incorrect coverage,
+        # instead of by simulation, which ignores the iterations, cache
+        # and adaptive mode options
+        self.exact = exact
+        self.exact_tail_mass = exact_tail_mass
         self.confidence_scores_percentiles = {}
         self.min_conf_score = None
         self.max_conf_score = None
+        # Sorted array of the distinct simulated confidence scores, and
+        # array of their percentiles. Made from
+        # confidence_scores_percentiles when needed
+        self.percentile_scores = None
+        self.percentile_values = None
 
     @classmethod
-    def _simulate_confidence_scores(
-        cls,
-        mean_depth,
-        depth_variance,
-        error_rate,
-        iterations,
-        allele_length=1,
-        seed=42,
+    def _confidence_scores(
+        cls, model, incorrect_coverage, correct_coverage, allele_length=1
     ):
-        np.random.seed(seed)
-        allele_groups_dict = {"1": {0}, "2": {1}}
-        i = 0
-        confidences = []
-        #  We can't use the negative binomial unless depth_variance > mean_depth.
+        """Returns list of the genotype confidences (rounded to the nearest
+        integer) of sites with two alleles of length allele_length, where
+        the coverage of each site is in the arrays incorrect_coverage (on
+        allele 0) and correct_coverage (on allele 1). Every position of
+        an allele has the same coverage. The confidences are the same as
+        running genotyper.Genotyper on each site, but are calculated using
+        numpy arrays. Each site must have non-zero total coverage"""
+        incorrect_coverage = np.asarray(incorrect_coverage, dtype=np.int64)
+        correct_coverage = np.asarray(correct_coverage, dtype=np.int64)
+        total_depth = incorrect_coverage + correct_coverage
+        assert np.all(total_depth > 0)
+        mean_depth = model.mean_depth
+        non_zeros = [
+            np.where(x >= model.min_cov_more_than_error, allele_length, 0)
+            for x in (incorrect_coverage, correct_coverage)
+        ]
+
+        # Terms are added in the same order as in
+        # genotyper.GenotypingModel.log_likelihood_homozygous(), so that the
+        # results are identical
+        likelihoods = np.empty((3, len(total_depth)), dtype=np.float64)
+        for allele, depth in enumerate((incorrect_coverage, correct_coverage)):
+            likelihoods[allele] = (
+                -mean_depth * (1 + (allele_length - non_zeros[allele]) / allele_length)
+                + depth * model.log_mean_depth
+                - model.lgamma_plus_one_array(depth)
+                + (total_depth - depth) * model.log_error_rate
+                + non_zeros[allele] * model.log_prob_non_zero / allele_length
+            )
+
+        # Heterozygous genotype is only possible when both alleles have
+        # coverage. There is no shared coverage, so no dispatching to do.
+        # Terms in same order as
+        # genotyper.GenotypingModel.log_likelihood_heterozygous()
+        has_het = (incorrect_coverage > 0) & (correct_coverage > 0)
+        likelihoods[2] = -np.inf
+        if model.ploidy == 2 and has_het.any():
+            depth1 = incorrect_coverage[has_het].astype(np.float64)
+            depth2 = correct_coverage[has_het].astype(np.float64)
+            fraction1 = non_zeros[0][has_het] / allele_length
+            fraction2 = non_zeros[1][has_het] / allele_length
+            likelihoods[2, has_het] = (
+                -mean_depth * (1 + 0.5 * ((1 - fraction1) + (1 - fraction2)))
+                + (depth1 + depth2) * model.log_half_mean_depth
+                - model.lgamma_plus_one_array(depth1)
+                - model.lgamma_plus_one_array(depth2)
+                + (total_depth[has_het] - depth1 - depth2) * model.log_error_rate
+                + (fraction1 + fraction2) * model.log_prob_non_zero_half
+            )
+
+        # argmax returns the first of equal values, which is the same as
+        # the genotyper breaking ties by the order the genotypes are added:
+        # 0/0, 1/1, 0/1
+        sites = np.arange(len(total_depth))
+        best = np.argmax(likelihoods, axis=0)
+        best_likelihood = likelihoods[best, sites]
+        likelihoods[best, sites] = -np.inf
+        second_likelihood = likelihoods.max(axis=0)
+        # Null call if the most likely genotype is homozygous for an allele
+        # with no coverage
+        null_call = ((best == 0) & (incorrect_coverage == 0)) | (
+            (best == 1) & (correct_coverage == 0)
+        )
+        differences = (best_likelihood - second_likelihood).tolist()
+        return [
+            0 if is_null else round(round(difference, 2))
+            for difference, is_null in zip(differences, null_call.tolist())
+        ]
+
+    @classmethod
+    def _negative_binomial_parameters(cls, mean_depth, depth_variance):
+        """Returns tuple (number of successes, probability of success) of
+        the negative binomial distribution of the correct coverage"""
+        #  We can't use the negative binomial unless depth_variance > mean_depth.
         # So force it to be so.
         if depth_variance < mean_depth:
             depth_variance = 2 * mean_depth
@@ -41,39 +172,190 @@ class GenotypeConfidenceSimulator:
             )
         no_of_successes = (mean_depth ** 2) / (depth_variance - mean_depth)
         prob_of_success = 1 - (depth_variance - mean_depth) / depth_variance
+        return no_of_successes, prob_of_success
 
-        while i < iterations:
-            correct_coverage = np.random.negative_binomial(
-                no_of_successes, prob_of_success
+    @classmethod
+    def _simulate_chunk(
+        cls,
+        seed_sequence,
+        iterations,
+        no_of_successes,
+        prob_of_success,
+        model,
+        allele_length,
+    ):
+        """Returns list of iterations simulated confidence scores, drawn
+        using a random number generator made from seed_sequence"""
+        generator = np.random.Generator(np.random.PCG64(seed_sequence))
+        # Draw all the coverages at once. Sites with zero total coverage
+        # can't be genotyped, so draw them again until none are left
+        correct_coverage = generator.negative_binomial(
+            no_of_successes, prob_of_success, size=iterations
+        )
+        incorrect_coverage = generator.binomial(
+            model.mean_depth, model.error_rate, size=iterations
+        )
+        to_redraw = np.flatnonzero(correct_coverage + incorrect_coverage == 0)
+        while len(to_redraw) > 0:
+            correct_coverage[to_redraw] = generator.negative_binomial(
+                no_of_successes, prob_of_success, size=len(to_redraw)
             )
-            incorrect_coverage = np.random.binomial(mean_depth, error_rate)
-            if correct_coverage + incorrect_coverage == 0:
-                continue
-
-            allele_combination_cov = {}
-            if incorrect_coverage > 0:
-                allele_combination_cov["1"] = incorrect_coverage
-            if correct_coverage > 0:
-                allele_combination_cov["2"] = correct_coverage
-            allele_per_base_cov = [
-                [incorrect_coverage] * allele_length,
-                [correct_coverage] * allele_length,
-            ]
-            gtyper = genotyper.Genotyper(
-                mean_depth,
-                error_rate,
-                allele_combination_cov,
-                allele_per_base_cov,
-                allele_groups_dict,
+            incorrect_coverage[to_redraw] = generator.binomial(
+                model.mean_depth, model.error_rate, size=len(to_redraw)
             )
-            gtyper.run()
-            confidences.append(round(gtyper.genotype_confidence))
-            i += 1
+            to_redraw = to_redraw[
+                correct_coverage[to_redraw] + incorrect_coverage[to_redraw] == 0
+            ]
+        return GenotypeConfidenceSimulator._confidence_scores(
+            model, incorrect_coverage, correct_coverage, allele_length=allele_length
+        )
+
+    @classmethod
+    def _simulate_confidence_scores(
+        cls,
+        mean_depth,
+        depth_variance,
+        error_rate,
+        iterations,
+        allele_length=1,
+        seed=42,
+        model=None,
+        ploidy=2,
+        threads=1,
+        first_chunk=0,
+    ):
+        """Returns sorted list of iterations simulated confidence scores.
+        The random number generator of each chunk of the simulations is
+        made from the seed and the index of the chunk, starting at
+        first_chunk. To get more scores that are independent of the
+        ones from one call, make another call with first_chunk set to the
+        number of chunks used by the first call (see number_of_chunks())"""
+        if model is None:
+            model = genotyper.GenotypingModel(mean_depth, error_rate, ploidy=ploidy)
+        no_of_successes, prob_of_success = GenotypeConfidenceSimulator._negative_binomial_parameters(
+            mean_depth, depth_variance
+        )
+
+        chunk_sizes = [
+            min(SIMULATION_CHUNK_SIZE, iterations - i)
+            for i in range(0, iterations, SIMULATION_CHUNK_SIZE)
+        ]
+        # Same as np.random.SeedSequence(seed).spawn(), but starting at first_chunk
+        seed_sequences = [
+            np.random.SeedSequence(seed, spawn_key=(first_chunk + i,))
+            for i in range(len(chunk_sizes))
+        ]
+
+        if threads > 1 and len(chunk_sizes) > 1:
+            # The model's table of lgamma values grows when it is used,
+            # so each chunk gets its own copy of the model. numpy releases
+            # the GIL for most of the work, so the threads run in parallel
+            def run_chunk(chunk):
+                chunk_model = genotyper.GenotypingModel(
+                    model.mean_depth,
+                    model.error_rate,
+                    min_cov_more_than_error=model.min_cov_more_than_error,
+                    ploidy=model.ploidy,
+                )
+                return GenotypeConfidenceSimulator._simulate_chunk(
+                    seed_sequences[chunk],
+                    chunk_sizes[chunk],
+                    no_of_successes,
+                    prob_of_success,
+                    chunk_model,
+                    allele_length,
+                )
 
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                chunks = list(executor.map(run_chunk, range(len(chunk_sizes))))
+        else:
+            chunks = [
+                GenotypeConfidenceSimulator._simulate_chunk(
+                    seed_sequence,
+                    chunk_size,
+                    no_of_successes,
+                    prob_of_success,
+                    model,
+                    allele_length,
+                )
+                for seed_sequence, chunk_size in zip(seed_sequences, chunk_sizes)
+            ]
+
+        confidences = [x for chunk in chunks for x in chunk]
         assert len(confidences) == iterations
         confidences.sort()
         return confidences
 
+    @classmethod
+    def number_of_chunks(cls, iterations):
+        """Returns the number of chunks used by _simulate_confidence_scores()"""
+        return -(-iterations // SIMULATION_CHUNK_SIZE)
+
+    @classmethod
+    def _exact_conf_to_percentile_dict(
+        cls,
+        mean_depth,
+        depth_variance,
+        error_rate,
+        allele_length=1,
+        model=None,
+        ploidy=2,
+        tail_mass=DEFAULT_EXACT_TAIL_MASS,
+    ):
+        """Returns the same as _make_conf_to_percentile_dict() would for an
+        infinite number of simulations. Calculates the probability of each
+        pair of correct and incorrect coverage that the simulations can
+        draw, ignoring tails of total probability at most tail_mass. In the
+        simulations, a score with probability p_less of smaller scores and
+        p_equal of the same score has percentile 100 * (p_less + p_equal / 2)"""
+        if model is None:
+            model = genotyper.GenotypingModel(mean_depth, error_rate, ploidy=ploidy)
+        no_of_successes, prob_of_success = GenotypeConfidenceSimulator._negative_binomial_parameters(
+            mean_depth, depth_variance
+        )
+        # Same distributions as _simulate_chunk(). The number of trials of
+        # the binomial is the integer part of the mean depth, because that
+        # is what numpy uses
+        trials = int(model.mean_depth)
+        max_correct = int(
+            stats.nbinom.ppf(1 - tail_mass / 2, no_of_successes, prob_of_success)
+        )
+        max_incorrect = min(
+            trials, int(stats.binom.ppf(1 - tail_mass / 2, trials, model.error_rate))
+        )
+        correct_probs = stats.nbinom.pmf(
+            np.arange(max_correct + 1), no_of_successes, prob_of_success
+        )
+        incorrect_probs = stats.binom.pmf(
+            np.arange(max_incorrect + 1), trials, model.error_rate
+        )
+
+        correct_coverage, incorrect_coverage = np.meshgrid(
+            np.arange(max_correct + 1), np.arange(max_incorrect + 1), indexing="ij"
+        )
+        probs = np.outer(correct_probs, incorrect_probs).ravel()
+        correct_coverage = correct_coverage.ravel()
+        incorrect_coverage = incorrect_coverage.ravel()
+        # Simulations redraw sites with zero total coverage
+        keep = (correct_coverage + incorrect_coverage > 0) & (probs > 0)
+        scores = np.array(
+            GenotypeConfidenceSimulator._confidence_scores(
+                model,
+                incorrect_coverage[keep],
+                correct_coverage[keep],
+                allele_length=allele_length,
+            ),
+            dtype=np.int64,
+        )
+        probs = probs[keep]
+
+        distinct_scores, score_indexes = np.unique(scores, return_inverse=True)
+        score_probs = np.bincount(score_indexes, weights=probs)
+        score_probs /= score_probs.sum()
+        cumulative = np.cumsum(score_probs)
+        percentiles = 100 * (cumulative - score_probs / 2)
+        return dict(zip(distinct_scores.tolist(), np.round(percentiles, 2).tolist()))
+
     @classmethod
     def _make_conf_to_percentile_dict(cls, confidence_scores):
         assert len(confidence_scores) > 0
@@ -85,161 +367,181 @@ class GenotypeConfidenceSimulator:
             conf_to_percentile[conf] = round(percentile, 2)
         return conf_to_percentile
 
-    def get_percentile(self, confidence):
-        percentile = self.confidence_scores_percentiles.get(confidence, None)
-        if percentile is not None:
-            return percentile
-
-        # If we don't know this percentile, then infer it by linearly interpolating
-        # between the two nearest values, and add
-        # it to the dict, so we don't have to work it out again
-        if self.min_conf_score is None or self.max_conf_score is None:
-            self.min_conf_score = min(self.confidence_scores_percentiles.keys())
-            self.max_conf_score = max(self.confidence_scores_percentiles.keys())
-
-        if confidence < self.min_conf_score:
-            self.confidence_scores_percentiles[confidence] = 0.00
-        elif confidence > self.max_conf_score:
-            self.confidence_scores_percentiles[confidence] = 100.00
-        else:
-            i = 0
-            left_conf = None
-            right_conf = None
-
-            for i in range(1, self.max_conf_score, 1):
-                if left_conf is None:
-                    left_conf = (
-                        confidence - i
-                        if confidence - i in self.confidence_scores_percentiles
-                        else None
-                    )
-                if right_conf is None:
-                    right_conf = self.confidence_scores_percentiles.get(
-                        confidence + 1, None
-                    )
-                    right_conf = (
-                        confidence + i
-                        if confidence + i in self.confidence_scores_percentiles
-                        else None
-                    )
-                if left_conf is not None and right_conf is not None:
-                    break
-            else:
-                raise Exception(
-                    f"Error inferring new confidence score {confidence}. Cannot continue"
-                )
+    def _set_percentile_arrays(self):
+        self.percentile_scores = np.array(
+            sorted(self.confidence_scores_percentiles), dtype=np.float64
+        )
+        self.percentile_values = np.array(
+            [
+                self.confidence_scores_percentiles[x]
+                for x in sorted(self.confidence_scores_percentiles)
+            ],
+            dtype=np.float64,
+        )
+        self.min_conf_score = min(self.confidence_scores_percentiles)
+        self.max_conf_score = max(self.confidence_scores_percentiles)
 
-            assert (
-                self.min_conf_score
-                <= left_conf
-                < confidence
-                < right_conf
-                <= self.max_conf_score
-            )
-            left_pc = self.confidence_scores_percentiles[left_conf]
-            right_pc = self.confidence_scores_percentiles[right_conf]
-            if left_pc == right_pc:
-                self.confidence_scores_percentiles[confidence] = left_pc
-            else:
-                self.confidence_scores_percentiles[confidence] = round(
-                    left_pc
-                    + ((confidence - left_conf) / (right_conf - left_conf))
-                    * (right_pc - left_pc),
-                    2,
-                )
+    def get_percentiles(self, confidences):
+        """Returns array of the percentile of each of the confidences.
+        Confidences found in the simulations get their percentile.
+        Those smaller than all simulated scores get 0, and those bigger
+        get 100. Anything else is linearly interpolated between the nearest
+        simulated scores either side of it, rounded to 2 decimal places"""
+        if self.percentile_scores is None:
+            self._set_percentile_arrays()
+        scores = self.percentile_scores
+        confidences = np.asarray(confidences, dtype=np.float64)
+        # right = index of the first simulated score >= confidence
+        right = np.searchsorted(scores, confidences, side="left")
+        right_clipped = np.minimum(right, len(scores) - 1)
+        left = np.maximum(right - 1, 0)
+        found = scores[right_clipped] == confidences
+        below = confidences < scores[0]
+        above = confidences > scores[-1]
 
-        return self.confidence_scores_percentiles[confidence]
+        left_pc = self.percentile_values[left]
+        right_pc = self.percentile_values[right_clipped]
+        left_conf = scores[left]
+        right_conf = scores[right_clipped]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            interpolated = left_pc + (
+                (confidences - left_conf) / (right_conf - left_conf)
+            ) * (right_pc - left_pc)
+        percentiles = np.where(left_pc == right_pc, left_pc, np.round(interpolated, 2))
+        percentiles[found] = self.percentile_values[right_clipped[found]]
+        percentiles[below] = 0.0
+        percentiles[above] = 100.0
+        return percentiles
 
-    def run_simulations(self):
-        confidence_scores = GenotypeConfidenceSimulator._simulate_confidence_scores(
-            self.mean_depth,
-            self.depth_variance,
-            self.error_rate,
+    def get_percentile(self, confidence):
+        """Returns the percentile of one confidence. See get_percentiles()"""
+        return float(self.get_percentiles([confidence])[0])
+
+    def cache_key(self, seed=42):
+        """Returns the key of the simulated scores in a disk_cache.DiskCache.
+        Depths are rounded to 3 decimal places (as they are in the output of
+        gramtools.check_allele_coverage_and_get_depth_stats()), and
+        the error rate to 10 significant figures"""
+        ploidy = self.ploidy if self.model is None else self.model.ploidy
+        return self.cache.key(
+            "genotype_confidence_simulation",
+            SIMULATION_VERSION,
+            round(self.mean_depth, 3),
+            round(self.depth_variance, 3),
+            format(self.error_rate, ".10g"),
             self.iterations,
-            allele_length=self.allele_length,
-        )
-        self.confidence_scores_percentiles = GenotypeConfidenceSimulator._make_conf_to_percentile_dict(
-            confidence_scores
+            self.allele_length,
+            ploidy,
+            seed,
+            self.tolerance,
+            None if self.tolerance is None else list(self.quantiles),
+            None if self.tolerance is None else self.max_iterations,
         )
 
+    def _simulate_adaptive_confidence_scores(self, seed=42):
+        """Returns sorted list of simulated confidence scores, made by
+        adaptive mode (see __init__). Sets iterations_used and
+        convergence_error"""
+        confidence_scores = []
+        previous_quantiles = None
+        first_chunk = 0
+        chunks_per_batch = GenotypeConfidenceSimulator.number_of_chunks(self.iterations)
 
-#  This class is here for when we were simulating different allele lengths.
-# It was used before the genotyper was changed to normalise non-zero coverage positions
-# by allele length. It's no longer used, but leave it here just in case.
-# Note that using it is currently pointless because the genotyper normalises by length,
-# so would only make sense to use it if the genotyper was changed.
-class Simulations:
-    def __init__(
-        self,
-        mean_depth,
-        depth_variance,
-        error_rate,
-        allele_lengths=[
-            1,
-            2,
-            3,
-            4,
-            5,
-            6,
-            7,
-            8,
-            9,
-            10,
-            11,
-            12,
-            13,
-            14,
-            15,
-            20,
-            30,
-            40,
-            50,
-        ],
-        iterations=1000,
-    ):
-        self.sims = {
-            l: GenotypeConfidenceSimulator(
-                mean_depth,
-                depth_variance,
-                error_rate,
-                allele_length=l,
-                iterations=iterations,
+        while len(confidence_scores) < self.max_iterations:
+            batch_size = min(
+                self.iterations, self.max_iterations - len(confidence_scores)
             )
-            for l in allele_lengths
-        }
-
-        for allele_length in sorted(self.sims):
-            logging.info(
-                f"Run simulation, mean_depth={mean_depth}, depth_variance={depth_variance}, error_rate={error_rate}, allele_length={allele_length}, iterations={iterations}"
+            confidence_scores.extend(
+                GenotypeConfidenceSimulator._simulate_confidence_scores(
+                    self.mean_depth,
+                    self.depth_variance,
+                    self.error_rate,
+                    batch_size,
+                    allele_length=self.allele_length,
+                    seed=seed,
+                    model=self.model,
+                    ploidy=self.ploidy,
+                    threads=self.threads,
+                    first_chunk=first_chunk,
+                )
+            )
+            first_chunk += chunks_per_batch
+            quantiles = np.percentile(confidence_scores, self.quantiles)
+            if previous_quantiles is not None:
+                self.convergence_error = float(
+                    np.max(np.abs(quantiles - previous_quantiles))
+                )
+                logging.info(
+                    f"Simulated {len(confidence_scores)} genotype confidences. Biggest change in quantiles {self.quantiles}: {self.convergence_error}"
+                )
+                if self.convergence_error < self.tolerance:
+                    break
+            previous_quantiles = quantiles
+        else:
+            logging.warning(
+                f"Genotype confidence simulations stopped at maximum of {self.max_iterations} iterations before converging to tolerance {self.tolerance}"
             )
-            self.sims[allele_length].run_simulations()
-        logging.info("Finished running simulations")
-        self.max_allele_length = max(self.sims.keys())
-        self.nearest_allele_length = {}
-
-    def get_percentile(self, allele_length, confidence):
-        if allele_length in self.sims:
-            return self.sims[allele_length].get_percentile(confidence)
-        elif allele_length > self.max_allele_length:
-            return self.sims[self.max_allele_length].get_percentile(confidence)
-        elif allele_length in self.nearest_allele_length:
-            return self.sims[self.nearest_allele_length[allele_length]].get_percentile(
-                confidence
+
+        confidence_scores.sort()
+        return confidence_scores
+
+    def _simulate_or_load_confidence_scores(self):
+        if self.cache is not None:
+            key = self.cache_key()
+            data = self.cache.get(key)
+            if data is not None:
+                logging.info(f"Using simulated confidence scores from cache {key}")
+                cached = np.load(io.BytesIO(data))
+                confidence_scores = cached["scores"].tolist()
+                self.iterations_used = len(confidence_scores)
+                if self.tolerance is not None:
+                    self.convergence_error = float(cached["convergence_error"])
+                return confidence_scores
+
+        if self.tolerance is None:
+            confidence_scores = GenotypeConfidenceSimulator._simulate_confidence_scores(
+                self.mean_depth,
+                self.depth_variance,
+                self.error_rate,
+                self.iterations,
+                allele_length=self.allele_length,
+                model=self.model,
+                ploidy=self.ploidy,
+                threads=self.threads,
             )
         else:
-            # Find the nearest allele length to the one we want, because
-            # we haven't had this allele length before
-            nearest_length = None
+            confidence_scores = self._simulate_adaptive_confidence_scores()
+        self.iterations_used = len(confidence_scores)
 
-            for i in range(1, self.max_allele_length, 1):
-                if (allele_length - i) in self.sims:
-                    nearest_length = allele_length - i
-                    break
-                elif (allele_length + i) in self.sims:
-                    nearest_length = allele_length + i
-                    break
+        if self.cache is not None:
+            data = io.BytesIO()
+            np.savez(
+                data,
+                scores=np.array(confidence_scores, dtype=np.int64),
+                convergence_error=np.nan
+                if self.convergence_error is None
+                else self.convergence_error,
+            )
+            self.cache.put(key, data.getvalue())
+            logging.info(f"Saved simulated confidence scores in cache {key}")
+        return confidence_scores
 
-            assert nearest_length is not None
+    def run_simulations(self):
+        if self.exact:
+            self.confidence_scores_percentiles = GenotypeConfidenceSimulator._exact_conf_to_percentile_dict(
+                self.mean_depth,
+                self.depth_variance,
+                self.error_rate,
+                allele_length=self.allele_length,
+                model=self.model,
+                ploidy=self.ploidy,
+                tail_mass=self.exact_tail_mass,
+            )
+            self._set_percentile_arrays()
+            return
 
-            self.nearest_allele_length[allele_length] = nearest_length
-            return self.sims[nearest_length].get_percentile(confidence)
+        confidence_scores = self._simulate_or_load_confidence_scores()
+        self.confidence_scores_percentiles = GenotypeConfidenceSimulator._make_conf_to_percentile_dict(
+            confidence_scores
+        )
+        self._set_percentile_arrays()
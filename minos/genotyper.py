@@ -1,11 +1,318 @@
+import collections
+import heapq
 import itertools
 import math
 import operator
 
+import numpy as np
+
 from scipy.stats import poisson
 
 
+# The minimum of lgamma(x + 1) for x >= 0, and where it happens
+LGAMMA_PLUS_ONE_MIN = -0.12148629053584961
+LGAMMA_PLUS_ONE_ARGMIN = 0.46163214496836225
+
+# Default maximum number of sites in a GenotypeCache
+DEFAULT_GENOTYPE_CACHE_SIZE = 100000
+
+# Default number of sites kept by a SlowSiteReport
+DEFAULT_SLOW_SITES = 100
+
+
+class GenotypeCache:
+    """Least recently used cache of genotyping results. Keys are made by
+    Genotyper.coverage_signature(), values are tuples of
+    (genotype, genotype confidence, singleton allele coverages, likelihoods,
+    haploid allele coverages, het pairs evaluated, het pairs pruned), so that
+    a Genotyper restored from the cache has the same attributes as one that
+    genotyped the site.
+    Keeps at most max_size results, forgetting the least recently used one
+    when full. Keeps count of hits and misses"""
+
+    def __init__(self, max_size=DEFAULT_GENOTYPE_CACHE_SIZE):
+        self.max_size = max_size
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, signature):
+        result = self.results.get(signature, None)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(signature)
+        return result
+
+    def add(self, signature, result):
+        self.results[signature] = result
+        self.results.move_to_end(signature)
+        if len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return 0 if lookups == 0 else self.hits / lookups
+
+    def stats_string(self):
+        return f"Genotype cache lookups: {self.hits + self.misses}. Hits: {self.hits} ({round(100 * self.hit_rate(), 2)}%). Cached sites: {len(self)}"
+
+
+class SlowSiteReport:
+    """Keeps the max_sites sites that took the longest time to genotype.
+    Add each site with add(), which only stores it if it is one of the
+    slowest sites so far, then write them with write_tsv(). One of these
+    can be shared by several runs of the genotyper (eg one per split),
+    to get the slowest sites of all of them"""
+
+    columns = ["CHROM", "POS", "ALLELES", "ALLELE_GROUPS", "HET_PAIRS", "SECONDS"]
+
+    def __init__(self, max_sites=DEFAULT_SLOW_SITES):
+        self.max_sites = max_sites
+        # Min heap of (seconds, order added, site info), so the fastest of
+        # the kept sites is at the top. Order added breaks ties, so the
+        # site info is never compared
+        self.heap = []
+        self.sites_added = 0
+        self.total_seconds = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, seconds, chrom, pos, alleles, allele_groups, het_pairs):
+        """pos should be 1-based. het_pairs is the number of heterozygous
+        genotypes whose likelihood was calculated"""
+        self.sites_added += 1
+        self.total_seconds += seconds
+        item = (
+            seconds,
+            self.sites_added,
+            (chrom, pos, alleles, allele_groups, het_pairs),
+        )
+        if len(self.heap) < self.max_sites:
+            heapq.heappush(self.heap, item)
+        elif self.max_sites > 0 and seconds > self.heap[0][0]:
+            heapq.heapreplace(self.heap, item)
+
+    def slowest_sites(self):
+        """Returns list of the kept sites, slowest first. Each one is a tuple
+        of the values in the columns of the TSV file"""
+        return [
+            site + (seconds,)
+            for seconds, _, site in sorted(self.heap, key=lambda x: (-x[0], x[1]))
+        ]
+
+    def write_tsv(self, outfile):
+        with open(outfile, "w") as f:
+            print(*SlowSiteReport.columns, sep="\t", file=f)
+            for site in self.slowest_sites():
+                print(*site[:-1], f"{site[-1]:.6f}", sep="\t", file=f)
+
+
+class GenotypingModel:
+    """Holds the values used by the genotyper that only depend on the
+    mean depth and read error rate. These are the same for every site,
+    so make one of these per run and share it between all the sites,
+    instead of recalculating them (and calling scipy) for each site.
+    Also has a lookup table of lgamma(depth + 1) for integer depths,
+    which grows as needed"""
+
+    def __init__(
+        self,
+        mean_depth,
+        error_rate,
+        min_cov_more_than_error=None,
+        prune_het_pairs=False,
+        cache_size=None,
+        ploidy=2,
+    ):
+        self.mean_depth = mean_depth
+        self.error_rate = error_rate
+        # With ploidy 1, only homozygous genotypes are considered, and
+        # GT_CONF is the difference between the two most likely alleles
+        if ploidy not in (1, 2):
+            raise Exception(f"Ploidy must be 1 or 2, but got {ploidy}")
+        self.ploidy = ploidy
+        # Sites with the same coverage signature (see
+        # Genotyper.coverage_signature()) get the same genotype. If
+        # cache_size is not None, the results of the most recent cache_size
+        # distinct signatures are kept and reused by Genotyper.run()
+        if cache_size is None:
+            self.genotype_cache = None
+        else:
+            self.genotype_cache = GenotypeCache(max_size=cache_size)
+        # If prune_het_pairs is True, heterozygous genotypes that cannot be
+        # one of the two most likely genotypes are skipped. This gives the
+        # same GT and GT_CONF, but the full list of likelihoods from
+        # Genotyper only has the heterozygous genotypes that were calculated
+        self.prune_het_pairs = prune_het_pairs
+        self.het_pairs_evaluated = 0
+        self.het_pairs_pruned = 0
+        if min_cov_more_than_error is None:
+            self.min_cov_more_than_error = Genotyper.get_min_cov_to_be_more_likely_than_error(
+                self.mean_depth, self.error_rate
+            )
+        else:
+            self.min_cov_more_than_error = min_cov_more_than_error
+
+        # If the mean depth is zero, all calls are null and the likelihoods are
+        # never calculated. Can't take log of zero, so leave them as None
+        if self.mean_depth > 0:
+            self.log_mean_depth = math.log(self.mean_depth)
+            self.log_half_mean_depth = math.log(0.5 * self.mean_depth)
+            self.log_error_rate = math.log(self.error_rate)
+            self.log_prob_non_zero = math.log(1 - poisson.pmf(0, self.mean_depth))
+            self.log_prob_non_zero_half = math.log(
+                1 - poisson.pmf(0, 0.5 * self.mean_depth)
+            )
+        else:
+            self.log_mean_depth = None
+            self.log_half_mean_depth = None
+            self.log_error_rate = None
+            self.log_prob_non_zero = None
+            self.log_prob_non_zero_half = None
+
+        self.lgamma_table = [0.0]
+        self.lgamma_array = np.array(self.lgamma_table)
+
+    def _extend_lgamma_table(self, max_depth):
+        new_length = max(max_depth + 1, 2 * len(self.lgamma_table))
+        self.lgamma_table.extend(
+            math.lgamma(i + 1) for i in range(len(self.lgamma_table), new_length)
+        )
+        self.lgamma_array = np.array(self.lgamma_table)
+
+    def lgamma_plus_one(self, depth):
+        """Returns lgamma(depth + 1). Integer depths are looked up in the table,
+        anything else (eg the non-integer coverage from dispatching shared
+        coverage between two alleles) is calculated"""
+        if not isinstance(depth, (int, np.integer)):
+            return math.lgamma(depth + 1)
+        if depth >= len(self.lgamma_table):
+            self._extend_lgamma_table(depth)
+        return self.lgamma_table[depth]
+
+    def lgamma_plus_one_array(self, depths):
+        """Same as lgamma_plus_one(), but for a numpy array of depths"""
+        depths = np.asarray(depths)
+        if len(depths) == 0:
+            return np.zeros(0, dtype=np.float64)
+        integers = depths == np.floor(depths)
+        max_depth = int(depths[integers].max()) if integers.any() else 0
+        if max_depth >= len(self.lgamma_table):
+            self._extend_lgamma_table(max_depth)
+        result = np.empty(len(depths), dtype=np.float64)
+        result[integers] = self.lgamma_array[depths[integers].astype(np.int64)]
+        if not integers.all():
+            result[~integers] = np.frompyfunc(math.lgamma, 1, 1)(depths[~integers] + 1)
+        return result
+
+    def het_allele_term(self, allele_length, non_zeros):
+        """Returns the part of the heterozygous log likelihood that only
+        depends on the length and non-zeros of one of the alleles. The
+        heterozygous log likelihood of alleles a and b, apart from the
+        terms that depend on their coverage, is
+        -mean_depth + het_allele_term(a) + het_allele_term(b)"""
+        non_zero_fraction = non_zeros / allele_length
+        return (
+            -0.5 * self.mean_depth * (1 - non_zero_fraction)
+            + non_zero_fraction * self.log_prob_non_zero_half
+        )
+
+    def het_depth_term_upper_bound(self, total_depth, min_depth, max_depth):
+        """Returns an upper bound on the part of the heterozygous log
+        likelihood that depends on the coverage of the two alleles, given
+        that their summed coverage (after dispatching shared coverage) is
+        between min_depth and max_depth"""
+        # Depth terms are D * log(0.5 * mean_depth) + (total - D) * log(error_rate)
+        # for summed depth D, which is linear in D ...
+        slope = self.log_half_mean_depth - self.log_error_rate
+        bound = total_depth * self.log_error_rate + max(
+            min_depth * slope, max_depth * slope
+        )
+        # ... and -lgamma(d1 + 1) - lgamma(d2 + 1), which is at most
+        # -2 * lgamma(D / 2 + 1) because lgamma is convex. lgamma(x + 1) is
+        # smallest at x = LGAMMA_PLUS_ONE_ARGMIN
+        if min_depth / 2 >= LGAMMA_PLUS_ONE_ARGMIN:
+            return bound - 2 * math.lgamma(min_depth / 2 + 1)
+        elif max_depth / 2 <= LGAMMA_PLUS_ONE_ARGMIN:
+            return bound - 2 * math.lgamma(max_depth / 2 + 1)
+        else:
+            return bound - 2 * LGAMMA_PLUS_ONE_MIN
+
+    def log_likelihood_homozygous(
+        self, allele_depth, total_depth, allele_length, non_zeros
+    ):
+        # Same as Genotyper._log_likelihood_homozygous(), using the
+        # precomputed values. Terms are added in the same order, so the
+        # result is identical
+        return (
+            -self.mean_depth * (1 + (allele_length - non_zeros) / allele_length)
+            + allele_depth * self.log_mean_depth
+            - self.lgamma_plus_one(allele_depth)
+            + (total_depth - allele_depth) * self.log_error_rate
+            + non_zeros * self.log_prob_non_zero / allele_length
+        )
+
+    def log_likelihood_heterozygous(
+        self,
+        allele_depth1,
+        allele_depth2,
+        total_depth,
+        allele_length1,
+        allele_length2,
+        non_zeros1,
+        non_zeros2,
+    ):
+        # Same as Genotyper._log_likelihood_heterozygous(), using the
+        # precomputed values
+        return (
+            -self.mean_depth
+            * (
+                1
+                + 0.5
+                * (
+                    (1 - (non_zeros1 / allele_length1))
+                    + (1 - (non_zeros2 / allele_length2))
+                )
+            )
+            + (allele_depth1 + allele_depth2) * self.log_half_mean_depth
+            - self.lgamma_plus_one(allele_depth1)
+            - self.lgamma_plus_one(allele_depth2)
+            + (total_depth - allele_depth1 - allele_depth2) * self.log_error_rate
+            + ((non_zeros1 / allele_length1) + (non_zeros2 / allele_length2))
+            * self.log_prob_non_zero_half
+        )
+
+
 class Genotyper:
+    # Lots of these get made (one per site, and many by the confidence
+    # simulator), so use slots to make them smaller and faster
+    __slots__ = [
+        "model",
+        "mean_depth",
+        "error_rate",
+        "min_cov_more_than_error",
+        "allele_combination_cov",
+        "allele_per_base_cov",
+        "allele_lengths",
+        "allele_non_zeros",
+        "allele_groups_dict",
+        "allele_group_masks",
+        "lean",
+        "likelihoods",
+        "genotype",
+        "genotype_confidence",
+        "singleton_allele_coverages",
+        "haploid_allele_coverages",
+        "het_pairs_evaluated",
+        "het_pairs_pruned",
+    ]
+
     def __init__(
         self,
         mean_depth,
@@ -14,23 +321,48 @@ class Genotyper:
         allele_per_base_cov,
         allele_groups_dict,
         min_cov_more_than_error=None,
+        model=None,
+        allele_group_masks=None,
+        lean=False,
+        allele_lengths=None,
+        allele_non_zeros=None,
     ):
-        self.mean_depth = mean_depth
-        self.error_rate = error_rate
+        if model is None:
+            model = GenotypingModel(
+                mean_depth, error_rate, min_cov_more_than_error=min_cov_more_than_error
+            )
+        self.model = model
+        self.mean_depth = model.mean_depth
+        self.error_rate = model.error_rate
+        self.min_cov_more_than_error = model.min_cov_more_than_error
         self.allele_combination_cov = allele_combination_cov
         self.allele_per_base_cov = allele_per_base_cov
+        # The genotyper only needs the length of each allele, and the number
+        # of positions with coverage at least min_cov_more_than_error. These
+        # can be given instead of allele_per_base_cov (eg from an
+        # allele_coverage.AlleleCoverage, which calculates them for all sites
+        # at once), in which case allele_per_base_cov can be None
+        if allele_lengths is None:
+            allele_lengths = [len(x) for x in allele_per_base_cov]
+        self.allele_lengths = allele_lengths
+        self.allele_non_zeros = allele_non_zeros
         self.allele_groups_dict = allele_groups_dict
+        # allele_group_masks is allele_groups_dict encoded as bitmasks, made by
+        # allele_groups_to_bitmasks(). Can be made once per quasimap run and
+        # shared between sites. If not given, only the groups with coverage at
+        # this site are encoded, when the likelihoods are calculated
+        self.allele_group_masks = allele_group_masks
+        # If lean is True, only the two most likely genotypes are kept in
+        # self.likelihoods, which is all that is needed by run().
+        # Otherwise self.likelihoods has all the genotypes
+        self.lean = lean
         self.likelihoods = None
         self.genotype = None
         self.genotype_confidence = None
         self.singleton_allele_coverages = {}
         self.haploid_allele_coverages = []
-        if min_cov_more_than_error is None:
-            self.min_cov_more_than_error = Genotyper.get_min_cov_to_be_more_likely_than_error(
-                self.mean_depth, self.error_rate
-            )
-        else:
-            self.min_cov_more_than_error = min_cov_more_than_error
+        self.het_pairs_evaluated = 0
+        self.het_pairs_pruned = 0
 
     @classmethod
     def get_min_cov_to_be_more_likely_than_error(cls, mean_depth, error_rate):
@@ -79,6 +411,89 @@ class Genotyper:
                 haploid_allele_coverages[allele] += coverage
         return haploid_allele_coverages
 
+    @classmethod
+    def allele_groups_to_bitmasks(cls, allele_groups_dict, keys=None):
+        """Returns dict of allele group key -> integer bitmask, where bit i
+        is set iff allele i is in the group. If keys is given, only those
+        keys are converted"""
+        if keys is None:
+            keys = allele_groups_dict.keys()
+        masks = {}
+        for key in keys:
+            mask = 0
+            for allele in allele_groups_dict[key]:
+                mask |= 1 << allele
+            masks[key] = mask
+        return masks
+
+    @classmethod
+    def _alleles_in_bitmask(cls, mask):
+        alleles = []
+        while mask:
+            lowest_bit = mask & -mask
+            alleles.append(lowest_bit.bit_length() - 1)
+            mask ^= lowest_bit
+        return alleles
+
+    @classmethod
+    def _singleton_alleles_and_coverage_from_masks(
+        cls, allele_combination_cov, allele_group_masks
+    ):
+        singleton_alleles = {}
+        for allele_key, coverage in allele_combination_cov.items():
+            mask = allele_group_masks[allele_key]
+            if mask != 0 and mask & (mask - 1) == 0:
+                singleton_alleles[mask.bit_length() - 1] = coverage
+        return singleton_alleles
+
+    @classmethod
+    def _haploid_allele_coverages_from_masks(
+        cls, num_distinct_alleles, allele_combination_cov, allele_group_masks
+    ):
+        haploid_allele_coverages = [0] * num_distinct_alleles
+        for allele_key, coverage in allele_combination_cov.items():
+            for allele in Genotyper._alleles_in_bitmask(allele_group_masks[allele_key]):
+                haploid_allele_coverages[allele] += coverage
+        return haploid_allele_coverages
+
+    @classmethod
+    def _shared_coverage_of_singleton_pairs(
+        cls, singleton_alleles, allele_combination_cov, allele_group_masks
+    ):
+        """Returns dict of (allele1, allele2) -> total coverage of the groups
+        that contain both alleles, where allele1 < allele2 and both alleles
+        are in singleton_alleles. Pairs with no shared coverage are not
+        in the dict. Only groups with at least two singleton alleles can
+        contribute, so this is one pass over the groups instead of one
+        pass per pair of alleles"""
+        singletons_mask = 0
+        for allele in singleton_alleles:
+            singletons_mask |= 1 << allele
+
+        shared = {}
+        for allele_key, coverage in allele_combination_cov.items():
+            assert coverage >= 0
+            mask = allele_group_masks[allele_key] & singletons_mask
+            if mask & (mask - 1) == 0:
+                continue
+            for pair in itertools.combinations(Genotyper._alleles_in_bitmask(mask), 2):
+                shared[pair] = shared.get(pair, 0) + coverage
+        return shared
+
+    @classmethod
+    def _dispatch_shared_coverage(
+        cls, allele1_specific_cov, allele2_specific_cov, shared_cov
+    ):
+        """Dispatches the shared coverage of two alleles to each allele,
+        proportionally to how much specific coverage each has"""
+        if allele1_specific_cov != 0 or allele2_specific_cov != 0:  # If both are zero, there is no dispatching to do.
+            allele1_belonging = allele1_specific_cov / (
+                allele1_specific_cov + allele2_specific_cov
+            )
+            allele1_specific_cov += allele1_belonging * shared_cov
+            allele2_specific_cov += (1 - allele1_belonging) * shared_cov
+        return allele1_specific_cov, allele2_specific_cov
+
     @classmethod
     def _coverage_of_diploid_alleles(
         cls,
@@ -111,11 +526,9 @@ class Genotyper:
                 allele2_total_cov += coverage
 
         ## Perform the dispatching in ambiguous equiv classes ##
-        if allele1_total_cov != 0 or allele2_total_cov != 0:  # If both are zero, there is no dispatching to do.
-            allele1_belonging = allele1_total_cov / (allele1_total_cov + allele2_total_cov)
-            allele1_total_cov += allele1_belonging * shared_cov
-            allele2_total_cov += (1 - allele1_belonging) * shared_cov
-        return allele1_total_cov, allele2_total_cov
+        return Genotyper._dispatch_shared_coverage(
+            allele1_total_cov, allele2_total_cov, shared_cov
+        )
 
     @classmethod
     def _log_likelihood_homozygous(
@@ -174,69 +587,331 @@ class Genotyper:
 
     def _calculate_log_likelihoods(self):
         """Makes a list of tuples: ( (allele(s) tuple), log likelihood).
-        List is sorted from most to least likely"""
-        self.likelihoods = []
+        List is sorted from most to least likely. If self.lean is True, the
+        list only has the two most likely genotypes"""
         total_depth = sum(self.allele_combination_cov.values())
 
-        non_zeros_per_allele = Genotyper._non_zeros_from_allele_per_base_cov(
-            self.allele_per_base_cov, self.min_cov_more_than_error
-        )
+        if self.allele_non_zeros is None:
+            self.allele_non_zeros = Genotyper._non_zeros_from_allele_per_base_cov(
+                self.allele_per_base_cov, self.min_cov_more_than_error
+            )
+        non_zeros_per_allele = self.allele_non_zeros
 
-        self.haploid_allele_coverages = Genotyper._haploid_allele_coverages(
-            len(self.allele_per_base_cov), self.allele_combination_cov, self.allele_groups_dict
-        )
+        if self.allele_group_masks is None:
+            self.allele_group_masks = Genotyper.allele_groups_to_bitmasks(
+                self.allele_groups_dict, keys=self.allele_combination_cov.keys()
+            )
 
-        for allele_number, per_base_cov in enumerate(self.allele_per_base_cov):
-            allele_length = len(per_base_cov)
-            non_zeros = non_zeros_per_allele[allele_number]
-            allele_depth = self.haploid_allele_coverages[allele_number]
+        self.haploid_allele_coverages = Genotyper._haploid_allele_coverages_from_masks(
+            len(self.allele_lengths),
+            self.allele_combination_cov,
+            self.allele_group_masks,
+        )
 
-            log_likelihood = Genotyper._log_likelihood_homozygous(
-                self.mean_depth,
-                allele_depth,
+        hom_likelihoods = [
+            self.model.log_likelihood_homozygous(
+                self.haploid_allele_coverages[allele_number],
                 total_depth,
-                self.error_rate,
                 allele_length,
-                non_zeros,
+                non_zeros_per_allele[allele_number],
+            )
+            for allele_number, allele_length in enumerate(self.allele_lengths)
+        ]
+
+        self.singleton_allele_coverages = Genotyper._singleton_alleles_and_coverage_from_masks(
+            self.allele_combination_cov, self.allele_group_masks
+        )
+        if self.model.ploidy == 1:
+            self._set_likelihoods(hom_likelihoods, [])
+            return
+
+        shared_coverages = Genotyper._shared_coverage_of_singleton_pairs(
+            self.singleton_allele_coverages,
+            self.allele_combination_cov,
+            self.allele_group_masks,
+        )
+
+        if self.model.prune_het_pairs:
+            het_likelihoods = self._pruned_heterozygous_log_likelihoods(
+                hom_likelihoods, total_depth, non_zeros_per_allele, shared_coverages
             )
-            self.likelihoods.append(({allele_number, allele_number}, log_likelihood))
+        else:
+            het_likelihoods = self._heterozygous_log_likelihoods(
+                total_depth, non_zeros_per_allele, shared_coverages
+            )
+
+        self._set_likelihoods(hom_likelihoods, het_likelihoods)
+        self.model.het_pairs_evaluated += self.het_pairs_evaluated
+        self.model.het_pairs_pruned += self.het_pairs_pruned
+
+    def _set_likelihoods(self, hom_likelihoods, het_likelihoods):
+        """hom_likelihoods = list of the log likelihood of each homozygous
+        genotype. het_likelihoods = iterable of (allele1, allele2, log likelihood)
+        of heterozygous genotypes. Sets self.likelihoods"""
+        if self.lean:
+            self.likelihoods = Genotyper._two_most_likely(
+                hom_likelihoods, het_likelihoods
+            )
+        else:
+            self.likelihoods = [
+                ({allele_number}, log_likelihood)
+                for allele_number, log_likelihood in enumerate(hom_likelihoods)
+            ]
+            self.likelihoods.extend(
+                ({allele_number1, allele_number2}, log_likelihood)
+                for allele_number1, allele_number2, log_likelihood in het_likelihoods
+            )
+            self.likelihoods.sort(key=operator.itemgetter(1), reverse=True)
+
+    @classmethod
+    def _two_most_likely(cls, hom_likelihoods, het_likelihoods):
+        """Returns the first two elements of the list of likelihoods made by
+        _calculate_log_likelihoods() when self.lean is False, in one pass and
+        without sorting. Ties are broken the same way: the genotype seen
+        first wins"""
+        best = second = -math.inf
+        best1 = best2 = second1 = second2 = None
+        for allele, log_likelihood in enumerate(hom_likelihoods):
+            if log_likelihood > best:
+                second, second1, second2 = best, best1, best2
+                best, best1, best2 = log_likelihood, allele, allele
+            elif log_likelihood > second:
+                second, second1, second2 = log_likelihood, allele, allele
+        for allele1, allele2, log_likelihood in het_likelihoods:
+            if log_likelihood > best:
+                second, second1, second2 = best, best1, best2
+                best, best1, best2 = log_likelihood, allele1, allele2
+            elif log_likelihood > second:
+                second, second1, second2 = log_likelihood, allele1, allele2
+        return [({best1, best2}, best), ({second1, second2}, second)]
 
-        self.singleton_allele_coverages = Genotyper._singleton_alleles_and_coverage(
-            self.allele_combination_cov, self.allele_groups_dict
+    def _heterozygous_log_likelihood(
+        self, allele1, allele2, total_depth, non_zeros_per_allele, shared_coverages
+    ):
+        # The coverage specific to one allele is its haploid coverage, minus
+        # the coverage of groups that also contain the other allele
+        shared_cov = shared_coverages.get(
+            (min(allele1, allele2), max(allele1, allele2)), 0
+        )
+        allele1_depth, allele2_depth = Genotyper._dispatch_shared_coverage(
+            self.haploid_allele_coverages[allele1] - shared_cov,
+            self.haploid_allele_coverages[allele2] - shared_cov,
+            shared_cov,
+        )
+        return self.model.log_likelihood_heterozygous(
+            allele1_depth,
+            allele2_depth,
+            total_depth,
+            self.allele_lengths[allele1],
+            self.allele_lengths[allele2],
+            non_zeros_per_allele[allele1],
+            non_zeros_per_allele[allele2],
         )
 
-        for (allele_number1, allele_number2) in itertools.combinations(
+    def _heterozygous_log_likelihoods(
+        self, total_depth, non_zeros_per_allele, shared_coverages
+    ):
+        """Generates (allele1, allele2, log likelihood) for every pair of
+        singleton alleles"""
+        for allele1, allele2 in itertools.combinations(
             self.singleton_allele_coverages.keys(), 2
         ):
-            allele1_depth, allele2_depth = Genotyper._coverage_of_diploid_alleles(
-                allele_number1,
-                allele_number2,
-                self.allele_combination_cov,
-                self.allele_groups_dict,
+            self.het_pairs_evaluated += 1
+            yield allele1, allele2, self._heterozygous_log_likelihood(
+                allele1, allele2, total_depth, non_zeros_per_allele, shared_coverages
             )
-            allele1_length = len(self.allele_per_base_cov[allele_number1])
-            allele2_length = len(self.allele_per_base_cov[allele_number2])
-            non_zeros1 = non_zeros_per_allele[allele_number1]
-            non_zeros2 = non_zeros_per_allele[allele_number2]
-
-            log_likelihood = Genotyper._log_likelihood_heterozygous(
-                self.mean_depth,
-                allele1_depth,
-                allele2_depth,
-                total_depth,
-                self.error_rate,
-                allele1_length,
-                allele2_length,
-                non_zeros1,
-                non_zeros2,
+
+    def _pruned_heterozygous_log_likelihoods(
+        self, hom_likelihoods, total_depth, non_zeros_per_allele, shared_coverages
+    ):
+        """Same as _heterozygous_log_likelihoods(), but skips pairs whose
+        likelihood cannot beat the second best likelihood found so far,
+        starting with the homozygous likelihoods.
+        Returns list of (allele1, allele2, log likelihood) for the pairs that
+        were calculated, in the same order as itertools.combinations()"""
+        singletons = list(self.singleton_allele_coverages)
+        position = {allele: i for i, allele in enumerate(singletons)}
+        best = second = -math.inf
+        for log_likelihood in hom_likelihoods:
+            if log_likelihood > best:
+                best, second = log_likelihood, best
+            elif log_likelihood > second:
+                second = log_likelihood
+
+        # Try the alleles with the most coverage first, because they are most
+        # likely to make good genotypes and raise the bar for the rest
+        ranked = sorted(
+            singletons, key=lambda a: self.haploid_allele_coverages[a], reverse=True
+        )
+        allele_terms = [
+            self.model.het_allele_term(self.allele_lengths[a], non_zeros_per_allele[a])
+            for a in ranked
+        ]
+        best_allele_term_from = allele_terms[:]
+        for i in reversed(range(len(ranked) - 1)):
+            best_allele_term_from[i] = max(
+                allele_terms[i], best_allele_term_from[i + 1]
             )
-            self.likelihoods.append(
-                (set([allele_number1, allele_number2]), log_likelihood)
+
+        het_likelihoods = []
+        for i, allele1 in enumerate(ranked):
+            depth1 = self.haploid_allele_coverages[allele1]
+            # The summed coverage of the two alleles is at least the coverage of
+            # allele1, unless neither allele has coverage specific to it, in
+            # which case no coverage is dispatched to them
+            min_depth = depth1 if self.singleton_allele_coverages[allele1] > 0 else 0
+            for j in range(i + 1, len(ranked)):
+                allele2 = ranked[j]
+                # Alleles after j have no more coverage than allele2, and their
+                # allele terms are at most best_allele_term_from[j]. So if this
+                # bound is too low, it is too low for all of them
+                upper_bound = (
+                    -self.mean_depth
+                    + allele_terms[i]
+                    + best_allele_term_from[j]
+                    + self.model.het_depth_term_upper_bound(
+                        total_depth,
+                        min_depth,
+                        depth1 + self.haploid_allele_coverages[allele2],
+                    )
+                )
+                if upper_bound < second - 1e-6 * (1 + abs(second)):
+                    self.het_pairs_pruned += len(ranked) - j
+                    break
+
+                log_likelihood = self._heterozygous_log_likelihood(
+                    allele1,
+                    allele2,
+                    total_depth,
+                    non_zeros_per_allele,
+                    shared_coverages,
+                )
+                if position[allele1] > position[allele2]:
+                    allele1_out, allele2_out = allele2, allele1
+                else:
+                    allele1_out, allele2_out = allele1, allele2
+                het_likelihoods.append((allele1_out, allele2_out, log_likelihood))
+                if log_likelihood > best:
+                    best, second = log_likelihood, best
+                elif log_likelihood > second:
+                    second = log_likelihood
+
+        self.het_pairs_evaluated = len(het_likelihoods)
+        het_likelihoods.sort(key=lambda x: (position[x[0]], position[x[1]]))
+        return het_likelihoods
+
+    def coverage_signature(self):
+        """Returns a tuple that has everything that the genotype depends on
+        (apart from the values in self.model): the allele groups (as
+        bitmasks, in the same order as allele_combination_cov because
+        that order can break ties) with their coverage, and the length and
+        non-zero coverage count of each allele"""
+        if self.allele_non_zeros is None:
+            self.allele_non_zeros = Genotyper._non_zeros_from_allele_per_base_cov(
+                self.allele_per_base_cov, self.min_cov_more_than_error
+            )
+        if self.allele_group_masks is None:
+            self.allele_group_masks = Genotyper.allele_groups_to_bitmasks(
+                self.allele_groups_dict, keys=self.allele_combination_cov.keys()
+            )
+        return (
+            self.lean,
+            tuple(
+                (self.allele_group_masks[key], coverage)
+                for key, coverage in self.allele_combination_cov.items()
+            ),
+            tuple(self.allele_lengths),
+            tuple(self.allele_non_zeros),
+        )
+
+    def run(self):
+        if (
+            len(self.allele_combination_cov) == 0
+            or Genotyper._total_coverage(self.allele_combination_cov) == 0
+            or self.mean_depth == 0
+        ):
+            self.genotype = {"."}
+            self.genotype_confidence = 0.0
+            return
+
+        cache = self.model.genotype_cache
+        if cache is not None:
+            signature = self.coverage_signature()
+            result = cache.get(signature)
+            if result is not None:
+                (
+                    genotype,
+                    confidence,
+                    singletons,
+                    likelihoods,
+                    haploid,
+                    self.het_pairs_evaluated,
+                    self.het_pairs_pruned,
+                ) = result
+                self.genotype = set(genotype)
+                self.genotype_confidence = confidence
+                self.singleton_allele_coverages = dict(singletons)
+                self.likelihoods = likelihoods
+                self.haploid_allele_coverages = list(haploid)
+                return
+
+        self._call_genotype()
+
+        if cache is not None:
+            cache.add(
+                signature,
+                (
+                    frozenset(self.genotype),
+                    self.genotype_confidence,
+                    self.singleton_allele_coverages.copy(),
+                    self.likelihoods,
+                    tuple(self.haploid_allele_coverages),
+                    self.het_pairs_evaluated,
+                    self.het_pairs_pruned,
+                ),
+            )
+
+    def _call_genotype(self):
+        self._calculate_log_likelihoods()
+        assert self.likelihoods is not None and len(self.likelihoods) > 1
+        self.genotype, best_log_likelihood = self.likelihoods[0]
+
+        for allele in self.genotype:
+            if self.singleton_allele_coverages.get(allele, 0) == 0:
+                self.genotype = {"."}
+                self.genotype_confidence = 0.0
+                break
+        else:
+            self.genotype_confidence = round(
+                best_log_likelihood - self.likelihoods[1][1], 2
             )
 
-        self.likelihoods.sort(key=operator.itemgetter(1), reverse=True)
+
+class BiallelicGenotyper(Genotyper):
+    """Genotyper for sites with two alleles. The only possible allele
+    groups are {0}, {1} and {0, 1}, so the three genotypes 0/0, 1/1 and 0/1
+    are worked out directly from the coverage, instead of going through the
+    general code that handles any number of alleles. Gives the same results
+    as Genotyper. Use site_is_biallelic() to check if a site can use this"""
+
+    __slots__ = []
+
+    @classmethod
+    def site_is_biallelic(
+        cls, number_of_alleles, allele_combination_cov, allele_group_masks
+    ):
+        """Returns True iff the site has two alleles, and all the allele
+        groups in allele_combination_cov are in allele_group_masks"""
+        if number_of_alleles != 2:
+            return False
+        for allele_key in allele_combination_cov:
+            if allele_group_masks.get(allele_key, 0) not in (1, 2, 3):
+                return False
+        return True
 
     def run(self):
+        # The genotype cache is not used, because it takes about as long to
+        # make the coverage signature as it does to genotype the site
         if (
             len(self.allele_combination_cov) == 0
             or Genotyper._total_coverage(self.allele_combination_cov) == 0
@@ -245,16 +920,72 @@ class Genotyper:
             self.genotype = {"."}
             self.genotype_confidence = 0.0
         else:
-            self._calculate_log_likelihoods()
-            assert self.likelihoods is not None and len(self.likelihoods) > 1
-            self.genotype, best_log_likelihood = self.likelihoods[0]
-
-            for allele in self.genotype:
-                if self.singleton_allele_coverages.get(allele, 0) == 0:
-                    self.genotype = {"."}
-                    self.genotype_confidence = 0.0
-                    break
+            self._call_genotype()
+
+    def _calculate_log_likelihoods(self):
+        if self.allele_non_zeros is None:
+            self.allele_non_zeros = Genotyper._non_zeros_from_allele_per_base_cov(
+                self.allele_per_base_cov, self.min_cov_more_than_error
+            )
+        if self.allele_group_masks is None:
+            self.allele_group_masks = Genotyper.allele_groups_to_bitmasks(
+                self.allele_groups_dict, keys=self.allele_combination_cov.keys()
+            )
+
+        # Coverage of groups {0}, {1} and {0, 1}. Singleton coverage is put
+        # in a dict in the order that the groups are found, because this
+        # decides the order of the alleles in the heterozygous likelihood
+        total_depth = sum(self.allele_combination_cov.values())
+        shared_cov = 0
+        self.haploid_allele_coverages = [0, 0]
+        self.singleton_allele_coverages = {}
+        for allele_key, coverage in self.allele_combination_cov.items():
+            mask = self.allele_group_masks[allele_key]
+            if mask == 3:
+                shared_cov += coverage
+                self.haploid_allele_coverages[0] += coverage
+                self.haploid_allele_coverages[1] += coverage
             else:
-                self.genotype_confidence = round(
-                    best_log_likelihood - self.likelihoods[1][1], 2
+                self.singleton_allele_coverages[mask - 1] = coverage
+                self.haploid_allele_coverages[mask - 1] += coverage
+        hom_likelihoods = [
+            self.model.log_likelihood_homozygous(
+                self.haploid_allele_coverages[allele],
+                total_depth,
+                self.allele_lengths[allele],
+                self.allele_non_zeros[allele],
+            )
+            for allele in (0, 1)
+        ]
+
+        # Heterozygous genotype is only considered when both alleles have
+        # a group with only that allele in it
+        if self.model.ploidy == 2 and len(self.singleton_allele_coverages) == 2:
+            self.het_pairs_evaluated = 1
+            self.model.het_pairs_evaluated += 1
+            allele1, allele2 = self.singleton_allele_coverages
+            depth1, depth2 = Genotyper._dispatch_shared_coverage(
+                self.haploid_allele_coverages[allele1] - shared_cov,
+                self.haploid_allele_coverages[allele2] - shared_cov,
+                shared_cov,
+            )
+            het_likelihoods = [
+                (
+                    allele1,
+                    allele2,
+                    self.model.log_likelihood_heterozygous(
+                        depth1,
+                        depth2,
+                        total_depth,
+                        self.allele_lengths[allele1],
+                        self.allele_lengths[allele2],
+                        self.allele_non_zeros[allele1],
+                        self.allele_non_zeros[allele2],
+                    ),
                 )
+            ]
+        else:
+            het_likelihoods = []
+
+        self._set_likelihoods(hom_likelihoods, het_likelihoods)
+
@@ -0,0 +1,174 @@
+import json
+import os
+
+import numpy as np
+
+from minos import allele_coverage, genotyper
+
+# File of everything needed to genotype each site again, without the reads
+# or gramtools. It is text, with one JSON value per line. The first line is a
+# dict with "depths" = list of [mean depth, depth variance] (one per
+# gramtools run, eg one per split of the input VCF), and anything else about
+# the run (eg read error rate). Then there is one line per site, in the same
+# order as the VCF records, which is a list:
+#   [index of the site's depths in "depths",
+#    list of [allele group bitmask, coverage] (in gramtools order),
+#    list of allele lengths,
+#    list of per-base coverage histograms, one per allele]
+# Each histogram is a flat list [coverage1, count1, coverage2, count2, ...],
+# meaning count1 positions of the allele have coverage1 etc. This is
+# enough to get the number of positions with coverage at least any
+# minimum coverage, which depends on the mean depth and read error rate.
+
+
+def coverage_histograms(all_allele_coverage):
+    """Returns list (one element per site) of lists of the per-base coverage
+    histograms of each allele (see the description of the file format)"""
+    all_allele_coverage = allele_coverage.AlleleCoverage.from_all_allele_coverage(
+        all_allele_coverage
+    )
+    lengths = all_allele_coverage.allele_lengths()
+    allele_ids = np.repeat(np.arange(len(lengths)), lengths)
+    # Sort the coverage of each allele, then run-length encode it
+    order = np.lexsort((all_allele_coverage.base_counts, allele_ids))
+    sorted_counts = all_allele_coverage.base_counts[order]
+    sorted_ids = allele_ids[order]
+    run_starts = np.flatnonzero(
+        np.concatenate(
+            (
+                [True],
+                (sorted_counts[1:] != sorted_counts[:-1])
+                | (sorted_ids[1:] != sorted_ids[:-1]),
+            )
+        )
+    )
+    run_lengths = np.diff(np.append(run_starts, len(sorted_counts)))
+    run_values = sorted_counts[run_starts].tolist()
+    run_lengths = run_lengths.tolist()
+    runs_per_allele = np.bincount(sorted_ids[run_starts], minlength=len(lengths))
+    run_offsets = np.concatenate(([0], np.cumsum(runs_per_allele))).tolist()
+
+    histograms = []
+    for start, end in zip(run_offsets, run_offsets[1:]):
+        histogram = []
+        for i in range(start, end):
+            histogram.append(run_values[i])
+            histogram.append(run_lengths[i])
+        histograms.append(histogram)
+    return all_allele_coverage.site_slices(histograms)
+
+
+def non_zeros_from_histogram(histogram, min_cov):
+    """Returns the number of positions with coverage at least min_cov,
+    from a histogram made by coverage_histograms()"""
+    return sum(
+        histogram[i + 1] for i in range(0, len(histogram), 2) if histogram[i] >= min_cov
+    )
+
+
+def write_header(f, mean_depth, variance_depth, **kwargs):
+    """Writes the header line of a genotyping inputs file to the open
+    filehandle f. Any keyword arguments (eg read_error_rate) are added to
+    the header line"""
+    header = {"depths": [[mean_depth, variance_depth]]}
+    header.update(kwargs)
+    print(json.dumps(header), file=f)
+
+
+def write_sites(f, all_allele_coverage, allele_group_masks):
+    """Writes the lines of the sites in all_allele_coverage to the open
+    filehandle f. allele_group_masks should be made by
+    genotyper.Genotyper.allele_groups_to_bitmasks()"""
+    all_allele_coverage = allele_coverage.AlleleCoverage.from_all_allele_coverage(
+        all_allele_coverage
+    )
+    histograms = coverage_histograms(all_allele_coverage)
+    lengths = all_allele_coverage.site_slices(all_allele_coverage.allele_lengths())
+    for i, site_counts in enumerate(all_allele_coverage.site_counts):
+        groups = [[allele_group_masks[key], cov] for key, cov in site_counts.items()]
+        print(
+            json.dumps([0, groups, lengths[i], histograms[i]], separators=(",", ":")),
+            file=f,
+        )
+
+
+def write_windows(f, windows, allele_groups):
+    """Yields each (vcf records, allele coverage) tuple in windows (see
+    gramtools.write_vcf_annotated_using_coverage_windows_from_gramtools()),
+    after writing the lines of its sites to the open filehandle f. This
+    means the file is written while the windows are genotyped"""
+    masks = genotyper.Genotyper.allele_groups_to_bitmasks(allele_groups)
+    for vcf_records, all_allele_coverage in windows:
+        write_sites(f, all_allele_coverage, masks)
+        yield vcf_records, all_allele_coverage
+
+
+def write_file(
+    outfile, all_allele_coverage, allele_groups, mean_depth, variance_depth, **kwargs
+):
+    """Writes file of genotyping inputs of all the sites from one gramtools run.
+    all_allele_coverage, allele_groups, mean_depth, variance_depth should be
+    those returned by gramtools.load_gramtools_vcf_and_allele_coverage_files().
+    Any other keyword arguments (eg read_error_rate) are added to the
+    header line"""
+    masks = genotyper.Genotyper.allele_groups_to_bitmasks(allele_groups)
+    with open(outfile, "w") as f:
+        write_header(f, mean_depth, variance_depth, **kwargs)
+        write_sites(f, all_allele_coverage, masks)
+
+
+def load_file(infile):
+    """Loads file written by write_file() or merge_files(). Returns tuple:
+    (header dict, list of sites). Each site is a list as described at the
+    top of this file"""
+    with open(infile) as f:
+        header = json.loads(f.readline())
+        sites = [json.loads(line) for line in f]
+    return header, sites
+
+
+def merge_files(chunker, files_to_merge, outfile):
+    """Merges the files of genotyping inputs of each split made by
+    vcf_chunker.VcfChunker. Keeps the same sites as
+    VcfChunker.merge_files(), so that the sites in the merged file are in the
+    same order as the records of the merged VCF file. files_to_merge
+    should be a dict of ref name -> list of files, like in
+    VcfChunker.merge_files()"""
+    header = None
+    total_output_sites = 0
+
+    with open(outfile + ".tmp", "w") as f:
+        for ref_name in chunker.vcf_split_files:
+            assert ref_name in files_to_merge
+            assert len(chunker.vcf_split_files[ref_name]) == len(
+                files_to_merge[ref_name]
+            )
+            for i, split_file in enumerate(chunker.vcf_split_files[ref_name]):
+                split_header, sites = load_file(files_to_merge[ref_name][i])
+                if header is None:
+                    header = split_header
+                else:
+                    header["depths"].extend(split_header["depths"])
+                depths_index = len(header["depths"]) - 1
+                start_i = split_file.use_start_index - split_file.file_start_index
+                end_i = start_i + split_file.use_end_index - split_file.use_start_index
+                for j in range(start_i, end_i + 1, 1):
+                    sites[j][0] = depths_index
+                    total_output_sites += 1
+                    print(json.dumps(sites[j], separators=(",", ":")), file=f)
+
+    if chunker.total_input_records != total_output_sites:
+        os.unlink(outfile + ".tmp")
+        raise Exception(
+            "Number of input VCF records = "
+            + str(chunker.total_input_records)
+            + " != "
+            + str(total_output_sites)
+            + " = number of sites in genotyping inputs files. Cannot continue"
+        )
+
+    with open(outfile, "w") as f_out, open(outfile + ".tmp") as f_in:
+        print(json.dumps(header), file=f_out)
+        for line in f_in:
+            f_out.write(line)
+    os.unlink(outfile + ".tmp")
@@ -1,14 +1,54 @@
+from collections import OrderedDict, namedtuple
+import contextlib
 import copy
 import datetime
+import fractions
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import shutil
 import statistics
+import time
+
+from cluster_vcf_records import vcf_file_read, vcf_record
+
+from minos import (
+    allele_coverage,
+    dependencies,
+    disk_cache,
+    genotyper,
+    json_stream,
+    utils,
+    vcf_writer,
+)
+from minos import __version__ as minos_version
 
-from cluster_vcf_records import vcf_file_read
 
-from minos import dependencies, genotyper, utils
-from minos import __version__ as minos_version
+# Number of sites held in memory at a time when streaming the gramtools
+# output (see iter_gramtools_site_windows())
+DEFAULT_STREAM_WINDOW = 10000
+
+# What update_vcf_record_using_gramtools_allele_depths() makes from a record
+# at a site with no coverage, formatted with the record and the COV string
+NULL_RECORD_TEMPLATE = (
+    "{0.CHROM}\t{1}\t{0.ID}\t{0.REF}\t{2}\t.\t.\t.\tGT:DP:COV:GT_CONF\t./.:0:{3}:0.0"
+)
+
+
+def _null_vcf_line(vcf_record):
+    """Returns the line written to the VCF file for vcf_record, at a site that
+    has no coverage. Is the same as str(vcf_record) after calling
+    update_vcf_record_using_gramtools_allele_depths(), but without
+    changing vcf_record"""
+    return NULL_RECORD_TEMPLATE.format(
+        vcf_record,
+        vcf_record.POS + 1,
+        ",".join(vcf_record.ALT),
+        ",".join("0" * (1 + len(vcf_record.ALT))),
+    )
 
 
 def _build_json_file_is_good(json_build_report):
@@ -28,11 +68,80 @@ def _build_json_file_is_good(json_build_report):
         return success
 
 
-def run_gramtools_build(outdir, vcf_file, ref_file, max_read_length, kmer_size=10):
+def _relocate_build_report(build_dir, vcf_file, ref_file):
+    """The paths in build_report.json of a build copied from the cache
+    point to the directory the build was made in. Changes them to point to
+    build_dir, and the VCF and reference paths to vcf_file and ref_file.
+    Returns True if the files in the build report exist in build_dir,
+    otherwise False"""
+    build_dir = os.path.abspath(build_dir)
+    build_report_file = os.path.join(build_dir, "build_report.json")
+    with open(build_report_file) as f:
+        build_report = json.load(f)
+
+    paths = build_report.get("paths", {})
+    old_project = paths.get("project", None)
+    if old_project is None:
+        return True
+
+    paths_ok = True
+    for name, path in paths.items():
+        if name == "vcf":
+            paths[name] = os.path.abspath(vcf_file)
+        elif name == "reference":
+            paths[name] = os.path.abspath(ref_file)
+        elif path == old_project:
+            paths[name] = build_dir
+        elif path.startswith(old_project + os.sep):
+            paths[name] = os.path.join(build_dir, path[len(old_project) + 1 :])
+            paths_ok = paths_ok and os.path.exists(paths[name])
+
+    with open(build_report_file, "w") as f:
+        json.dump(build_report, f, indent=4)
+    return paths_ok
+
+
+def build_cache_key(vcf_file, ref_file, max_read_length, kmer_size):
+    """Returns the key of a gramtools build directory in a
+    disk_cache.DirectoryCache. Uses the contents of the files, not their
+    names, so that the same VCF and reference in a different place use the
+    same build"""
+    return disk_cache.DirectoryCache.key(
+        "gramtools_build",
+        dependencies.get_version_of_program("gramtools"),
+        disk_cache.file_sha256(vcf_file),
+        disk_cache.file_sha256(ref_file),
+        max_read_length,
+        kmer_size,
+    )
+
+
+def run_gramtools_build(
+    outdir, vcf_file, ref_file, max_read_length, kmer_size=10, cache_dir=None
+):
     """Runs gramtools build. Makes new directory called 'outdir' for
-    the output"""
+    the output. If cache_dir is given, builds are cached in its
+    subdirectory gramtools_builds (see disk_cache.DirectoryCache), and a
+    cached build of the same VCF, reference and options is copied to
+    outdir instead of running gramtools build"""
     if os.path.exists(outdir):
         raise FileExistsError(f"Gramtools build output directory '{outdir}' already exists. Cannot continue")
+
+    if cache_dir is not None:
+        cache = disk_cache.DirectoryCache(os.path.join(cache_dir, "gramtools_builds"))
+        key = build_cache_key(vcf_file, ref_file, max_read_length, kmer_size)
+        if cache.get(key, outdir):
+            if _relocate_build_report(outdir, vcf_file, ref_file):
+                logging.info(
+                    f"Copied gramtools build from cache {cache.path(key)} to {outdir}"
+                )
+                return
+            logging.warning(
+                f"Cached gramtools build {cache.path(key)} is missing files. Removing it from the cache and running gramtools build"
+            )
+            shutil.rmtree(outdir)
+            cache.remove(key)
+
     os.mkdir(outdir)
     gramtools_exe = dependencies.find_binary("gramtools")
     build_command = " ".join(
@@ -70,6 +179,9 @@ def run_gramtools_build(outdir, vcf_file, ref_file, max_read_length, kmer_size=1
         )
 
     logging.info("Build report file looks good from gramtools build: " + build_report)
+    if cache_dir is not None:
+        cache.put(key, outdir)
+        logging.info(f"Added gramtools build {outdir} to cache {cache.path(key)}")
 
 
 def run_gramtools(
@@ -81,17 +193,24 @@ def run_gramtools(
     max_read_length,
     kmer_size=10,
     seed=42,
+    cache_dir=None,
 ):
     """If build_dir does not exist, runs runs gramtools build and quasimap.
     Otherwise, just runs quasimap. quasimap output is in new
     directory called quasimap_dir.
     "reads" can be one filename, or a list of filenames.
+    cache_dir is used for gramtools build - see run_gramtools_build().
     Raises Error if either of the expected json coverage
     files made by quasimap are not found."""
     gramtools_exe = dependencies.find_binary("gramtools")
     if not os.path.exists(build_dir):
         run_gramtools_build(
-            build_dir, vcf_file, ref_file, max_read_length, kmer_size=kmer_size
+            build_dir,
+            vcf_file,
+            ref_file,
+            max_read_length,
+            kmer_size=kmer_size,
+            cache_dir=cache_dir,
         )
 
     if type(reads) is not list:
@@ -148,24 +267,27 @@ def run_gramtools(
     return json_build_report, json_quasimap_report
 
 
-def load_gramtools_vcf_and_allele_coverage_files(vcf_file, quasimap_dir):
-    """Loads the perl_generated_vcf file and allele_coverage files.
-    Sanity checks that they agree: 1) same number of lines (excluding header
-    lines in vcf) and 2) number of alts agree on each line.
-    Raises error at the first time somthing wrong is found.
-    Returns a list of tuples: (VcfRecord, dict of allele -> coverage)"""
+def load_quasimap_allele_files(quasimap_dir, ragged=False):
+    """Loads the allele coverage files from a gramtools quasimap output
+    directory. Returns the same as load_allele_files()"""
     allele_base_counts_file = os.path.join(
         quasimap_dir, "quasimap_outputs", "allele_base_coverage.json"
     )
     grouped_allele_counts_file = os.path.join(
         quasimap_dir, "quasimap_outputs", "grouped_allele_counts_coverage.json"
     )
-    all_allele_coverage, allele_groups = load_allele_files(
-        allele_base_counts_file, grouped_allele_counts_file
+    return load_allele_files(
+        allele_base_counts_file, grouped_allele_counts_file, ragged=ragged
     )
-    vcf_header, vcf_lines = vcf_file_read.vcf_file_to_list(vcf_file)
-    coverages = []
 
+
+def check_allele_coverage_and_get_depth_stats(
+    vcf_lines, all_allele_coverage, ragged=False
+):
+    """Sanity checks that the VCF records and allele coverage loaded from
+    gramtools agree: 1) same number of sites and 2) number of alts agree
+    on each line. Raises error at the first time somthing wrong is found.
+    Returns the mean and variance of the total coverage of the sites"""
     if len(all_allele_coverage) != len(vcf_lines):
         raise Exception(
             "Number of records in VCF ("
@@ -175,10 +297,15 @@ def load_gramtools_vcf_and_allele_coverage_files(vcf_file, quasimap_dir):
             + "). Cannot continue"
         )
 
-    for i, (allele_combi_coverage, allele_per_base_coverage) in enumerate(
-        all_allele_coverage
-    ):
-        if len(allele_per_base_coverage) != 1 + len(vcf_lines[i].ALT):
+    if ragged:
+        number_of_alleles = all_allele_coverage.number_of_alleles().tolist()
+        coverages = all_allele_coverage.total_coverages()
+    else:
+        number_of_alleles = [len(x[1]) for x in all_allele_coverage]
+        coverages = [sum(x[0].values()) for x in all_allele_coverage]
+
+    for i, allele_count in enumerate(number_of_alleles):
+        if allele_count != 1 + len(vcf_lines[i].ALT):
             raise Exception(
                 "Mismatch in number of alleles for this VCF record:\n"
                 + str(vcf_lines[i])
@@ -186,8 +313,6 @@ def load_gramtools_vcf_and_allele_coverage_files(vcf_file, quasimap_dir):
                 + str(i + 1)
             )
 
-        coverages.append(sum(allele_combi_coverage.values()))
-
     assert len(coverages) > 0
     # Unlikely to happen edge case on real data is when coverages has length 1.
     # It happens when running test_run in adjudicator_test, with a split VCf.
@@ -197,14 +322,180 @@ def load_gramtools_vcf_and_allele_coverage_files(vcf_file, quasimap_dir):
     else:
         variance = round(statistics.variance(coverages), 3)
 
-    return (
-        round(statistics.mean(coverages), 3),
-        variance,
-        vcf_header,
-        vcf_lines,
-        all_allele_coverage,
-        allele_groups,
+    return round(statistics.mean(coverages), 3), variance
+
+
+def load_gramtools_vcf_and_allele_coverage_files(vcf_file, quasimap_dir, ragged=False):
+    """Loads the perl_generated_vcf file and allele_coverage files.
+    Sanity checks that they agree: 1) same number of lines (excluding header
+    lines in vcf) and 2) number of alts agree on each line.
+    Raises error at the first time somthing wrong is found.
+    Returns a list of tuples: (VcfRecord, dict of allele -> coverage).
+    If ragged is True, the allele coverage is returned as an
+    allele_coverage.AlleleCoverage (see load_allele_files())"""
+    all_allele_coverage, allele_groups = load_quasimap_allele_files(
+        quasimap_dir, ragged=ragged
+    )
+    vcf_header, vcf_lines = vcf_file_read.vcf_file_to_list(vcf_file)
+    mean, variance = check_allele_coverage_and_get_depth_stats(
+        vcf_lines, all_allele_coverage, ragged=ragged
+    )
+    return (mean, variance, vcf_header, vcf_lines, all_allele_coverage, allele_groups)
+
+
+def _depth_stats_from_sums(number_of_sites, total, total_squares):
+    """Returns the mean and variance of coverages, given their number, sum,
+    and sum of squares. Uses exact arithmetic, so that the result is the
+    same as check_allele_coverage_and_get_depth_stats()"""
+    assert number_of_sites > 0
+    if number_of_sites == 1:
+        variance = 1.000
+    else:
+        variance = round(
+            float(
+                fractions.Fraction(
+                    number_of_sites * total_squares - total ** 2,
+                    number_of_sites * (number_of_sites - 1),
+                )
+            ),
+            3,
+        )
+    return round(float(fractions.Fraction(total, number_of_sites)), 3), variance
+
+
+def load_depth_stats_and_allele_groups(grouped_allele_counts_file):
+    """Reads the grouped allele counts file made by gramtools quasimap,
+    one site at a time. Returns tuple:
+    (mean depth, depth variance, number of sites, allele groups).
+    The mean and variance are the same as from
+    check_allele_coverage_and_get_depth_stats()"""
+    number_of_sites = 0
+    total = 0
+    total_squares = 0
+    allele_groups = None
+
+    with open(grouped_allele_counts_file) as f:
+        stream = json_stream.JsonStream(f)
+        for key in stream.iter_object():
+            if key != "grouped_allele_counts":
+                stream.skip_value()
+                continue
+            for key in stream.iter_object():
+                if key == "site_counts":
+                    for site_counts in stream.iter_array():
+                        coverage = sum(site_counts.values())
+                        number_of_sites += 1
+                        total += coverage
+                        total_squares += coverage * coverage
+                elif key == "allele_groups":
+                    allele_groups = stream.read_value()
+                else:
+                    stream.skip_value()
+
+    if allele_groups is None:
+        raise Exception(
+            "Error in json file "
+            + grouped_allele_counts_file
+            + ". allele_groups not found."
+        )
+    for key, value in allele_groups.items():
+        allele_groups[key] = set(value)
+
+    mean, variance = _depth_stats_from_sums(number_of_sites, total, total_squares)
+    return mean, variance, number_of_sites, allele_groups
+
+
+def iter_gramtools_site_windows(
+    vcf_file, quasimap_dir, window_size=DEFAULT_STREAM_WINDOW
+):
+    """Yields tuples (list of VcfRecords, allele_coverage.AlleleCoverage) of
+    at most window_size sites at a time, from the VCF file and allele
+    coverage files made by gramtools build and quasimap. Only one window
+    is held in memory at a time. Does the same sanity checks as
+    load_gramtools_vcf_and_allele_coverage_files(), raising an error when
+    the first problem is found"""
+    allele_base_counts_file = os.path.join(
+        quasimap_dir, "quasimap_outputs", "allele_base_coverage.json"
+    )
+    grouped_allele_counts_file = os.path.join(
+        quasimap_dir, "quasimap_outputs", "grouped_allele_counts_coverage.json"
+    )
+    all_site_counts = json_stream.iter_array(
+        grouped_allele_counts_file, ["grouped_allele_counts", "site_counts"]
     )
+    all_base_counts = json_stream.iter_array(
+        allele_base_counts_file, ["allele_base_counts"]
+    )
+    vcf_records = []
+    site_counts = []
+    allele_base_counts = []
+
+    with vcf_file_read.open_vcf_file_for_reading(vcf_file) as f:
+        records = (vcf_record.VcfRecord(x) for x in f if not x.startswith("#"))
+        for i, site in enumerate(
+            itertools.zip_longest(records, all_site_counts, all_base_counts)
+        ):
+            if site[0] is None:
+                raise Exception(
+                    f"Number of records in VCF ({i}) is less than number output from gramtools. Cannot continue"
+                )
+            elif site[1] is None or site[2] is None:
+                raise Exception(
+                    f"Number of records output from gramtools ({i}) is less than number in VCF. Cannot continue"
+                )
+
+            record, counts, base_counts = site
+            if len(base_counts) != 1 + len(record.ALT):
+                raise Exception(
+                    "Mismatch in number of alleles for this VCF record:\n"
+                    + str(record)
+                    + "\nLine number is "
+                    + str(i + 1)
+                )
+            vcf_records.append(record)
+            site_counts.append(counts)
+            allele_base_counts.append(base_counts)
+
+            if len(vcf_records) == window_size:
+                yield vcf_records, allele_coverage.AlleleCoverage.from_lists(
+                    site_counts, allele_base_counts
+                )
+                vcf_records = []
+                site_counts = []
+                allele_base_counts = []
+
+    if len(vcf_records) > 0:
+        yield vcf_records, allele_coverage.AlleleCoverage.from_lists(
+            site_counts, allele_base_counts
+        )
+
+
+def load_gramtools_files_streaming(
+    vcf_file, quasimap_dir, window_size=DEFAULT_STREAM_WINDOW
+):
+    """Same as load_gramtools_vcf_and_allele_coverage_files(), but only
+    reads the coverage of all sites once, to get the depth statistics.
+    Returns tuple:
+    (mean depth, depth variance, VCF header lines, windows, allele groups),
+    where windows is a generator from iter_gramtools_site_windows(), which
+    reads the files again, a window at a time"""
+    vcf_header = []
+    with vcf_file_read.open_vcf_file_for_reading(vcf_file) as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+            vcf_header.append(line.rstrip())
+
+    grouped_allele_counts_file = os.path.join(
+        quasimap_dir, "quasimap_outputs", "grouped_allele_counts_coverage.json"
+    )
+    mean, variance, number_of_sites, allele_groups = load_depth_stats_and_allele_groups(
+        grouped_allele_counts_file
+    )
+    windows = iter_gramtools_site_windows(
+        vcf_file, quasimap_dir, window_size=window_size
+    )
+    return mean, variance, vcf_header, windows, allele_groups
 
 
 def update_vcf_record_using_gramtools_allele_depths(
@@ -215,31 +506,82 @@ def update_vcf_record_using_gramtools_allele_depths(
     mean_depth,
     read_error_rate,
     min_cov_more_than_error=None,
+    model=None,
+    allele_group_masks=None,
+    allele_lengths=None,
+    allele_non_zeros=None,
 ):
     """allele_depths should be a dict of allele -> coverage.
     The REF allele must also be in the dict.
     So keys of dict must be equal to REF + ALTs sequences.
     This also changes all columns from QUAL onwards.
+    model should be a genotyper.GenotypingModel made from mean_depth and
+    read_error_rate. If not given, one is made for this record.
+    allele_group_masks should be allele_groups_dict encoded by
+    genotyper.Genotyper.allele_groups_to_bitmasks(). If not given, the groups
+    used by this record are encoded.
+    allele_lengths and allele_non_zeros can be given instead of
+    allele_per_base_cov (which can then be None) - see genotyper.Genotyper.
+    If allele_group_masks is given and the site has two alleles, it is
+    genotyped using genotyper.BiallelicGenotyper.
     Returns a VcfRecord the same as vcf_record, but with all zero
     coverage alleles removed, and GT and COV fixed accordingly"""
-    gtyper = genotyper.Genotyper(
+    if allele_lengths is None:
+        number_of_alleles = len(allele_per_base_cov)
+    else:
+        number_of_alleles = len(allele_lengths)
+    if (
+        allele_group_masks is not None
+        and genotyper.BiallelicGenotyper.site_is_biallelic(
+            number_of_alleles, allele_combination_cov, allele_group_masks
+        )
+    ):
+        genotyper_class = genotyper.BiallelicGenotyper
+    else:
+        genotyper_class = genotyper.Genotyper
+
+    gtyper = genotyper_class(
         mean_depth,
         read_error_rate,
         allele_combination_cov,
         allele_per_base_cov,
         allele_groups_dict,
         min_cov_more_than_error=min_cov_more_than_error,
+        model=model,
+        allele_group_masks=allele_group_masks,
+        lean=True,
+        allele_lengths=allele_lengths,
+        allele_non_zeros=allele_non_zeros,
     )
     gtyper.run()
+    return annotate_vcf_record_with_genotype(
+        vcf_record,
+        gtyper.genotype,
+        gtyper.genotype_confidence,
+        gtyper.singleton_allele_coverages,
+        sum(allele_combination_cov.values()),
+    )
+
+
+def annotate_vcf_record_with_genotype(
+    vcf_record, genotype_alleles, genotype_confidence, singleton_allele_coverages, depth
+):
+    """Changes all columns from QUAL onwards of vcf_record to have the
+    results from genotyping its site: genotype_alleles, genotype_confidence
+    and singleton_allele_coverages should be Genotyper.genotype,
+    Genotyper.genotype_confidence and Genotyper.singleton_allele_coverages,
+    and depth is the total coverage of the site.
+    Returns a VcfRecord the same as vcf_record, but with all zero
+    coverage alleles removed, and GT and COV fixed accordingly"""
     genotype_indexes = set()
 
-    if "." in gtyper.genotype:
+    if "." in genotype_alleles:
         genotype = "./."
     else:
-        if 0 in gtyper.genotype:
+        if 0 in genotype_alleles:
             genotype_indexes.add(0)
         for i in range(len(vcf_record.ALT)):
-            if i + 1 in gtyper.genotype:
+            if i + 1 in genotype_alleles:
                 genotype_indexes.add(i + 1)
 
         if len(genotype_indexes) == 1:
@@ -250,20 +592,28 @@ def update_vcf_record_using_gramtools_allele_depths(
             genotype = "/".join([str(x) for x in sorted(list(genotype_indexes))])
 
     cov_values = [
-        gtyper.singleton_allele_coverages.get(x, 0) for x in range(1 + len(vcf_record.ALT))
+        singleton_allele_coverages.get(x, 0) for x in range(1 + len(vcf_record.ALT))
     ]
     cov_string = ",".join([str(x) for x in cov_values])
+    # Use new containers instead of clearing the old ones, in case they are
+    # shared with a shallow copy of the record
     vcf_record.QUAL = None
-    vcf_record.INFO.clear()
+    vcf_record.INFO = {}
     vcf_record.FILTER = set()
-    vcf_record.FORMAT.clear()
-    vcf_record.set_format_key_value("DP", str(sum(allele_combination_cov.values())))
+    vcf_record.FORMAT = OrderedDict()
+    vcf_record.set_format_key_value("DP", str(depth))
     vcf_record.set_format_key_value("GT", genotype)
     vcf_record.set_format_key_value("COV", cov_string)
-    vcf_record.set_format_key_value("GT_CONF", str(gtyper.genotype_confidence))
-
-    # Make new record where all zero coverage alleles are removed
-    filtered_record = copy.deepcopy(vcf_record)
+    vcf_record.set_format_key_value("GT_CONF", str(genotype_confidence))
+
+    # Make new record where all zero coverage alleles are removed. This is
+    # done once per site, so avoid deepcopy: the other attributes are
+    # strings, so copying the containers is enough
+    filtered_record = copy.copy(vcf_record)
+    filtered_record.ALT = list(vcf_record.ALT)
+    filtered_record.INFO = {}
+    filtered_record.FILTER = set()
+    filtered_record.FORMAT = vcf_record.FORMAT.copy()
     if genotype in ["./.", "0/0"]:
         return filtered_record
 
@@ -303,22 +653,9 @@ def update_vcf_record_using_gramtools_allele_depths(
     return filtered_record
 
 
-def write_vcf_annotated_using_coverage_from_gramtools(
-    mean_depth,
-    vcf_records,
-    all_allele_coverage,
-    allele_groups,
-    read_error_rate,
-    outfile,
-    sample_name="SAMPLE",
-    max_read_length=None,
-    filtered_outfile=None,
-):
-    """mean_depth, vcf_records, all_allele_coverage, allele_groups should be those
-    returned by load_gramtools_vcf_and_allele_coverage_files().
-    Writes a new VCF that has allele counts for all the ALTs"""
-    assert len(vcf_records) == len(all_allele_coverage)
-
+def vcf_header_lines(sample_name, max_read_length=None):
+    """Returns list of the header lines of the VCF files written by
+    write_vcf_annotated_using_coverage_from_gramtools()"""
     header_lines = [
         "##fileformat=VCFv4.2",
         "##source=minos, version " + minos_version,
@@ -349,53 +686,292 @@ def write_vcf_annotated_using_coverage_from_gramtools(
         )
     )
 
-    min_cov_more_than_error = genotyper.Genotyper.get_min_cov_to_be_more_likely_than_error(
-        mean_depth, read_error_rate
+    return header_lines
+
+
+# The values used to genotype every site in one call of
+# write_vcf_annotated_using_coverage_windows_from_gramtools()
+_GenotypingRun = namedtuple(
+    "_GenotypingRun",
+    ["allele_groups", "allele_group_masks", "mean_depth", "read_error_rate", "model"],
+)
+
+# The sites of one window (or part of a window) to be genotyped
+_WindowSites = namedtuple(
+    "_WindowSites",
+    [
+        "vcf_records",
+        "site_counts",
+        "allele_lengths",
+        "allele_non_zeros",
+        "total_coverages",
+    ],
+)
+
+# The _GenotypingRun of a process started by _genotyping_pool(). Is set once
+# when the process starts, and is the same for all the windows
+_process_run = None
+
+
+def _genotype_sites(run, sites):
+    """Genotypes all the sites (a _WindowSites), using run (a _GenotypingRun),
+    changing their records. Yields tuple (line, filtered line, slow site) for
+    each site. The lines are VcfRecords or strings. Filtered line is None for
+    sites with zero coverage, meaning it is the same as line. Slow site is
+    the arguments for genotyper.SlowSiteReport.add(), or None for sites
+    with zero coverage"""
+    model = run.model
+    for i, vcf_record in enumerate(sites.vcf_records):
+        if sites.total_coverages[i] == 0:
+            yield _null_vcf_line(vcf_record), None, None
+            continue
+
+        logging.debug("Genotyping: " + str(vcf_record))
+        start_time = time.perf_counter()
+        het_pairs_before = model.het_pairs_evaluated
+        filtered_record = update_vcf_record_using_gramtools_allele_depths(
+            vcf_record,
+            sites.site_counts[i],
+            None,
+            run.allele_groups,
+            run.mean_depth,
+            run.read_error_rate,
+            model=model,
+            allele_group_masks=run.allele_group_masks,
+            allele_lengths=sites.allele_lengths[i],
+            allele_non_zeros=sites.allele_non_zeros[i],
+        )
+        slow_site = (
+            time.perf_counter() - start_time,
+            vcf_record.CHROM,
+            vcf_record.POS + 1,
+            len(sites.allele_lengths[i]),
+            len(sites.site_counts[i]),
+            model.het_pairs_evaluated - het_pairs_before,
+        )
+        yield vcf_record, filtered_record, slow_site
+
+
+def _init_genotyping_process(run):
+    global _process_run
+    _process_run = run
+
+
+def _genotyping_pool(run, threads):
+    """Returns a pool of threads processes for genotyping with
+    _genotype_sites_in_parallel(). Each process gets run when it starts,
+    so it is not sent again with every block of sites"""
+    return multiprocessing.get_context("fork").Pool(
+        threads, initializer=_init_genotyping_process, initargs=(run,)
     )
 
-    if filtered_outfile is not None:
-        f_filter = open(filtered_outfile, "w")
-        print(*header_lines, sep="\n", file=f_filter)
 
-    with open(outfile, "w") as f:
-        print(*header_lines, sep="\n", file=f)
+def _genotype_block(block):
+    """Run in a process of _genotyping_pool(). block is a _WindowSites.
+    Returns tuple (list of the results of _genotype_sites() with the lines
+    as strings, changes to the counters of the model)"""
+    model = _process_run.model
+    cache = model.genotype_cache
+    counters_before = (
+        model.het_pairs_evaluated,
+        model.het_pairs_pruned,
+        0 if cache is None else cache.hits,
+        0 if cache is None else cache.misses,
+    )
+    results = [
+        (str(line), None if filtered_line is None else str(filtered_line), slow_site)
+        for line, filtered_line, slow_site in _genotype_sites(_process_run, block)
+    ]
+    counters_after = (
+        model.het_pairs_evaluated,
+        model.het_pairs_pruned,
+        0 if cache is None else cache.hits,
+        0 if cache is None else cache.misses,
+    )
+    return results, [x - y for x, y in zip(counters_after, counters_before)]
+
+
+def _genotype_sites_in_parallel(pool, threads, run, sites):
+    """Same as _genotype_sites(), but genotypes contiguous blocks of the
+    sites using pool (from _genotyping_pool(run, threads)), and does not
+    change the records. Yields the results in the same order as the sites.
+    Adds the heterozygous pairs and genotype cache hits and misses of the
+    processes to the counters of run.model"""
+    number_of_sites = len(sites.vcf_records)
+    # More blocks than processes, so that a block of slow sites does not
+    # keep the other processes waiting
+    block_size = max(1, math.ceil(number_of_sites / (4 * threads)))
+    blocks = (
+        _WindowSites(*(x[start : start + block_size] for x in sites))
+        for start in range(0, number_of_sites, block_size)
+    )
+    model = run.model
+    for results, counters in pool.imap(_genotype_block, blocks):
+        model.het_pairs_evaluated += counters[0]
+        model.het_pairs_pruned += counters[1]
+        if model.genotype_cache is not None:
+            model.genotype_cache.hits += counters[2]
+            model.genotype_cache.misses += counters[3]
+        yield from results
 
-        for i in range(len(vcf_records)):
-            logging.debug("Genotyping: " + str(vcf_records[i]))
-            filtered_record = update_vcf_record_using_gramtools_allele_depths(
-                vcf_records[i],
-                all_allele_coverage[i][0],
-                all_allele_coverage[i][1],
-                allele_groups,
-                mean_depth,
-                read_error_rate,
-                min_cov_more_than_error=min_cov_more_than_error,
+
+def write_vcf_annotated_using_coverage_from_gramtools(
+    mean_depth,
+    vcf_records,
+    all_allele_coverage,
+    allele_groups,
+    read_error_rate,
+    outfile,
+    **kwargs,
+):
+    """mean_depth, vcf_records, all_allele_coverage, allele_groups should be those
+    returned by load_gramtools_vcf_and_allele_coverage_files().
+    Writes a new VCF that has allele counts for all the ALTs. See
+    write_vcf_annotated_using_coverage_windows_from_gramtools() for the
+    other options"""
+    assert len(vcf_records) == len(all_allele_coverage)
+    write_vcf_annotated_using_coverage_windows_from_gramtools(
+        mean_depth,
+        [(vcf_records, all_allele_coverage)],
+        allele_groups,
+        read_error_rate,
+        outfile,
+        **kwargs,
+    )
+
+
+def write_vcf_annotated_using_coverage_windows_from_gramtools(
+    mean_depth,
+    windows,
+    allele_groups,
+    read_error_rate,
+    outfile,
+    sample_name="SAMPLE",
+    max_read_length=None,
+    filtered_outfile=None,
+    prune_het_pairs=False,
+    genotype_cache_size=genotyper.DEFAULT_GENOTYPE_CACHE_SIZE,
+    ploidy=2,
+    slow_sites=None,
+    threads=1,
+):
+    """Same as write_vcf_annotated_using_coverage_from_gramtools(), but the
+    sites are in windows, which is an iterable of (list of VcfRecords,
+    allele coverage) tuples, eg from load_gramtools_files_streaming().
+    Each window is genotyped and written before the next one is used.
+    Writes a new VCF that has allele counts for all the ALTs.
+    If prune_het_pairs is True, heterozygous genotypes that cannot change
+    GT or GT_CONF are skipped (see genotyper.GenotypingModel).
+    Results of up to genotype_cache_size distinct site coverage signatures
+    are cached and reused (see genotyper.GenotypeCache). Use None to not
+    cache anything.
+    If ploidy is 1, only homozygous genotypes are considered.
+    Sites with zero coverage are written as null calls without running the
+    genotyper, and their records in vcf_records are not changed.
+    If slow_sites is a genotyper.SlowSiteReport, the time taken to genotype
+    each site is added to it.
+    If threads > 1, each window is split into contiguous blocks of sites,
+    which are genotyped in parallel by that many processes. The processes
+    are started once and used for all the windows. The output is the same
+    as with one thread, but the records in vcf_records are not changed, and
+    each process has its own genotype cache"""
+    header_lines = vcf_header_lines(sample_name, max_read_length=max_read_length)
+
+    model = genotyper.GenotypingModel(
+        mean_depth,
+        read_error_rate,
+        prune_het_pairs=prune_het_pairs,
+        cache_size=genotype_cache_size,
+        ploidy=ploidy,
+    )
+    allele_group_masks = genotyper.Genotyper.allele_groups_to_bitmasks(allele_groups)
+    run = _GenotypingRun(
+        allele_groups, allele_group_masks, mean_depth, read_error_rate, model
+    )
+    sites_genotyped = 0
+    sites_skipped = 0
+
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(
+            vcf_writer.VcfWriter(outfile, filtered_outfile=filtered_outfile)
+        )
+        writer.write_header(header_lines)
+        # Made when the first window with more than one site is found, and
+        # used for all the windows
+        pool = None
+
+        for vcf_records, all_allele_coverage in windows:
+            all_allele_coverage = allele_coverage.AlleleCoverage.from_all_allele_coverage(
+                all_allele_coverage
+            )
+            assert len(vcf_records) == len(all_allele_coverage)
+            sites = _WindowSites(
+                vcf_records,
+                all_allele_coverage.site_counts,
+                all_allele_coverage.site_slices(all_allele_coverage.allele_lengths()),
+                all_allele_coverage.site_slices(
+                    all_allele_coverage.allele_non_zeros(model.min_cov_more_than_error)
+                ),
+                all_allele_coverage.total_coverages(),
             )
-            print(vcf_records[i], file=f)
-            if filtered_outfile is not None:
-                print(filtered_record, file=f_filter)
 
-    if filtered_outfile is not None:
-        f_filter.close()
+            if threads > 1 and len(vcf_records) > 1:
+                if pool is None:
+                    pool = stack.enter_context(_genotyping_pool(run, threads))
+                results = _genotype_sites_in_parallel(pool, threads, run, sites)
+            else:
+                results = _genotype_sites(run, sites)
+
+            for line, filtered_line, slow_site in results:
+                writer.write(line, filtered_line)
+                if filtered_line is None:
+                    sites_skipped += 1
+                else:
+                    sites_genotyped += 1
+                if slow_sites is not None and slow_site is not None:
+                    slow_sites.add(*slow_site)
+
+    logging.info(
+        f"Genotyped {sites_genotyped} sites. Skipped {sites_skipped} sites with zero coverage"
+    )
+    if model.genotype_cache is not None:
+        logging.info(model.genotype_cache.stats_string())
+
+    if prune_het_pairs:
+        logging.info(
+            f"Heterozygous allele pairs evaluated: {model.het_pairs_evaluated}. Pruned: {model.het_pairs_pruned}"
+        )
 
 
-def load_allele_files(allele_base_counts_file, grouped_allele_counts_file):
+def load_allele_files(
+    allele_base_counts_file, grouped_allele_counts_file, ragged=False
+):
     """Loads the allele base counts and groupeed allele counts files
-    made by gramtools qausimap."""
-    with open(allele_base_counts_file) as f:
-        json_base_counts_data = json.load(f)
+    made by gramtools qausimap. If ragged is True, the allele coverage is
+    returned as an allele_coverage.AlleleCoverage, which stores the per-base
+    coverage in one numpy array instead of lists of lists of ints. The
+    allele base counts file is then read one site at a time, so the
+    per-base coverage is never all loaded as lists"""
+    if ragged:
+        allele_base_counts = json_stream.iter_array(
+            allele_base_counts_file, ["allele_base_counts"]
+        )
+    else:
+        with open(allele_base_counts_file) as f:
+            json_base_counts_data = json.load(f)
+
+        try:
+            allele_base_counts = json_base_counts_data["allele_base_counts"]
+        except:
+            raise Exception(
+                "Error in json file "
+                + allele_base_counts_file
+                + ". allele_base_counts not found."
+            )
+
     with open(grouped_allele_counts_file) as f:
         json_allele_counts_data = json.load(f)
 
-    try:
-        allele_base_counts = json_base_counts_data["allele_base_counts"]
-    except:
-        raise Exception(
-            "Error in json file "
-            + allele_base_counts_file
-            + ". allele_base_counts not found."
-        )
-
     try:
         site_counts = json_allele_counts_data["grouped_allele_counts"]["site_counts"]
     except:
@@ -416,7 +992,7 @@ def load_allele_files(allele_base_counts_file, grouped_allele_counts_file):
             + ". allele_groups not found."
         )
 
-    if len(allele_base_counts) != len(site_counts):
+    if not ragged and len(allele_base_counts) != len(site_counts):
         raise Exception(
             "Mismatch between number of records in json files "
             + allele_base_counts_file
@@ -427,4 +1003,11 @@ def load_allele_files(allele_base_counts_file, grouped_allele_counts_file):
     for key, value in allele_groups.items():
         allele_groups[key] = set(value)
 
-    return list(zip(site_counts, allele_base_counts)), allele_groups
+    if ragged:
+        # from_lists() checks that the number of sites matches
+        return (
+            allele_coverage.AlleleCoverage.from_lists(site_counts, allele_base_counts),
+            allele_groups,
+        )
+    else:
+        return list(zip(site_counts, allele_base_counts)), allele_groups
@@ -0,0 +1,146 @@
+import json
+
+# Number of characters read from the file at a time
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+_WHITESPACE = " \t\n\r"
+
+# Characters that can come after a value in valid JSON
+_VALUE_ENDS = _WHITESPACE + ",:]}"
+
+
+class JsonStream:
+    """Reads a JSON file a bit at a time, so that big arrays can be read one
+    element at a time without loading the whole file. Only the current
+    element (plus one chunk of the file) is held in memory.
+    The methods must be called in the order that the values appear in
+    the file. For example, to read {"a": [1, 2], "b": 3}:
+        for key in stream.iter_object():
+            if key == "a":
+                for x in stream.iter_array():
+                    ...
+            else:
+                stream.skip_value()"""
+
+    def __init__(self, filehandle, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.filehandle = filehandle
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read_more(self):
+        """Adds the next chunk of the file to the buffer. Returns False if
+        the end of the file has been reached"""
+        if self.eof:
+            return False
+        chunk = self.filehandle.read(self.chunk_size)
+        if chunk == "":
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position :] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, without
+        consuming it. Returns None at the end of the file"""
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in _WHITESPACE
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_more():
+                return None
+
+    def expect(self, character):
+        found = self.peek()
+        if found != character:
+            raise Exception(f"Error parsing JSON. Expected {character} but got {found}")
+        self.position += 1
+
+    def read_value(self):
+        """Returns the next value in the file"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self._read_more():
+                    continue
+                raise
+            # A number at the end of the buffer might continue in the next
+            # chunk (eg "1.5" split into "1." and "5"), so only trust a
+            # value that is followed by the end of a value
+            if (
+                end < len(self.buffer) and self.buffer[end] in _VALUE_ENDS
+            ) or not self._read_more():
+                self.position = end
+                return value
+
+    def iter_array(self):
+        """Yields the elements of the array that is next in the file"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.peek() == ",":
+                self.position += 1
+            else:
+                self.expect("]")
+                return
+
+    def iter_object(self):
+        """Yields the keys of the object that is next in the file. The value
+        of each key must be read (or skipped) before getting the next key"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.position += 1
+            else:
+                self.expect("}")
+                return
+
+    def skip_value(self):
+        """Skips the next value in the file, without holding all of it in
+        memory if it is an array or object"""
+        next_char = self.peek()
+        if next_char == "[":
+            for _ in self.iter_array():
+                pass
+        elif next_char == "{":
+            for _ in self.iter_object():
+                self.skip_value()
+        else:
+            self.read_value()
+
+
+def iter_array(filename, keys, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the elements of the array in the JSON file filename that is
+    found by following keys from the top-level object. eg keys=["a", "b"]
+    yields the elements of data["a"]["b"]. Raises an Exception if the keys
+    are not found"""
+    with open(filename) as f:
+        stream = JsonStream(f, chunk_size=chunk_size)
+        for wanted_key in keys:
+            for key in stream.iter_object():
+                if key == wanted_key:
+                    break
+                stream.skip_value()
+            else:
+                raise Exception(
+                    f"Error in json file {filename}. {wanted_key} not found"
+                )
+        yield from stream.iter_array()
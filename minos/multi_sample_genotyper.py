@@ -0,0 +1,473 @@
+import contextlib
+import copy
+import datetime
+import itertools
+import logging
+import os
+
+import numpy as np
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import allele_coverage, genotyper, gramtools, vcf_writer
+from minos import __version__ as minos_version
+
+
+class MultiSampleGenotyper:
+    """Genotypes many samples that were all mapped (gramtools quasimap) to
+    the same gramtools build. The VCF records, allele lengths and
+    the list of possible genotypes of each site are only worked out once.
+    At each site, the log likelihoods of all genotypes in all samples are
+    calculated together as a samples x genotypes matrix.
+    The genotypes and GT_CONF are the same as genotyping each sample on
+    its own with gramtools.write_vcf_annotated_using_coverage_from_gramtools().
+
+    vcf_records = list of VcfRecords of the gramtools build.
+    all_allele_coverages = list with one element per sample of allele
+    coverage, and allele_groups = list with one dict of allele groups
+    per sample, as returned by gramtools.load_gramtools_vcf_and_allele_coverage_files().
+    mean_depths = list of mean depth of each sample.
+    read_error_rates = list of error rate of each sample, or one error rate
+    to use for all the samples.
+    ploidy = 1 or 2 (see genotyper.GenotypingModel)"""
+
+    def __init__(
+        self,
+        vcf_records,
+        sample_names,
+        all_allele_coverages,
+        allele_groups,
+        mean_depths,
+        read_error_rates,
+        ploidy=2,
+    ):
+        self.vcf_records = vcf_records
+        self.ploidy = ploidy
+        self.sample_names = sample_names
+        number_of_samples = len(sample_names)
+        if not (
+            len(all_allele_coverages)
+            == len(allele_groups)
+            == len(mean_depths)
+            == number_of_samples
+        ):
+            raise Exception(
+                f"Must have the same number of sample names ({number_of_samples}), allele coverages ({len(all_allele_coverages)}), allele groups ({len(allele_groups)}) and mean depths ({len(mean_depths)})"
+            )
+        if not isinstance(read_error_rates, (list, tuple)):
+            read_error_rates = [read_error_rates] * number_of_samples
+
+        self.all_allele_coverages = [
+            allele_coverage.AlleleCoverage.from_all_allele_coverage(x)
+            for x in all_allele_coverages
+        ]
+        self.allele_group_masks = [
+            genotyper.Genotyper.allele_groups_to_bitmasks(x) for x in allele_groups
+        ]
+        self.models = [
+            genotyper.GenotypingModel(mean_depth, error_rate, ploidy=ploidy)
+            for mean_depth, error_rate in zip(mean_depths, read_error_rates)
+        ]
+
+        # All samples use the same gramtools build, so have the same alleles
+        # at every site
+        first_coverage = self.all_allele_coverages[0]
+        for i, coverage in enumerate(self.all_allele_coverages):
+            if (
+                len(coverage) != len(vcf_records)
+                or not np.array_equal(
+                    coverage.site_offsets, first_coverage.site_offsets
+                )
+                or not np.array_equal(
+                    coverage.allele_offsets, first_coverage.allele_offsets
+                )
+            ):
+                raise Exception(
+                    f"Allele coverage of sample {sample_names[i]} does not match the VCF records and/or the first sample. Cannot continue"
+                )
+        self.site_offsets = first_coverage.site_offsets.tolist()
+        self.allele_lengths = first_coverage.allele_lengths()
+        self.allele_non_zeros = np.array(
+            [
+                coverage.allele_non_zeros(model.min_cov_more_than_error)
+                for coverage, model in zip(self.all_allele_coverages, self.models)
+            ],
+            dtype=np.int64,
+        ).reshape((number_of_samples, len(self.allele_lengths)))
+
+        # Constants of each sample's model, as columns so that they broadcast
+        # along the genotypes of each sample. Samples with zero mean depth
+        # always get null calls, and their logs are not defined
+        def model_column(attribute):
+            return np.array(
+                [
+                    0.0 if getattr(m, attribute) is None else getattr(m, attribute)
+                    for m in self.models
+                ],
+                dtype=np.float64,
+            ).reshape((number_of_samples, 1))
+
+        self.mean_depth_column = model_column("mean_depth")
+        self.log_mean_depth_column = model_column("log_mean_depth")
+        self.log_half_mean_depth_column = model_column("log_half_mean_depth")
+        self.log_error_rate_column = model_column("log_error_rate")
+        self.log_prob_non_zero_column = model_column("log_prob_non_zero")
+        self.log_prob_non_zero_half_column = model_column("log_prob_non_zero_half")
+
+    @classmethod
+    def from_quasimap_dirs(
+        cls, vcf_file, quasimap_dirs, sample_names, read_error_rates, ploidy=2
+    ):
+        """Loads the VCF file of a gramtools build once, and the allele
+        coverage from the quasimap output directory of each sample"""
+        vcf_header, vcf_records = vcf_file_read.vcf_file_to_list(vcf_file)
+        all_allele_coverages = []
+        allele_groups = []
+        mean_depths = []
+        for quasimap_dir in quasimap_dirs:
+            logging.info(f"Loading gramtools quasimap output files {quasimap_dir}")
+            coverage, groups = gramtools.load_quasimap_allele_files(
+                quasimap_dir, ragged=True
+            )
+            mean_depth, variance = gramtools.check_allele_coverage_and_get_depth_stats(
+                vcf_records, coverage, ragged=True
+            )
+            all_allele_coverages.append(coverage)
+            allele_groups.append(groups)
+            mean_depths.append(mean_depth)
+
+        return cls(
+            vcf_records,
+            sample_names,
+            all_allele_coverages,
+            allele_groups,
+            mean_depths,
+            read_error_rates,
+            ploidy=ploidy,
+        )
+
+    @classmethod
+    def site_genotypes(cls, number_of_alleles, ploidy=2):
+        """Returns list of the genotypes (as tuples of allele indexes) that
+        are the columns of the likelihoods matrix of a site with
+        number_of_alleles alleles: all the homozygous genotypes, then all the
+        heterozygous genotypes (only if ploidy is 2)"""
+        genotypes = [(i, i) for i in range(number_of_alleles)]
+        if ploidy == 2:
+            genotypes.extend(itertools.combinations(range(number_of_alleles), 2))
+        return genotypes
+
+    def _site_coverage_arrays(self, site):
+        """Returns dict of the coverage of one site in all samples. Arrays
+        have one row per sample and one column per allele (or per pair of
+        alleles for shared coverage)"""
+        start = self.site_offsets[site]
+        number_of_alleles = self.site_offsets[site + 1] - start
+        number_of_samples = len(self.sample_names)
+        pair_index = {
+            pair: i
+            for i, pair in enumerate(
+                itertools.combinations(range(number_of_alleles), 2)
+            )
+        }
+        total = np.zeros(number_of_samples, dtype=np.int64)
+        haploid = np.zeros((number_of_samples, number_of_alleles), dtype=np.int64)
+        singleton_cov = np.zeros_like(haploid)
+        # Order that the singleton alleles are found in each sample, -1 if
+        # the allele is not a singleton. Decides the order of the alleles
+        # in the heterozygous likelihoods and breaks ties, like in Genotyper
+        singleton_rank = np.full_like(haploid, -1)
+        shared = np.zeros((number_of_samples, len(pair_index)), dtype=np.int64)
+
+        for sample, coverage in enumerate(self.all_allele_coverages):
+            allele_combination_cov = coverage.site_counts[site]
+            if len(allele_combination_cov) == 0:
+                continue
+            masks = self.allele_group_masks[sample]
+            total[sample] = genotyper.Genotyper._total_coverage(allele_combination_cov)
+            haploid[sample] = genotyper.Genotyper._haploid_allele_coverages_from_masks(
+                number_of_alleles, allele_combination_cov, masks
+            )
+            singletons = genotyper.Genotyper._singleton_alleles_and_coverage_from_masks(
+                allele_combination_cov, masks
+            )
+            for rank, (allele, allele_cov) in enumerate(singletons.items()):
+                singleton_rank[sample, allele] = rank
+                singleton_cov[sample, allele] = allele_cov
+            for (
+                pair,
+                pair_cov,
+            ) in genotyper.Genotyper._shared_coverage_of_singleton_pairs(
+                singletons, allele_combination_cov, masks
+            ).items():
+                shared[sample, pair_index[pair]] = pair_cov
+
+        return {
+            "total": total,
+            "haploid": haploid,
+            "singleton_cov": singleton_cov,
+            "singleton_rank": singleton_rank,
+            "shared": shared,
+            "length": self.allele_lengths[start : start + number_of_alleles],
+            "non_zeros": self.allele_non_zeros[:, start : start + number_of_alleles],
+        }
+
+    def _lgamma_plus_one(self, depths):
+        return (
+            self.models[0]
+            .lgamma_plus_one_array(depths.reshape(-1))
+            .reshape(depths.shape)
+        )
+
+    def _log_likelihoods(self, arrays):
+        """Returns samples x genotypes matrix of log likelihoods (genotypes
+        are in the order from site_genotypes()), and matrix of the same
+        shape of the order that the genotypes are considered by Genotyper
+        in each sample, for breaking ties. Heterozygous genotypes that are
+        not possible in a sample have likelihood -inf"""
+        # Terms are added in the same order as in GenotypingModel, so that the
+        # floating point results are identical to genotyping each sample on
+        # its own
+        total = arrays["total"].reshape((-1, 1))
+        depth = arrays["haploid"]
+        length = arrays["length"]
+        non_zeros = arrays["non_zeros"]
+        hom = (
+            -self.mean_depth_column * (1 + (length - non_zeros) / length)
+            + depth * self.log_mean_depth_column
+            - self._lgamma_plus_one(depth)
+            + (total - depth) * self.log_error_rate_column
+            + non_zeros * self.log_prob_non_zero_column / length
+        )
+        number_of_samples, number_of_alleles = depth.shape
+        hom_rank = np.tile(np.arange(number_of_alleles), (number_of_samples, 1))
+        if number_of_alleles < 2 or self.ploidy == 1:
+            return hom, hom_rank
+
+        pairs = np.array(list(itertools.combinations(range(number_of_alleles), 2)))
+        rank = arrays["singleton_rank"]
+        rank1 = rank[:, pairs[:, 0]]
+        rank2 = rank[:, pairs[:, 1]]
+        possible = (rank1 >= 0) & (rank2 >= 0)
+        # Each sample puts the allele of the pair that it found first
+        # as allele 1
+        swap = rank2 < rank1
+        allele1 = np.where(swap, pairs[:, 1], pairs[:, 0])
+        allele2 = np.where(swap, pairs[:, 0], pairs[:, 1])
+        shared = arrays["shared"]
+        specific1 = np.take_along_axis(depth, allele1, axis=1) - shared
+        specific2 = np.take_along_axis(depth, allele2, axis=1) - shared
+        specific_sum = specific1 + specific2
+        dispatch = specific_sum != 0
+        belonging1 = np.divide(
+            specific1, specific_sum, out=np.zeros(specific1.shape), where=dispatch
+        )
+        depth1 = np.where(dispatch, specific1 + belonging1 * shared, specific1)
+        depth2 = np.where(dispatch, specific2 + (1 - belonging1) * shared, specific2)
+        non_zero_fraction1 = (
+            np.take_along_axis(non_zeros, allele1, axis=1) / length[allele1]
+        )
+        non_zero_fraction2 = (
+            np.take_along_axis(non_zeros, allele2, axis=1) / length[allele2]
+        )
+        het = (
+            -self.mean_depth_column
+            * (1 + 0.5 * ((1 - non_zero_fraction1) + (1 - non_zero_fraction2)))
+            + (depth1 + depth2) * self.log_half_mean_depth_column
+            - self._lgamma_plus_one(depth1)
+            - self._lgamma_plus_one(depth2)
+            + (total - depth1 - depth2) * self.log_error_rate_column
+            + (non_zero_fraction1 + non_zero_fraction2)
+            * self.log_prob_non_zero_half_column
+        )
+        het[~possible] = -np.inf
+
+        # Genotyper considers heterozygous genotypes after the homozygous ones,
+        # in the order from itertools.combinations of the singleton alleles
+        singletons = (rank >= 0).sum(axis=1).reshape((-1, 1))
+        low = np.minimum(rank1, rank2)
+        high = np.maximum(rank1, rank2)
+        het_rank = number_of_alleles + (
+            low * (2 * singletons - low - 1) // 2 + high - low - 1
+        )
+        het_rank[~possible] = np.iinfo(np.int64).max
+        return np.hstack((hom, het)), np.hstack((hom_rank, het_rank))
+
+    def genotype_site(self, site):
+        """Genotypes one site in all the samples. Returns tuple of:
+        list of genotypes (columns of the likelihood matrix, see site_genotypes()),
+        samples x genotypes matrix of log likelihoods (None if there is nothing
+        to genotype), and list of the results for each sample. Each result is
+        a tuple (genotype, GT_CONF, singleton allele coverages, depth), with
+        the first three the same as the attributes of a Genotyper"""
+        arrays = self._site_coverage_arrays(site)
+        number_of_alleles = len(arrays["length"])
+        genotypes = MultiSampleGenotyper.site_genotypes(
+            number_of_alleles, ploidy=self.ploidy
+        )
+        singleton_cov = arrays["singleton_cov"].tolist()
+        singleton_rank = arrays["singleton_rank"].tolist()
+        totals = arrays["total"].tolist()
+        # Samples with no coverage, or zero mean depth, are null calls and
+        # (like in Genotyper) have no singleton allele coverage
+        results = [[{"."}, 0.0, {}, total] for total in totals]
+        genotyped = [
+            sample
+            for sample in range(len(self.sample_names))
+            if totals[sample] > 0 and self.models[sample].mean_depth > 0
+        ]
+        if len(genotyped) == 0:
+            return genotypes, None, [tuple(x) for x in results]
+
+        likelihoods, order = self._log_likelihoods(arrays)
+        best_two = np.lexsort((order, -likelihoods))[:, :2].tolist()
+        for sample in genotyped:
+            singletons = sorted(
+                (rank, allele)
+                for allele, rank in enumerate(singleton_rank[sample])
+                if rank >= 0
+            )
+            results[sample][2] = {
+                allele: singleton_cov[sample][allele] for rank, allele in singletons
+            }
+            best, second = best_two[sample]
+            genotype = set(genotypes[best])
+            if all(singleton_cov[sample][allele] > 0 for allele in genotype):
+                results[sample][0] = genotype
+                results[sample][1] = round(
+                    float(likelihoods[sample, best] - likelihoods[sample, second]), 2
+                )
+
+        return genotypes, likelihoods, [tuple(x) for x in results]
+
+    def _header_lines(self, sample_names):
+        return [
+            "##fileformat=VCFv4.2",
+            "##source=minos, version " + minos_version,
+            "##fileDate=" + str(datetime.date.today()),
+            '##FORMAT=<ID=COV,Number=R,Type=Integer,Description="Number of reads on ref and alt alleles">',
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+            '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="total read depth from gramtools">',
+            '##FORMAT=<ID=GT_CONF,Number=1,Type=Float,Description="Genotype confidence. Difference in log likelihood of most likely and next most likely genotype">',
+            "\t".join(
+                [
+                    "#CHROM",
+                    "POS",
+                    "ID",
+                    "REF",
+                    "ALT",
+                    "QUAL",
+                    "FILTER",
+                    "INFO",
+                    "FORMAT",
+                    *sample_names,
+                ]
+            ),
+        ]
+
+    def run(self, cohort_vcf=None, sample_vcfs=None, filtered_sample_vcfs=None):
+        """Genotypes all sites in all samples. Writes any of:
+        cohort_vcf = one VCF file with all the samples, with all the alleles
+        from the gramtools build.
+        sample_vcfs = list of one VCF file per sample, and
+        filtered_sample_vcfs = list of one VCF file per sample, the same as the
+        outfile and filtered_outfile made by
+        gramtools.write_vcf_annotated_using_coverage_from_gramtools().
+        If anything goes wrong, all the files are closed and deleted"""
+        for filenames in sample_vcfs, filtered_sample_vcfs:
+            if filenames is not None and len(filenames) != len(self.sample_names):
+                raise Exception(
+                    f"Must have one VCF file per sample ({len(self.sample_names)}), but got {len(filenames)}"
+                )
+
+        outfiles = [
+            x
+            for x in [cohort_vcf, *(sample_vcfs or []), *(filtered_sample_vcfs or [])]
+            if x is not None
+        ]
+        try:
+            with contextlib.ExitStack() as stack:
+                self._write_vcf_files(
+                    stack, cohort_vcf, sample_vcfs, filtered_sample_vcfs
+                )
+        except BaseException:
+            for filename in outfiles:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            raise
+
+    def _write_vcf_files(self, stack, cohort_vcf, sample_vcfs, filtered_sample_vcfs):
+        cohort_writer = None
+        if cohort_vcf is not None:
+            cohort_writer = stack.enter_context(vcf_writer.VcfWriter(cohort_vcf))
+            cohort_writer.write_header(self._header_lines(self.sample_names))
+
+        # One writer per sample. It writes the unfiltered record to the sample
+        # VCF and the filtered record to the filtered VCF. If there is only a
+        # filtered VCF, it is the writer's only output file, and
+        # filtered_only[sample] is True
+        sample_writers = [None] * len(self.sample_names)
+        filtered_only = [sample_vcfs is None] * len(self.sample_names)
+        if sample_vcfs is not None or filtered_sample_vcfs is not None:
+            for i, sample_name in enumerate(self.sample_names):
+                if sample_vcfs is None:
+                    writer = vcf_writer.VcfWriter(filtered_sample_vcfs[i])
+                else:
+                    writer = vcf_writer.VcfWriter(
+                        sample_vcfs[i],
+                        filtered_outfile=None
+                        if filtered_sample_vcfs is None
+                        else filtered_sample_vcfs[i],
+                    )
+                sample_writers[i] = stack.enter_context(writer)
+                writer.write_header(self._header_lines([sample_name]))
+
+        for site, vcf_record in enumerate(self.vcf_records):
+            genotypes, likelihoods, results = self.genotype_site(site)
+            cohort_fields = []
+
+            for sample, (genotype, conf, singletons, depth) in enumerate(results):
+                writer = sample_writers[sample]
+                if depth == 0:
+                    null_line = gramtools._null_vcf_line(vcf_record)
+                    cohort_fields.append(null_line.rsplit("\t", 1)[1])
+                    if writer is not None:
+                        writer.write(null_line)
+                    continue
+
+                # annotate_vcf_record_with_genotype() replaces the containers
+                # of the record instead of changing them, so a shallow copy
+                # leaves vcf_record unchanged
+                record = copy.copy(vcf_record)
+                filtered_record = gramtools.annotate_vcf_record_with_genotype(
+                    record, genotype, conf, singletons, depth
+                )
+                cohort_fields.append(
+                    ":".join(
+                        record.FORMAT[key] for key in ("GT", "DP", "COV", "GT_CONF")
+                    )
+                )
+                if writer is None:
+                    continue
+                elif filtered_only[sample]:
+                    writer.write(filtered_record)
+                else:
+                    writer.write(record, filtered_record)
+
+            if cohort_writer is not None:
+                cohort_writer.write(
+                    "\t".join(
+                        [
+                            vcf_record.CHROM,
+                            str(vcf_record.POS + 1),
+                            vcf_record.ID,
+                            vcf_record.REF,
+                            ",".join(vcf_record.ALT),
+                            ".",
+                            ".",
+                            ".",
+                            "GT:DP:COV:GT_CONF",
+                            *cohort_fields,
+                        ]
+                    )
+                )
@@ -0,0 +1,214 @@
+import logging
+import os
+import shutil
+import statistics
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import (
+    adjudicator,
+    disk_cache,
+    gcp_table,
+    genotype_confidence_simulator,
+    genotyper,
+    genotyping_inputs,
+    gramtools,
+    vcf_writer,
+)
+
+
+class Regenotyper:
+    """Genotypes the sites of a previous run of adjudicate again, using the
+    genotyping inputs file it wrote (see Adjudicator option
+    save_genotyping_inputs), instead of the reads. Allows changing
+    the read error rate, ploidy and filters without rerunning gramtools.
+    Options that are None are taken from the original run"""
+
+    def __init__(
+        self,
+        adjudicate_dir,
+        outdir,
+        read_error_rate=None,
+        ploidy=None,
+        overwrite_outdir=False,
+        genotype_simulation_iterations=10000,
+        filter_min_dp=5,
+        filter_min_gcp=5,
+        prune_het_pairs=False,
+        cache_dir=None,
+        threads=1,
+        simulation_tolerance=None,
+        simulation_quantiles=genotype_confidence_simulator.DEFAULT_CONVERGENCE_QUANTILES,
+        max_simulation_iterations=genotype_confidence_simulator.DEFAULT_MAX_ADAPTIVE_ITERATIONS,
+        gcp_table=None,
+        exact_gcp=False,
+    ):
+        self.adjudicate_dir = os.path.abspath(adjudicate_dir)
+        self.genotyping_inputs_file = os.path.join(
+            self.adjudicate_dir, "genotyping_inputs.jsonl"
+        )
+        self.in_vcf = os.path.join(
+            self.adjudicate_dir, "debug.calls_with_zero_cov_alleles.vcf"
+        )
+        self.outdir = os.path.abspath(outdir)
+        self.unfiltered_vcf_file = os.path.join(
+            self.outdir, "debug.calls_with_zero_cov_alleles.vcf"
+        )
+        self.final_vcf = os.path.join(self.outdir, "final.vcf")
+        self.read_error_rate = read_error_rate
+        self.ploidy = ploidy
+        self.overwrite_outdir = overwrite_outdir
+        self.genotype_simulation_iterations = genotype_simulation_iterations
+        self.filter_min_dp = filter_min_dp
+        self.filter_min_gcp = filter_min_gcp
+        self.prune_het_pairs = prune_het_pairs
+        self.cache_dir = disk_cache.cache_dir_from_options(cache_dir)
+        self.threads = threads
+        self.simulation_tolerance = simulation_tolerance
+        self.simulation_quantiles = simulation_quantiles
+        self.max_simulation_iterations = max_simulation_iterations
+        self.gcp_table = None if gcp_table is None else os.path.abspath(gcp_table)
+        self.exact_gcp = exact_gcp
+
+    def build_output_dir(self):
+        try:
+            os.mkdir(self.outdir)
+        except FileExistsError:
+            if self.overwrite_outdir:
+                shutil.rmtree(self.outdir)
+                os.mkdir(self.outdir)
+            else:
+                raise Exception(
+                    f"Output directory {self.outdir} already exists. "
+                    f"Rerun command with --force flag if you are OK with overwriting it"
+                )
+
+    def write_vcf_files(self):
+        logging.info("Loading genotyping inputs file " + self.genotyping_inputs_file)
+        header, sites = genotyping_inputs.load_file(self.genotyping_inputs_file)
+        vcf_header, vcf_records = vcf_file_read.vcf_file_to_list(self.in_vcf)
+        if len(sites) != len(vcf_records):
+            raise Exception(
+                f"Number of sites in {self.genotyping_inputs_file} ({len(sites)}) does not match number of records in {self.in_vcf} ({len(vcf_records)}). Cannot continue"
+            )
+
+        if self.read_error_rate is None:
+            self.read_error_rate = header["read_error_rate"]
+        if self.ploidy is None:
+            self.ploidy = header["ploidy"]
+        logging.info(
+            f"Genotyping {len(sites)} sites using read_error_rate={self.read_error_rate} and ploidy={self.ploidy}"
+        )
+
+        # One model per gramtools run, because each one has its own mean depth
+        models = [
+            genotyper.GenotypingModel(
+                mean_depth,
+                self.read_error_rate,
+                prune_het_pairs=self.prune_het_pairs,
+                cache_size=genotyper.DEFAULT_GENOTYPE_CACHE_SIZE,
+                ploidy=self.ploidy,
+            )
+            for mean_depth, _ in header["depths"]
+        ]
+        # The sites only have the bitmasks of their allele groups, so use
+        # str(bitmask) as the allele group keys
+        allele_groups = {}
+        allele_group_masks = {}
+        header_lines = gramtools.vcf_header_lines(
+            vcf_file_read.get_sample_name_from_vcf_header_lines(vcf_header),
+            max_read_length=header["max_read_length"],
+        )
+
+        with vcf_writer.VcfWriter(
+            self.unfiltered_vcf_file, filtered_outfile=self.final_vcf
+        ) as writer:
+            writer.write_header(header_lines)
+
+            for vcf_record, site in zip(vcf_records, sites):
+                depth_index, groups, allele_lengths, histograms = site
+                if sum(x[1] for x in groups) == 0:
+                    writer.write(gramtools._null_vcf_line(vcf_record))
+                    continue
+
+                allele_combination_cov = {}
+                for mask, cov in groups:
+                    key = str(mask)
+                    allele_combination_cov[key] = cov
+                    if key not in allele_group_masks:
+                        allele_group_masks[key] = mask
+                        allele_groups[key] = set(
+                            genotyper.Genotyper._alleles_in_bitmask(mask)
+                        )
+
+                model = models[depth_index]
+                allele_non_zeros = [
+                    genotyping_inputs.non_zeros_from_histogram(
+                        x, model.min_cov_more_than_error
+                    )
+                    for x in histograms
+                ]
+                filtered_record = gramtools.update_vcf_record_using_gramtools_allele_depths(
+                    vcf_record,
+                    allele_combination_cov,
+                    None,
+                    allele_groups,
+                    model.mean_depth,
+                    self.read_error_rate,
+                    model=model,
+                    allele_group_masks=allele_group_masks,
+                    allele_lengths=allele_lengths,
+                    allele_non_zeros=allele_non_zeros,
+                )
+                writer.write(vcf_record, filtered_record)
+
+        for model in models:
+            if model.genotype_cache is not None:
+                logging.info(model.genotype_cache.stats_string())
+
+        return header["depths"]
+
+    def run(self):
+        if not os.path.exists(self.genotyping_inputs_file):
+            raise Exception(
+                f"Genotyping inputs file {self.genotyping_inputs_file} not found. It is only made if adjudicate is run with --save_genotyping_inputs. Cannot continue"
+            )
+        self.build_output_dir()
+        depths = self.write_vcf_files()
+        mean_depth = statistics.mean([x[0] for x in depths])
+        variance_depth = statistics.mean([x[1] for x in depths])
+        if self.gcp_table is None:
+            table = None
+            logging.info(
+                f"Adding GT_CONF_PERCENTLE to VCF files using mean depth {mean_depth}, variance depth {variance_depth}, error rate {self.read_error_rate}, "
+                + (
+                    "and the exact distribution of GT_CONF"
+                    if self.exact_gcp
+                    else f"and {self.genotype_simulation_iterations} simulation iterations"
+                )
+            )
+        else:
+            table = gcp_table.GcpTable.load(self.gcp_table)
+            logging.info(
+                f"Adding GT_CONF_PERCENTLE to VCF files using mean depth {mean_depth}, variance depth {variance_depth}, error rate {self.read_error_rate}, "
+                f"and table {self.gcp_table}"
+            )
+        for f in [self.unfiltered_vcf_file, self.final_vcf]:
+            adjudicator.Adjudicator._add_gt_conf_percentile_and_filters_to_vcf_file(
+                f,
+                mean_depth,
+                variance_depth,
+                self.read_error_rate,
+                self.genotype_simulation_iterations,
+                min_dp=self.filter_min_dp,
+                min_gcp=self.filter_min_gcp,
+                ploidy=self.ploidy,
+                cache_dir=self.cache_dir,
+                threads=self.threads,
+                tolerance=self.simulation_tolerance,
+                quantiles=self.simulation_quantiles,
+                max_iterations=self.max_simulation_iterations,
+                table=table,
+                exact=self.exact_gcp,
+            )
+        logging.info("All done! Output written to " + self.final_vcf)
@@ -1,11 +1,14 @@
 __all__ = [
     "adjudicate",
+    "build_gcp_table",
     "check_with_ref",
     "check_snps",
     "check_recall",
     "cluster_vcfs",
+    "genotype_samples",
     "make_split_gramtools_build",
     "multi_sample_pipeline",
+    "regenotype",
     "versions",
 ]
 
@@ -19,7 +19,19 @@ def run(options):
         clean=not options.debug,
         gramtools_kmer_size=options.gramtools_kmer_size,
         use_unmapped_reads=options.use_unmapped_reads,
+        save_genotyping_inputs=options.save_genotyping_inputs,
         filter_min_dp=options.filter_min_dp,
         filter_min_gcp=options.filter_min_gcp,
+        prune_het_pairs=options.prune_het_pairs,
+        ploidy=options.ploidy,
+        slow_sites=options.slow_sites,
+        cache_dir=options.cache_dir,
+        threads=options.threads,
+        simulation_tolerance=options.simulation_tolerance,
+        simulation_quantiles=options.simulation_quantiles,
+        max_simulation_iterations=options.max_simulation_iterations,
+        gcp_table=options.gcp_table,
+        exact_gcp=options.exact_gcp,
+        stream_gramtools_output=options.stream_gramtools_output,
     )
     adj.run()
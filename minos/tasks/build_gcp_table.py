@@ -0,0 +1,14 @@
+from minos import gcp_table
+
+
+def run(options):
+    table = gcp_table.GcpTable.build(
+        mean_depths=options.mean_depths,
+        variance_ratios=options.variance_ratios,
+        error_rates=options.error_rates,
+        iterations=options.iterations,
+        ploidy=options.ploidy,
+        threads=options.threads,
+        exact=options.exact,
+    )
+    table.save(options.outfile)
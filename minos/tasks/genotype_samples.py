@@ -0,0 +1,56 @@
+import logging
+import os
+import shutil
+
+from minos import multi_sample_genotyper
+
+
+def run(options):
+    if options.sample_names is None:
+        sample_names = [
+            os.path.basename(os.path.normpath(x)) for x in options.quasimap_dirs
+        ]
+    else:
+        sample_names = options.sample_names.split(",")
+    if len(sample_names) != len(options.quasimap_dirs):
+        raise Exception(
+            f"Number of sample names ({len(sample_names)}) does not match number of quasimap directories ({len(options.quasimap_dirs)})"
+        )
+
+    if os.path.exists(options.outdir):
+        if options.force:
+            shutil.rmtree(options.outdir)
+        else:
+            raise Exception(
+                f"Output directory {options.outdir} already exists. "
+                f"Rerun command with --force flag if you are OK with overwriting it"
+            )
+    os.mkdir(options.outdir)
+
+    genotyper = multi_sample_genotyper.MultiSampleGenotyper.from_quasimap_dirs(
+        options.vcf_file,
+        options.quasimap_dirs,
+        sample_names,
+        options.read_error_rate,
+        ploidy=options.ploidy,
+    )
+    if options.per_sample_vcfs:
+        sample_vcfs = [
+            os.path.join(options.outdir, f"{i}.debug.calls_with_zero_cov_alleles.vcf")
+            for i in range(len(sample_names))
+        ]
+        filtered_sample_vcfs = [
+            os.path.join(options.outdir, f"{i}.final.vcf")
+            for i in range(len(sample_names))
+        ]
+    else:
+        sample_vcfs = filtered_sample_vcfs = None
+
+    cohort_vcf = os.path.join(options.outdir, "cohort.vcf")
+    logging.info(f"Genotyping {len(sample_names)} samples")
+    genotyper.run(
+        cohort_vcf=cohort_vcf,
+        sample_vcfs=sample_vcfs,
+        filtered_sample_vcfs=filtered_sample_vcfs,
+    )
+    logging.info("All done! Output written to " + cohort_vcf)
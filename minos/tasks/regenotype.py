@@ -0,0 +1,22 @@
+from minos import regenotyper
+
+
+def run(options):
+    regenotyper.Regenotyper(
+        options.adjudicate_dir,
+        options.outdir,
+        read_error_rate=options.read_error_rate,
+        ploidy=options.ploidy,
+        overwrite_outdir=options.force,
+        genotype_simulation_iterations=options.genotype_simulation_iterations,
+        filter_min_dp=options.filter_min_dp,
+        filter_min_gcp=options.filter_min_gcp,
+        prune_het_pairs=options.prune_het_pairs,
+        cache_dir=options.cache_dir,
+        threads=options.threads,
+        simulation_tolerance=options.simulation_tolerance,
+        simulation_quantiles=options.simulation_quantiles,
+        max_simulation_iterations=options.max_simulation_iterations,
+        gcp_table=options.gcp_table,
+        exact_gcp=options.exact_gcp,
+    ).run()
@@ -7,7 +7,7 @@ import pickle
 
 import cluster_vcf_records
 
-from minos import gramtools
+from minos import gramtools, vcf_writer
 
 
 split_file_attributes = [
@@ -25,7 +25,7 @@ split_file_attributes = [
 SplitFile = namedtuple("SplitFile", split_file_attributes)
 
 
-def _run_gramtools_build(split_file, ref_fasta, max_read_length, kmer_size):
+def _run_gramtools_build(split_file, ref_fasta, max_read_length, kmer_size, cache_dir):
     logging.info("Start gramtools build " + split_file.filename)
     gramtools.run_gramtools_build(
         split_file.gramtools_build_dir,
@@ -33,6 +33,7 @@ def _run_gramtools_build(split_file, ref_fasta, max_read_length, kmer_size):
         ref_fasta,
         max_read_length,
         kmer_size,
+        cache_dir=cache_dir,
     )
     logging.info("Finish gramtools build " + split_file.filename)
 
@@ -50,10 +51,14 @@ class VcfChunker:
         gramtools_kmer_size=10,
         alleles_per_split=None,
         threads=1,
+        cache_dir=None,
     ):
         self.outdir = os.path.abspath(outdir)
         self.metadata_pickle = os.path.join(self.outdir, "data.pickle")
         self.threads = threads
+        # If not None, gramtools builds are cached here (see
+        # gramtools.run_gramtools_build())
+        self.cache_dir = cache_dir
 
         if os.path.exists(self.outdir):
             self._load_existing_data()
@@ -273,6 +278,7 @@ class VcfChunker:
                         self.ref_fasta,
                         self.max_read_length,
                         self.gramtools_kmer_size,
+                        cache_dir=self.cache_dir,
                     )
         else:
             assert self.threads > 1
@@ -288,6 +294,7 @@ class VcfChunker:
                     itertools.repeat(self.ref_fasta),
                     itertools.repeat(self.max_read_length),
                     itertools.repeat(self.gramtools_kmer_size),
+                    itertools.repeat(self.cache_dir),
                 ),
             )
             pool.close()
@@ -305,7 +312,7 @@ class VcfChunker:
         printed_header_lines = False
         logging.info("Making merged VCF file " + outfile)
 
-        with open(outfile, "w") as f:
+        with vcf_writer.VcfWriter(outfile) as writer:
             for ref_name in self.vcf_split_files:
                 assert ref_name in files_to_merge
                 assert len(self.vcf_split_files[ref_name]) == len(
@@ -316,7 +323,7 @@ class VcfChunker:
                         files_to_merge[ref_name][i]
                     )
                     if not printed_header_lines:
-                        print(*header_lines, sep="\n", file=f)
+                        writer.write_header(header_lines)
                         printed_header_lines = True
                     start_i = split_file.use_start_index - split_file.file_start_index
                     end_i = (
@@ -324,7 +331,7 @@ class VcfChunker:
                     )
                     for j in range(start_i, end_i + 1, 1):
                         total_output_records += 1
-                        print(records_to_merge[j], file=f)
+                        writer.write(records_to_merge[j])
 
         if self.total_input_records != total_output_records:
             raise Exception(
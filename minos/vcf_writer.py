@@ -0,0 +1,62 @@
+# Default number of lines kept in memory before writing them to the file
+DEFAULT_BUFFER_LINES = 10000
+
+
+class VcfWriter:
+    """Writes VCF lines to outfile, and optionally also to filtered_outfile.
+    Lines are kept in memory and written in one go every buffer_lines
+    lines, which is much faster than calling print() once per line.
+    Use as a context manager, so that the remaining lines are written and
+    the files closed at the end:
+        with VcfWriter("out.vcf", filtered_outfile="filtered.vcf") as writer:
+            writer.write_header(header_lines)
+            writer.write(record, filtered_record)"""
+
+    def __init__(
+        self, outfile, filtered_outfile=None, buffer_lines=DEFAULT_BUFFER_LINES
+    ):
+        self.buffer_lines = buffer_lines
+        self.f = open(outfile, "w")
+        self.f_filter = (
+            None if filtered_outfile is None else open(filtered_outfile, "w")
+        )
+        self.lines = []
+        self.filtered_lines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            self.f.write("\n".join(self.lines) + "\n")
+            self.lines.clear()
+        if len(self.filtered_lines) > 0:
+            self.f_filter.write("\n".join(self.filtered_lines) + "\n")
+            self.filtered_lines.clear()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.f_filter is not None:
+            self.f_filter.close()
+
+    def write_header(self, header_lines):
+        """Writes the header lines to both files"""
+        for line in header_lines:
+            self.write(line)
+
+    def write(self, line, filtered_line=None):
+        """Adds line (a string or VcfRecord) to the output file, and
+        filtered_line to the filtered file. If filtered_line is None, then
+        line is also used for the filtered file"""
+        line = str(line)
+        self.lines.append(line)
+        if self.f_filter is not None:
+            self.filtered_lines.append(
+                line if filtered_line is None else str(filtered_line)
+            )
+        if len(self.lines) >= self.buffer_lines:
+            self.flush()
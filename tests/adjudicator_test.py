@@ -3,7 +3,9 @@ import shutil
 import os
 import unittest
 
-from minos import adjudicator
+from cluster_vcf_records import vcf_file_read
+
+from minos import adjudicator, gcp_table
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "adjudicator")
@@ -47,12 +49,14 @@ class TestAdjudicator(unittest.TestCase):
             clean=False,
             gramtools_kmer_size=5,
             genotype_simulation_iterations=1000,
+            save_genotyping_inputs=True,
         )
         adj.run()
         self.assertTrue(os.path.exists(outdir))
         self.assertTrue(os.path.exists(adj.log_file))
         self.assertTrue(os.path.exists(adj.final_vcf))
         self.assertTrue(os.path.exists(adj.clustered_vcf))
+        self.assertTrue(os.path.exists(adj.genotyping_inputs_file))
 
         # Clean up and then run without splitting
         shutil.rmtree(outdir)
@@ -76,6 +80,11 @@ class TestAdjudicator(unittest.TestCase):
         self.assertTrue(os.path.exists(adj.plots_prefix + ".dp_hist.pdf"))
         self.assertTrue(os.path.exists(adj.plots_prefix + ".gt_conf_dp_scatter.pdf"))
         self.assertTrue(os.path.exists(adj.plots_prefix + ".gt_conf_hist.pdf"))
+        # Genotyping inputs are only saved if asked for
+        self.assertIsNone(adj.genotyping_inputs_file)
+        self.assertFalse(
+            os.path.exists(os.path.join(outdir, "genotyping_inputs.jsonl"))
+        )
 
         # Now we've run the adjudicator, we have a gramtools
         # build directory. Rerun, but this time use the build
@@ -196,6 +205,81 @@ class TestAdjudicator(unittest.TestCase):
         self.assertTrue(filecmp.cmp(tmp_file, expect_file, shallow=False))
         os.unlink(tmp_file)
 
+        # Using a cache of the simulations should give the same output, when
+        # the simulations are run, and when they are loaded from the cache
+        tmp_cache_dir = "tmp.adjudicator.add_gt_conf_percentile_to_vcf_file.cache"
+        if os.path.exists(tmp_cache_dir):
+            shutil.rmtree(tmp_cache_dir)
+        for i in range(2):
+            shutil.copyfile(original_file, tmp_file)
+            adjudicator.Adjudicator._add_gt_conf_percentile_and_filters_to_vcf_file(
+                tmp_file,
+                60,
+                100,
+                error_rate,
+                iterations=1000,
+                min_dp=2,
+                min_gcp=2.5,
+                cache_dir=tmp_cache_dir,
+            )
+            self.assertTrue(filecmp.cmp(tmp_file, expect_file, shallow=False))
+            os.unlink(tmp_file)
+        shutil.rmtree(tmp_cache_dir)
+
+        # Adaptive simulations should add the iterations used and the
+        # convergence to the header
+        shutil.copyfile(original_file, tmp_file)
+        adjudicator.Adjudicator._add_gt_conf_percentile_and_filters_to_vcf_file(
+            tmp_file,
+            60,
+            100,
+            error_rate,
+            iterations=1000,
+            min_dp=2,
+            min_gcp=2.5,
+            tolerance=100,
+            quantiles=[25, 75],
+        )
+        got_header, got_records = vcf_file_read.vcf_file_to_list(tmp_file)
+        self.assertIn("##minos_gt_conf_simulation_iterations=2000", got_header)
+        convergence = [
+            x
+            for x in got_header
+            if x.startswith(
+                "##minos_gt_conf_simulation_convergence=<Tolerance=100,Quantiles=25;75,Error="
+            )
+        ]
+        self.assertEqual(1, len(convergence))
+        _, expect_records = vcf_file_read.vcf_file_to_list(expect_file)
+        self.assertEqual(len(expect_records), len(got_records))
+        os.unlink(tmp_file)
+
+        # Using a table made at the same depth and error rate should give
+        # the same output as running the simulations
+        table = gcp_table.GcpTable.build(
+            mean_depths=[60, 70],
+            variance_ratios=[100 / 60, 2],
+            error_rates=[error_rate, 0.01],
+            iterations=1000,
+        )
+        shutil.copyfile(original_file, tmp_file)
+        adjudicator.Adjudicator._add_gt_conf_percentile_and_filters_to_vcf_file(
+            tmp_file,
+            60,
+            100,
+            error_rate,
+            iterations=1000,
+            min_dp=2,
+            min_gcp=2.5,
+            table=table,
+        )
+        self.assertTrue(filecmp.cmp(tmp_file, expect_file, shallow=False))
+        with self.assertRaises(Exception):
+            adjudicator.Adjudicator._add_gt_conf_percentile_and_filters_to_vcf_file(
+                tmp_file, 60, 100, error_rate, iterations=1000, ploidy=1, table=table
+            )
+        os.unlink(tmp_file)
+
     def test_0MeanDepth_stillRuns(self):
         """
         When mean depth is 0, we can get math errors: math.log(0) in genotype likelihood computation,
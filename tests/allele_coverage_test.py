@@ -0,0 +1,52 @@
+import unittest
+
+from minos import allele_coverage
+
+
+class TestAlleleCoverage(unittest.TestCase):
+    def test_from_lists(self):
+        """test from_lists"""
+        site_counts = [{"1": 3, "2": 1}, {}, {"3": 2}]
+        allele_base_counts = [[[1, 2], [0, 0, 1]], [[0]], [[], [4, 0], [5]]]
+        cov = allele_coverage.AlleleCoverage.from_lists(site_counts, allele_base_counts)
+        self.assertEqual(3, len(cov))
+        self.assertEqual([2, 1, 3], cov.number_of_alleles().tolist())
+        self.assertEqual([0, 2, 3, 6], cov.site_offsets.tolist())
+        self.assertEqual([0, 2, 5, 6, 6, 8, 9], cov.allele_offsets.tolist())
+        self.assertEqual([1, 2, 0, 0, 1, 0, 4, 0, 5], cov.base_counts.tolist())
+        self.assertEqual([4, 0, 2], cov.total_coverages())
+        expect = list(zip(site_counts, allele_base_counts))
+        self.assertEqual(expect, list(cov))
+        self.assertEqual(expect[2], cov[2])
+
+        # allele_base_counts can be an iterator, eg reading the json file
+        # one site at a time
+        cov = allele_coverage.AlleleCoverage.from_lists(
+            site_counts, iter(allele_base_counts)
+        )
+        self.assertEqual(expect, list(cov))
+
+        with self.assertRaises(Exception):
+            allele_coverage.AlleleCoverage.from_lists(site_counts, [[[1]]])
+
+    def test_from_all_allele_coverage(self):
+        """test from_all_allele_coverage"""
+        all_allele_coverage = [({"1": 1}, [[1], [0, 1]]), ({"2": 2}, [[2, 2]])]
+        cov = allele_coverage.AlleleCoverage.from_all_allele_coverage(
+            all_allele_coverage
+        )
+        self.assertEqual(all_allele_coverage, list(cov))
+        self.assertIs(cov, allele_coverage.AlleleCoverage.from_all_allele_coverage(cov))
+
+    def test_allele_lengths_and_non_zeros(self):
+        """test allele_lengths and allele_non_zeros"""
+        cov = allele_coverage.AlleleCoverage.from_lists(
+            [{}, {}], [[[1, 2], [0, 0, 1]], [[], [4, 0, 2], [5]]]
+        )
+        lengths = cov.allele_lengths()
+        self.assertEqual([2, 3, 0, 3, 1], lengths.tolist())
+        self.assertEqual([[2, 3], [0, 3, 1]], cov.site_slices(lengths))
+        self.assertEqual([2, 1, 0, 2, 1], cov.allele_non_zeros(1).tolist())
+        self.assertEqual([1, 0, 0, 2, 1], cov.allele_non_zeros(2).tolist())
+        self.assertEqual([0, 0, 0, 1, 1], cov.allele_non_zeros(4).tolist())
+        self.assertEqual([[0, 0], [0, 0, 1]], cov.site_slices(cov.allele_non_zeros(5)))
@@ -0,0 +1,118 @@
+import os
+import shutil
+import time
+import unittest
+
+from minos import disk_cache
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_cache_dir_from_options(self):
+        """test cache_dir_from_options"""
+        original = os.environ.pop(disk_cache.CACHE_DIR_ENV_VARIABLE, None)
+        self.assertIsNone(disk_cache.cache_dir_from_options(None))
+        self.assertEqual("dir", disk_cache.cache_dir_from_options("dir"))
+        os.environ[disk_cache.CACHE_DIR_ENV_VARIABLE] = "env_dir"
+        self.assertEqual("env_dir", disk_cache.cache_dir_from_options(None))
+        self.assertEqual("dir", disk_cache.cache_dir_from_options("dir"))
+        if original is None:
+            del os.environ[disk_cache.CACHE_DIR_ENV_VARIABLE]
+        else:
+            os.environ[disk_cache.CACHE_DIR_ENV_VARIABLE] = original
+
+    def test_key(self):
+        """test key"""
+        key = disk_cache.DiskCache.key("a", 1, 0.5)
+        self.assertEqual(64, len(key))
+        self.assertEqual(key, disk_cache.DiskCache.key("a", 1, 0.5))
+        self.assertNotEqual(key, disk_cache.DiskCache.key("a", 1, 0.25))
+
+    def test_get_put_and_evict(self):
+        """test get, put and evict"""
+        tmp_dir = "tmp.disk_cache.get_put_and_evict"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        cache = disk_cache.DiskCache(tmp_dir, max_bytes=10)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"1234")
+        cache.put("b", b"5678")
+        self.assertEqual(b"1234", cache.get("a"))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(8, cache.total_bytes())
+
+        # Make "b" the least recently used, so it is removed when the
+        # cache gets too big
+        old_time = time.time() - 100
+        os.utime(cache.path("b"), (old_time, old_time))
+        cache.put("c", b"90")
+        self.assertEqual(10, cache.total_bytes())
+        cache.put("d", b"12")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(b"1234", cache.get("a"))
+        self.assertEqual(b"12", cache.get("d"))
+        self.assertEqual([], [x for x in os.listdir(tmp_dir) if x.startswith(".tmp")])
+        shutil.rmtree(tmp_dir)
+
+    def test_file_sha256(self):
+        """test file_sha256"""
+        tmp_file = "tmp.disk_cache.file_sha256"
+        with open(tmp_file, "wb") as f:
+            f.write(b"abc")
+        self.assertEqual(
+            "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad",
+            disk_cache.file_sha256(tmp_file),
+        )
+        os.unlink(tmp_file)
+
+    def test_directory_cache(self):
+        """test DirectoryCache"""
+        tmp_dir = "tmp.disk_cache.directory_cache"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        cache = disk_cache.DirectoryCache(os.path.join(tmp_dir, "cache"), max_bytes=10)
+
+        def make_dir(dirname, contents):
+            dirname = os.path.join(tmp_dir, dirname)
+            os.makedirs(os.path.join(dirname, "subdir"))
+            with open(os.path.join(dirname, "subdir", "file"), "wb") as f:
+                f.write(contents)
+            return dirname
+
+        def read_dir(dirname):
+            with open(os.path.join(dirname, "subdir", "file"), "rb") as f:
+                return f.read()
+
+        out_dir = os.path.join(tmp_dir, "out")
+        self.assertFalse(cache.get("a", out_dir))
+        self.assertFalse(os.path.exists(out_dir))
+        cache.put("a", make_dir("a", b"1234"))
+        cache.put("b", make_dir("b", b"5678"))
+        # Adding the same key again does nothing
+        cache.put("b", make_dir("b2", b"0000"))
+        self.assertEqual(8, cache.total_bytes())
+        self.assertTrue(cache.get("b", out_dir))
+        self.assertEqual(b"5678", read_dir(out_dir))
+        shutil.rmtree(out_dir)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+        # Make "a" the least recently used, so it is removed when the
+        # cache gets too big
+        old_time = time.time() - 100
+        os.utime(cache.path("a"), (old_time, old_time))
+        cache.put("c", make_dir("c", b"90"))
+        self.assertEqual(10, cache.total_bytes())
+        cache.put("d", make_dir("d", b"12"))
+        self.assertFalse(cache.get("a", out_dir))
+        self.assertTrue(cache.get("d", out_dir))
+        self.assertEqual(b"12", read_dir(out_dir))
+        shutil.rmtree(out_dir)
+        cache.remove("d")
+        cache.remove("d")
+        self.assertFalse(cache.get("d", out_dir))
+        self.assertEqual(
+            [], [x for x in os.listdir(cache.cache_dir) if x.startswith(".tmp")]
+        )
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,114 @@
+import os
+import unittest
+
+import numpy as np
+
+from minos import gcp_table, genotype_confidence_simulator
+
+
+class TestGcpTable(unittest.TestCase):
+    def test_interpolated_percentiles(self):
+        """test InterpolatedPercentiles"""
+        percentiles = gcp_table.InterpolatedPercentiles(
+            np.array([0.0, 10.0, 10.0, 50.0, 100.0])
+        )
+        self.assertEqual(
+            [0.0, 10.0, 10.0, 30.0, 50.0, 62.5, 100.0, 100.0],
+            percentiles.get_percentiles([0, 1, 2, 2.5, 3, 3.25, 4, 5]).tolist(),
+        )
+        self.assertEqual(30.0, percentiles.get_percentile(2.5))
+
+    def test_axis_weights(self):
+        """test _axis_weights"""
+        grid = np.array([1.0, 2.0, 4.0])
+        self.assertEqual((0, 0, 0.0), gcp_table.GcpTable._axis_weights(grid, 1, "x"))
+        self.assertEqual((0, 0, 0.0), gcp_table.GcpTable._axis_weights(grid, 0, "x"))
+        self.assertEqual((0, 1, 0.5), gcp_table.GcpTable._axis_weights(grid, 1.5, "x"))
+        self.assertEqual((1, 2, 0.0), gcp_table.GcpTable._axis_weights(grid, 2, "x"))
+        self.assertEqual((1, 2, 0.25), gcp_table.GcpTable._axis_weights(grid, 2.5, "x"))
+        self.assertEqual((2, 2, 0.0), gcp_table.GcpTable._axis_weights(grid, 4, "x"))
+        self.assertEqual((2, 2, 0.0), gcp_table.GcpTable._axis_weights(grid, 5, "x"))
+
+    def test_build_save_load_and_interpolate(self):
+        """test build, save, load, interpolate"""
+        with self.assertRaises(Exception):
+            gcp_table.GcpTable.build(
+                mean_depths=[20], variance_ratios=[1], error_rates=[0.01]
+            )
+        with self.assertRaises(Exception):
+            gcp_table.GcpTable.build(
+                mean_depths=[40, 20], variance_ratios=[2], error_rates=[0.01]
+            )
+
+        mean_depths = [20, 40]
+        variance_ratios = [2, 3]
+        error_rates = [0.001, 0.01]
+        table = gcp_table.GcpTable.build(
+            mean_depths=mean_depths,
+            variance_ratios=variance_ratios,
+            error_rates=error_rates,
+            iterations=500,
+            ploidy=1,
+        )
+        tmp_file = "tmp.gcp_table.build_save_load_and_interpolate.npz"
+        table.save(tmp_file)
+        loaded = gcp_table.GcpTable.load(tmp_file)
+        os.unlink(tmp_file)
+        self.assertEqual(1, loaded.ploidy)
+        self.assertEqual(500, loaded.iterations)
+        self.assertEqual(mean_depths, loaded.mean_depths.tolist())
+        self.assertEqual(variance_ratios, loaded.variance_ratios.tolist())
+        self.assertEqual(error_rates, loaded.error_rates.tolist())
+        self.assertTrue(np.array_equal(table.percentiles, loaded.percentiles))
+
+        # At grid points, should get the same as running the simulations
+        confidences = list(range(table.percentiles.shape[3] + 5))
+        for mean_depth in mean_depths:
+            for ratio in variance_ratios:
+                for error_rate in error_rates:
+                    simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+                        mean_depth,
+                        mean_depth * ratio,
+                        error_rate,
+                        iterations=500,
+                        ploidy=1,
+                    )
+                    simulator.run_simulations()
+                    got = loaded.interpolate(mean_depth, mean_depth * ratio, error_rate)
+                    self.assertEqual(
+                        simulator.get_percentiles(confidences).tolist(),
+                        got.get_percentiles(confidences).tolist(),
+                    )
+
+        # Between grid points, percentiles should be between those of the
+        # nearest grid points
+        low = loaded.interpolate(20, 40, 0.001).get_percentiles(confidences)
+        high = loaded.interpolate(40, 80, 0.001).get_percentiles(confidences)
+        middle = loaded.interpolate(30, 60, 0.001).get_percentiles(confidences)
+        self.assertTrue(np.all(np.minimum(low, high) <= middle))
+        self.assertTrue(np.all(middle <= np.maximum(low, high)))
+        self.assertFalse(np.array_equal(low, middle))
+
+        # Using exact distributions, should get the same as the simulator
+        # with exact=True
+        table = gcp_table.GcpTable.build(
+            mean_depths=mean_depths,
+            variance_ratios=variance_ratios,
+            error_rates=error_rates,
+            exact=True,
+        )
+        self.assertEqual(0, table.iterations)
+        simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            40, 120, 0.01, exact=True
+        )
+        simulator.run_simulations()
+        self.assertEqual(
+            simulator.get_percentiles(confidences).tolist(),
+            table.interpolate(40, 120, 0.01).get_percentiles(confidences).tolist(),
+        )
+
+        # Outside the grid, the nearest grid point is used
+        self.assertEqual(
+            high.tolist(),
+            loaded.interpolate(100, 200, 0.001).get_percentiles(confidences).tolist(),
+        )
@@ -1,7 +1,10 @@
 import os
+import shutil
 import unittest
 
-from minos import genotype_confidence_simulator
+import numpy as np
+
+from minos import disk_cache, genotype_confidence_simulator, genotyper
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "genotype_confidence_simulator")
@@ -13,7 +16,7 @@ class TestGenotypeConfidenceSimulator(unittest.TestCase):
         got = genotype_confidence_simulator.GenotypeConfidenceSimulator._simulate_confidence_scores(
             50, 300, 0.1, iterations=5
         )
-        expected = [26, 31, 37, 46, 51]
+        expected = [14, 25, 28, 47, 55]
         self.assertEqual(expected, got)
 
         #  Since the genotype confidence normalises by length, we shpuld get the same
@@ -21,9 +24,55 @@ class TestGenotypeConfidenceSimulator(unittest.TestCase):
         got = genotype_confidence_simulator.GenotypeConfidenceSimulator._simulate_confidence_scores(
             50, 300, 0.1, iterations=5, allele_length=2
         )
-        expected = [26, 31, 37, 46, 51]
+        expected = [14, 25, 28, 47, 55]
         self.assertEqual(expected, got)
 
+    def test_simulate_confidence_scores_threads(self):
+        """test _simulate_confidence_scores gives same result with any number of threads"""
+        expected = genotype_confidence_simulator.GenotypeConfidenceSimulator._simulate_confidence_scores(
+            30, 60, 0.01, iterations=25000
+        )
+        self.assertEqual(25000, len(expected))
+        for threads in (2, 3):
+            got = genotype_confidence_simulator.GenotypeConfidenceSimulator._simulate_confidence_scores(
+                30, 60, 0.01, iterations=25000, threads=threads
+            )
+            self.assertEqual(expected, got)
+
+        got = genotype_confidence_simulator.GenotypeConfidenceSimulator._simulate_confidence_scores(
+            30, 60, 0.01, iterations=25000, seed=43
+        )
+        self.assertNotEqual(expected, got)
+
+    def test_confidence_scores(self):
+        """test _confidence_scores"""
+        incorrect_coverage = [0, 1, 5, 0, 3, 20, 2]
+        correct_coverage = [1, 40, 50, 25, 0, 22, 2]
+        for ploidy in (1, 2):
+            model = genotyper.GenotypingModel(50, 0.1, ploidy=ploidy)
+            expected = []
+            for incorrect, correct in zip(incorrect_coverage, correct_coverage):
+                allele_combination_cov = {}
+                if incorrect > 0:
+                    allele_combination_cov["1"] = incorrect
+                if correct > 0:
+                    allele_combination_cov["2"] = correct
+                gtyper = genotyper.Genotyper(
+                    50,
+                    0.1,
+                    allele_combination_cov,
+                    [[incorrect] * 2, [correct] * 2],
+                    {"1": {0}, "2": {1}},
+                    model=model,
+                )
+                gtyper.run()
+                expected.append(round(gtyper.genotype_confidence))
+
+            got = genotype_confidence_simulator.GenotypeConfidenceSimulator._confidence_scores(
+                model, incorrect_coverage, correct_coverage, allele_length=2
+            )
+            self.assertEqual(expected, got)
+
     def test_make_conf_to_percentile_dict(self):
         """test _make_conf_to_percentile_dict"""
         confidence_scores = [1, 1, 2, 3, 4, 4, 4, 5, 6, 8]
@@ -40,27 +89,27 @@ class TestGenotypeConfidenceSimulator(unittest.TestCase):
         )
         simulator.run_simulations()
         expected_confidence_scores_percentiles = {
-            26: 20.0,
-            31: 40.0,
-            37: 60.0,
-            46: 80.0,
-            51: 100.0,
+            14: 20.0,
+            25: 40.0,
+            28: 60.0,
+            47: 80.0,
+            55: 100.0,
         }
         self.assertEqual(
             expected_confidence_scores_percentiles,
             simulator.confidence_scores_percentiles,
         )
-        self.assertEqual(20.00, simulator.get_percentile(26))
-        self.assertEqual(40.00, simulator.get_percentile(31))
+        self.assertEqual(20.00, simulator.get_percentile(14))
+        self.assertEqual(40.00, simulator.get_percentile(25))
         # Try getting numbers that are not in the dict and will have to be inferred
-        self.assertEqual(28.00, simulator.get_percentile(28))
-        self.assertEqual(84.00, simulator.get_percentile(47))
-        self.assertEqual(88.00, simulator.get_percentile(48))
+        self.assertEqual(23.64, simulator.get_percentile(16))
+        self.assertEqual(62.11, simulator.get_percentile(30))
+        self.assertEqual(72.63, simulator.get_percentile(40))
         # Try values outside the range of what we already have
-        self.assertEqual(0.00, simulator.get_percentile(25))
-        self.assertEqual(0.00, simulator.get_percentile(24))
-        self.assertEqual(100.00, simulator.get_percentile(51))
-        self.assertEqual(100.00, simulator.get_percentile(52))
+        self.assertEqual(0.00, simulator.get_percentile(13))
+        self.assertEqual(0.00, simulator.get_percentile(12))
+        self.assertEqual(100.00, simulator.get_percentile(55))
+        self.assertEqual(100.00, simulator.get_percentile(56))
 
     def test_run_simulations_and_get_percentile_allele_length_2(self):
         """test run_simulations and get_percentile"""
@@ -69,45 +118,186 @@ class TestGenotypeConfidenceSimulator(unittest.TestCase):
         )
         simulator.run_simulations()
         expected_confidence_scores_percentiles = {
-            26: 20.0,
-            31: 40.0,
-            37: 60.0,
-            46: 80.0,
-            51: 100.0,
+            14: 20.0,
+            25: 40.0,
+            28: 60.0,
+            47: 80.0,
+            55: 100.0,
         }
         self.assertEqual(
             expected_confidence_scores_percentiles,
             simulator.confidence_scores_percentiles,
         )
-        self.assertEqual(20.00, simulator.get_percentile(26))
-        self.assertEqual(40.00, simulator.get_percentile(31))
+        self.assertEqual(20.00, simulator.get_percentile(14))
+        self.assertEqual(40.00, simulator.get_percentile(25))
         # Try getting numbers that are not in the dict and will have to be inferred
-        self.assertEqual(28.00, simulator.get_percentile(28))
-        self.assertEqual(84.00, simulator.get_percentile(47))
-        self.assertEqual(88.00, simulator.get_percentile(48))
+        self.assertEqual(23.64, simulator.get_percentile(16))
+        self.assertEqual(62.11, simulator.get_percentile(30))
+        self.assertEqual(72.63, simulator.get_percentile(40))
         # Try values outside the range of what we already have
-        self.assertEqual(0.00, simulator.get_percentile(25))
-        self.assertEqual(0.00, simulator.get_percentile(24))
-        self.assertEqual(100.00, simulator.get_percentile(51))
-        self.assertEqual(100.00, simulator.get_percentile(52))
-
-    def test_simulations(self):
-        """test simulations"""
-        mean_depth = 50
-        error_rate = 0.1
-        depth_variance = 300
-        allele_lengths = [1, 2, 10]
-        simulations = genotype_confidence_simulator.Simulations(
-            mean_depth, depth_variance, error_rate, allele_lengths=allele_lengths
-        )
-        self.assertEqual(allele_lengths, sorted(list(simulations.sims.keys())))
-        self.assertEqual(
-            simulations.sims[1].get_percentile(40), simulations.get_percentile(1, 40)
+        self.assertEqual(0.00, simulator.get_percentile(13))
+        self.assertEqual(0.00, simulator.get_percentile(12))
+        self.assertEqual(100.00, simulator.get_percentile(55))
+        self.assertEqual(100.00, simulator.get_percentile(56))
+
+    def test_get_percentiles(self):
+        """test get_percentiles"""
+        simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=5
         )
-        self.assertEqual(
-            simulations.sims[2].get_percentile(40), simulations.get_percentile(2, 40)
+        simulator.confidence_scores_percentiles = {
+            10: 20.0,
+            12: 40.0,
+            15: 60.0,
+            16: 60.0,
+            20: 80.0,
+            23: 100.0,
+        }
+        confidences = [9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 22, 23, 24]
+        expected = [0, 20, 30, 40, 46.67, 53.33, 60, 60, 65, 70, 75, 93.33, 100, 100]
+        self.assertEqual(expected, simulator.get_percentiles(confidences).tolist())
+        self.assertEqual(expected, [simulator.get_percentile(x) for x in confidences])
+        self.assertEqual([], simulator.get_percentiles([]).tolist())
+
+    def test_run_simulations_with_cache(self):
+        """test run_simulations with a cache"""
+        tmp_dir = "tmp.genotype_confidence_simulator.run_simulations_with_cache"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        cache = disk_cache.DiskCache(tmp_dir)
+        expected = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=100
+        )
+        expected.run_simulations()
+        for i in range(2):
+            simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+                50, 300, 0.1, iterations=100, cache=cache
+            )
+            simulator.run_simulations()
+            self.assertEqual(
+                expected.confidence_scores_percentiles,
+                simulator.confidence_scores_percentiles,
+            )
+            self.assertEqual(i, cache.hits)
+
+        # Different parameters should not use the cached scores
+        simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=100, cache=cache, ploidy=1
+        )
+        simulator.run_simulations()
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, len(os.listdir(tmp_dir)))
+        shutil.rmtree(tmp_dir)
+
+    def test_run_simulations_adaptive(self):
+        """test run_simulations in adaptive mode"""
+        # A big tolerance means stopping after the second batch
+        simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=1000, tolerance=100
+        )
+        simulator.run_simulations()
+        self.assertEqual(2000, simulator.iterations_used)
+        self.assertLess(simulator.convergence_error, 100)
+
+        # Zero tolerance means running until max_iterations
+        simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=1000, tolerance=0, max_iterations=4500
+        )
+        simulator.run_simulations()
+        self.assertEqual(4500, simulator.iterations_used)
+        self.assertGreaterEqual(simulator.convergence_error, 0)
+
+        # The first batch is the same as not using adaptive mode
+        expected = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=1000
+        )
+        expected.run_simulations()
+        simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            50, 300, 0.1, iterations=1000, tolerance=0, max_iterations=1000
         )
-        # Check we get nearest allele length, when asking for an allele length that wasn't simulated
+        simulator.run_simulations()
+        self.assertEqual(1000, simulator.iterations_used)
+        self.assertEqual(None, simulator.convergence_error)
         self.assertEqual(
-            simulations.sims[2].get_percentile(40), simulations.get_percentile(3, 40)
+            expected.confidence_scores_percentiles,
+            simulator.confidence_scores_percentiles,
+        )
+
+        # Results should not depend on the number of threads, or on whether
+        # the scores came from the cache. Quantiles given as ints or floats
+        # should use the same cache entry
+        tmp_dir = "tmp.genotype_confidence_simulator.run_simulations_adaptive"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        cache = disk_cache.DiskCache(tmp_dir)
+        results = []
+        for threads, use_cache, quantiles in (
+            (1, None, [10, 50, 90]),
+            (2, None, [10, 50, 90]),
+            (2, cache, [10, 50, 90]),
+            (1, cache, [10.0, 50.0, 90.0]),
+        ):
+            simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+                50,
+                300,
+                0.1,
+                iterations=15000,
+                tolerance=0.5,
+                quantiles=quantiles,
+                threads=threads,
+                cache=use_cache,
+            )
+            simulator.run_simulations()
+            results.append(
+                (
+                    simulator.iterations_used,
+                    simulator.convergence_error,
+                    simulator.confidence_scores_percentiles,
+                )
+            )
+        for result in results[1:]:
+            self.assertEqual(results[0], result)
+        self.assertEqual(1, cache.hits)
+        shutil.rmtree(tmp_dir)
+
+    def test_run_simulations_exact(self):
+        """test run_simulations with exact=True"""
+        for ploidy in 1, 2:
+            exact = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+                20, 40, 0.002, ploidy=ploidy, exact=True
+            )
+            exact.run_simulations()
+            percentiles = [
+                exact.confidence_scores_percentiles[x]
+                for x in sorted(exact.confidence_scores_percentiles)
+            ]
+            self.assertEqual(sorted(percentiles), percentiles)
+            self.assertTrue(0 <= percentiles[0] and percentiles[-1] <= 100)
+
+            # Should agree with lots of simulations, apart from the noise in
+            # the simulations
+            simulator = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+                20, 40, 0.002, ploidy=ploidy, iterations=100000
+            )
+            simulator.run_simulations()
+            confidences = sorted(simulator.confidence_scores_percentiles)
+            differences = np.abs(
+                exact.get_percentiles(confidences)
+                - simulator.get_percentiles(confidences)
+            )
+            self.assertLess(differences.max(), 0.5)
+
+        # A bigger tail mass ignores the rarest scores
+        rough = genotype_confidence_simulator.GenotypeConfidenceSimulator(
+            20, 40, 0.002, ploidy=2, exact=True, exact_tail_mass=0.01
+        )
+        rough.run_simulations()
+        self.assertLess(
+            len(rough.confidence_scores_percentiles),
+            len(exact.confidence_scores_percentiles),
+        )
+        self.assertTrue(
+            set(rough.confidence_scores_percentiles).issubset(
+                exact.confidence_scores_percentiles
+            )
         )
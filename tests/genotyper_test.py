@@ -1,3 +1,4 @@
+import math
 import os
 import unittest
 
@@ -25,6 +26,51 @@ class TestGenotyper(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             genotyper.Genotyper.get_min_cov_to_be_more_likely_than_error(10000, 0.5)
 
+    def test_genotyping_model(self):
+        """test GenotypingModel"""
+        model = genotyper.GenotypingModel(10, 0.001)
+        self.assertEqual(2, model.min_cov_more_than_error)
+        self.assertEqual(math.log(10), model.log_mean_depth)
+        self.assertEqual(math.log(5), model.log_half_mean_depth)
+        self.assertEqual(math.log(0.001), model.log_error_rate)
+        model = genotyper.GenotypingModel(10, 0.001, min_cov_more_than_error=3)
+        self.assertEqual(3, model.min_cov_more_than_error)
+        model = genotyper.GenotypingModel(0, 0.001)
+        self.assertEqual(0, model.min_cov_more_than_error)
+        self.assertIsNone(model.log_mean_depth)
+
+    def test_genotyping_model_lgamma_plus_one(self):
+        """test GenotypingModel lgamma_plus_one and lgamma_plus_one_array"""
+        model = genotyper.GenotypingModel(10, 0.001)
+        self.assertEqual(1, len(model.lgamma_table))
+        self.assertEqual(math.lgamma(101), model.lgamma_plus_one(100))
+        self.assertGreaterEqual(len(model.lgamma_table), 101)
+        self.assertEqual(math.lgamma(3.5), model.lgamma_plus_one(2.5))
+        got = model.lgamma_plus_one_array([0, 2.5, 1000, 3])
+        expected = [math.lgamma(x + 1) for x in [0, 2.5, 1000, 3]]
+        self.assertEqual(expected, got.tolist())
+        self.assertGreaterEqual(len(model.lgamma_table), 1001)
+
+    def test_genotyping_model_log_likelihoods(self):
+        """test GenotypingModel log_likelihood_homozygous and log_likelihood_heterozygous"""
+        model = genotyper.GenotypingModel(100, 0.01)
+        self.assertEqual(
+            genotyper.Genotyper._log_likelihood_homozygous(100, 90, 95, 0.01, 5, 5),
+            model.log_likelihood_homozygous(90, 95, 5, 5),
+        )
+        self.assertEqual(
+            genotyper.Genotyper._log_likelihood_heterozygous(
+                100, 45, 40, 95, 0.01, 3, 3, 2, 2
+            ),
+            model.log_likelihood_heterozygous(45, 40, 95, 3, 3, 2, 2),
+        )
+        self.assertEqual(
+            genotyper.Genotyper._log_likelihood_heterozygous(
+                100, 45.5, 40.5, 95, 0.01, 3, 4, 2, 2
+            ),
+            model.log_likelihood_heterozygous(45.5, 40.5, 95, 3, 4, 2, 2),
+        )
+
     def test_singleton_alleles_and_coverage(self):
         """test _singleton_alleles_and_coverage"""
         allele_combination_cov = {"1": 20, "3": 1}
@@ -82,6 +128,56 @@ class TestGenotyper(unittest.TestCase):
             ),
         )
 
+    def test_allele_groups_to_bitmasks(self):
+        """test allele_groups_to_bitmasks"""
+        allele_groups_dict = {"1": {0}, "2": {1}, "3": {1, 2}, "4": {0, 5, 6}}
+        expected = {"1": 1, "2": 2, "3": 6, "4": 97}
+        self.assertEqual(
+            expected, genotyper.Genotyper.allele_groups_to_bitmasks(allele_groups_dict)
+        )
+        self.assertEqual(
+            {"1": 1, "3": 6},
+            genotyper.Genotyper.allele_groups_to_bitmasks(
+                allele_groups_dict, keys=["1", "3"]
+            ),
+        )
+        self.assertEqual([0, 5, 6], genotyper.Genotyper._alleles_in_bitmask(97))
+
+    def test_coverages_from_masks(self):
+        """test _singleton_alleles_and_coverage_from_masks, _haploid_allele_coverages_from_masks, _shared_coverage_of_singleton_pairs"""
+        allele_combination_cov = {"1": 17, "2": 80, "3": 10, "4": 3, "5": 2}
+        allele_groups_dict = {
+            "1": {0},
+            "2": {1},
+            "3": {0, 1},
+            "4": {0, 2},
+            "5": {0, 1, 2},
+        }
+        masks = genotyper.Genotyper.allele_groups_to_bitmasks(allele_groups_dict)
+        singletons = genotyper.Genotyper._singleton_alleles_and_coverage_from_masks(
+            allele_combination_cov, masks
+        )
+        self.assertEqual(
+            genotyper.Genotyper._singleton_alleles_and_coverage(
+                allele_combination_cov, allele_groups_dict
+            ),
+            singletons,
+        )
+        self.assertEqual(
+            genotyper.Genotyper._haploid_allele_coverages(
+                3, allele_combination_cov, allele_groups_dict
+            ),
+            genotyper.Genotyper._haploid_allele_coverages_from_masks(
+                3, allele_combination_cov, masks
+            ),
+        )
+        self.assertEqual(
+            {(0, 1): 12},
+            genotyper.Genotyper._shared_coverage_of_singleton_pairs(
+                singletons, allele_combination_cov, masks
+            ),
+        )
+
     def test_log_likelihood_homozygous(self):
         """test _log_likelihood_homozygous"""
         self.assertEqual(
@@ -162,6 +258,253 @@ class TestGenotyper(unittest.TestCase):
             self.assertEqual(expected[i][0], gtyper.likelihoods[i][0])
             self.assertAlmostEqual(expected[i][1], gtyper.likelihoods[i][1], places=2)
 
+    def test_run_lean(self):
+        """test run with lean=True"""
+        mean_depth = 20
+        error_rate = 0.01
+        allele_combination_cov = {"1": 2, "2": 20, "3": 1}
+        allele_groups_dict = {"1": {0}, "2": {1}, "3": {0, 1}, "4": {2}}
+        allele_per_base_cov = [[0, 1], [20, 19]]
+        gtyper = genotyper.Genotyper(
+            mean_depth,
+            error_rate,
+            allele_combination_cov,
+            allele_per_base_cov,
+            allele_groups_dict,
+            lean=True,
+        )
+        expected = [({1}, -11.68), ({0, 1}, -22.92)]
+        gtyper.run()
+        self.assertEqual(len(expected), len(gtyper.likelihoods))
+        for i in range(len(expected)):
+            self.assertEqual(expected[i][0], gtyper.likelihoods[i][0])
+            self.assertAlmostEqual(expected[i][1], gtyper.likelihoods[i][1], places=2)
+        self.assertEqual({1}, gtyper.genotype)
+        self.assertEqual(11.24, gtyper.genotype_confidence)
+        with self.assertRaises(AttributeError):
+            gtyper.not_an_attribute = 42
+
+    def test_run_haploid(self):
+        """test run with ploidy 1"""
+        allele_groups_dict = {"1": {0}, "2": {1}, "3": {0, 1}, "4": {2}}
+        allele_combination_cov = {"1": 12, "2": 10, "3": 1, "4": 1}
+        allele_per_base_cov = [[12, 13], [10, 11], [1]]
+        diploid = genotyper.Genotyper(
+            20, 0.01, allele_combination_cov, allele_per_base_cov, allele_groups_dict
+        )
+        diploid.run()
+        self.assertEqual({0, 1}, diploid.genotype)
+        self.assertEqual(3, diploid.het_pairs_evaluated)
+
+        model = genotyper.GenotypingModel(20, 0.01, ploidy=1)
+        for genotyper_class in genotyper.Genotyper, genotyper.BiallelicGenotyper:
+            gtyper = genotyper_class(
+                20,
+                0.01,
+                {"1": 12, "2": 10, "3": 1},
+                allele_per_base_cov[:2],
+                allele_groups_dict,
+                model=model,
+            )
+            gtyper.run()
+            self.assertEqual(0, gtyper.het_pairs_evaluated)
+            self.assertEqual([{0}, {1}], [x[0] for x in gtyper.likelihoods])
+            self.assertEqual({0}, gtyper.genotype)
+            expected_conf = round(
+                gtyper.likelihoods[0][1] - gtyper.likelihoods[1][1], 2
+            )
+            self.assertEqual(expected_conf, gtyper.genotype_confidence)
+
+        gtyper = genotyper.Genotyper(
+            20,
+            0.01,
+            allele_combination_cov,
+            allele_per_base_cov,
+            allele_groups_dict,
+            model=model,
+        )
+        gtyper.run()
+        self.assertEqual(0, gtyper.het_pairs_evaluated)
+        self.assertEqual(3, len(gtyper.likelihoods))
+        self.assertEqual({0}, gtyper.genotype)
+        expected = [x for x in diploid.likelihoods if len(x[0]) == 1]
+        self.assertEqual(expected, gtyper.likelihoods)
+
+        with self.assertRaises(Exception):
+            genotyper.GenotypingModel(20, 0.01, ploidy=3)
+
+    def test_genotype_cache(self):
+        """test GenotypeCache"""
+        cache = genotyper.GenotypeCache(max_size=2)
+        self.assertIsNone(cache.get("a"))
+        cache.add("a", 1)
+        cache.add("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.add("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(0.6, cache.hit_rate())
+
+    def test_slow_site_report(self):
+        """test SlowSiteReport"""
+        report = genotyper.SlowSiteReport(max_sites=2)
+        report.add(0.5, "ref", 1, 2, 3, 1)
+        report.add(0.25, "ref", 2, 2, 3, 1)
+        report.add(1.5, "ref", 3, 4, 7, 6)
+        report.add(0.5, "ref", 4, 2, 2, 0)
+        self.assertEqual(2, len(report))
+        self.assertEqual(4, report.sites_added)
+        self.assertEqual(2.75, report.total_seconds)
+        expected = [("ref", 3, 4, 7, 6, 1.5), ("ref", 1, 2, 3, 1, 0.5)]
+        self.assertEqual(expected, report.slowest_sites())
+
+        tmp_file = "tmp.genotyper.slow_site_report.tsv"
+        report.write_tsv(tmp_file)
+        with open(tmp_file) as f:
+            got = [x.rstrip().split("\t") for x in f]
+        os.unlink(tmp_file)
+        expected = [
+            genotyper.SlowSiteReport.columns,
+            ["ref", "3", "4", "7", "6", "1.500000"],
+            ["ref", "1", "2", "3", "1", "0.500000"],
+        ]
+        self.assertEqual(expected, got)
+
+        report = genotyper.SlowSiteReport(max_sites=0)
+        report.add(0.5, "ref", 1, 2, 3, 1)
+        self.assertEqual([], report.slowest_sites())
+
+    def test_run_with_cache(self):
+        """test run when the model has a genotype cache"""
+        model = genotyper.GenotypingModel(20, 0.01, cache_size=10)
+        allele_groups_dict = {"1": {0}, "2": {1}, "3": {0, 1}, "4": {1}}
+        # The second site has different non-zero counts to the first site.
+        # The third site has different group keys, but the same groups and
+        # coverage as the first site, so should be a cache hit
+        sites = [
+            ({"1": 2, "2": 20, "3": 1}, [[0, 1], [20, 19]]),
+            ({"1": 2, "2": 20, "3": 1}, [[5, 5], [20, 19]]),
+            ({"1": 2, "4": 20, "3": 1}, [[0, 1], [20, 19]]),
+        ]
+        for allele_combination_cov, allele_per_base_cov in sites:
+            expected = genotyper.Genotyper(
+                20,
+                0.01,
+                allele_combination_cov,
+                allele_per_base_cov,
+                allele_groups_dict,
+            )
+            expected.run()
+            gtyper = genotyper.Genotyper(
+                20,
+                0.01,
+                allele_combination_cov,
+                allele_per_base_cov,
+                allele_groups_dict,
+                model=model,
+            )
+            gtyper.run()
+            self.assertEqual(expected.genotype, gtyper.genotype)
+            self.assertEqual(expected.genotype_confidence, gtyper.genotype_confidence)
+            self.assertEqual(
+                expected.singleton_allele_coverages, gtyper.singleton_allele_coverages
+            )
+            self.assertEqual(expected.likelihoods, gtyper.likelihoods)
+            self.assertEqual(
+                expected.haploid_allele_coverages, gtyper.haploid_allele_coverages
+            )
+            self.assertEqual(expected.het_pairs_evaluated, gtyper.het_pairs_evaluated)
+
+        self.assertEqual(1, model.genotype_cache.hits)
+        self.assertEqual(2, model.genotype_cache.misses)
+
+    def test_site_is_biallelic(self):
+        """test BiallelicGenotyper.site_is_biallelic"""
+        masks = {"1": 1, "2": 2, "3": 3, "4": 4, "5": 5}
+        f = genotyper.BiallelicGenotyper.site_is_biallelic
+        self.assertTrue(f(2, {}, masks))
+        self.assertTrue(f(2, {"1": 1, "2": 3, "3": 0}, masks))
+        self.assertFalse(f(3, {"1": 1, "2": 3}, masks))
+        self.assertFalse(f(2, {"1": 1, "4": 3}, masks))
+        self.assertFalse(f(2, {"1": 1, "5": 3}, masks))
+        self.assertFalse(f(2, {"1": 1, "6": 3}, masks))
+
+    def test_biallelic_genotyper(self):
+        """test BiallelicGenotyper gives same results as Genotyper"""
+        allele_groups_dict = {"1": {0}, "2": {1}, "3": {0, 1}, "4": {1}}
+        allele_group_masks = genotyper.Genotyper.allele_groups_to_bitmasks(
+            allele_groups_dict
+        )
+        allele_per_base_cov = [[0, 1], [20, 19]]
+        tests = [
+            {},
+            {"1": 0},
+            {"3": 10},
+            {"1": 2, "2": 20, "3": 1},
+            {"2": 20, "1": 2, "3": 1},
+            {"2": 10, "1": 10},
+            {"1": 10, "2": 10},
+            {"1": 5, "3": 4},
+            {"1": 5, "2": 3, "4": 6, "3": 4},
+        ]
+        for mean_depth in 0, 3, 20:
+            model = genotyper.GenotypingModel(mean_depth, 0.01)
+            for allele_combination_cov in tests:
+                for lean in True, False:
+                    expected = genotyper.Genotyper(
+                        mean_depth,
+                        0.01,
+                        allele_combination_cov,
+                        allele_per_base_cov,
+                        allele_groups_dict,
+                        lean=lean,
+                    )
+                    expected.run()
+                    gtyper = genotyper.BiallelicGenotyper(
+                        mean_depth,
+                        0.01,
+                        allele_combination_cov,
+                        allele_per_base_cov,
+                        allele_groups_dict,
+                        model=model,
+                        allele_group_masks=allele_group_masks,
+                        lean=lean,
+                    )
+                    gtyper.run()
+                    self.assertEqual(expected.genotype, gtyper.genotype)
+                    self.assertEqual(
+                        expected.genotype_confidence, gtyper.genotype_confidence
+                    )
+                    self.assertEqual(
+                        expected.singleton_allele_coverages,
+                        gtyper.singleton_allele_coverages,
+                    )
+                    self.assertEqual(expected.likelihoods, gtyper.likelihoods)
+
+    def test_two_most_likely(self):
+        """test _two_most_likely"""
+        self.assertEqual(
+            [({1}, -1.0), ({0}, -2.0)],
+            genotyper.Genotyper._two_most_likely([-2.0, -1.0], []),
+        )
+        # Ties are broken by which genotype came first
+        self.assertEqual(
+            [({0}, -1.0), ({0, 1}, -1.0)],
+            genotyper.Genotyper._two_most_likely(
+                [-1.0, -3.0], [(0, 1, -1.0), (0, 2, -1.0)]
+            ),
+        )
+        self.assertEqual(
+            [({1, 2}, 0.5), ({1}, -1.0)],
+            genotyper.Genotyper._two_most_likely(
+                [-2.0, -1.0, -3.0], [(0, 1, -1.5), (1, 2, 0.5)]
+            ),
+        )
+
     def test_run_zero_coverage(self):
         """test run when all alleles have zero coverage"""
         mean_depth = 20
@@ -200,3 +543,48 @@ class TestGenotyper(unittest.TestCase):
         gtyper.run()
         self.assertEqual({"."}, gtyper.genotype)
         self.assertEqual(0.0, gtyper.genotype_confidence)
+
+    def test_run_prune_het_pairs(self):
+        """test run with prune_het_pairs gives same result as without"""
+        mean_depth = 30
+        error_rate = 0.01
+        number_of_alleles = 20
+        allele_groups_dict = {str(i): {i} for i in range(number_of_alleles)}
+        allele_groups_dict["20"] = {1, 2, 3}
+        allele_combination_cov = {str(i): 1 for i in range(number_of_alleles)}
+        allele_combination_cov["1"] = 15
+        allele_combination_cov["2"] = 14
+        allele_combination_cov["20"] = 3
+        allele_per_base_cov = [[1, 1] for i in range(number_of_alleles)]
+        allele_per_base_cov[1] = [15, 18]
+        allele_per_base_cov[2] = [14, 17]
+        gtyper = genotyper.Genotyper(
+            mean_depth,
+            error_rate,
+            allele_combination_cov,
+            allele_per_base_cov,
+            allele_groups_dict,
+        )
+        gtyper.run()
+        self.assertEqual({1, 2}, gtyper.genotype)
+        self.assertEqual(190, gtyper.het_pairs_evaluated)
+        self.assertEqual(0, gtyper.het_pairs_pruned)
+
+        model = genotyper.GenotypingModel(mean_depth, error_rate, prune_het_pairs=True)
+        pruned_gtyper = genotyper.Genotyper(
+            mean_depth,
+            error_rate,
+            allele_combination_cov,
+            allele_per_base_cov,
+            allele_groups_dict,
+            model=model,
+        )
+        pruned_gtyper.run()
+        self.assertEqual(gtyper.genotype, pruned_gtyper.genotype)
+        self.assertEqual(gtyper.genotype_confidence, pruned_gtyper.genotype_confidence)
+        self.assertEqual(gtyper.likelihoods[:2], pruned_gtyper.likelihoods[:2])
+        self.assertGreater(pruned_gtyper.het_pairs_pruned, 0)
+        self.assertEqual(
+            190, pruned_gtyper.het_pairs_evaluated + pruned_gtyper.het_pairs_pruned
+        )
+        self.assertEqual(pruned_gtyper.het_pairs_pruned, model.het_pairs_pruned)
@@ -0,0 +1,128 @@
+import os
+import unittest
+
+from minos import allele_coverage, genotyping_inputs
+
+
+class TestGenotypingInputs(unittest.TestCase):
+    def test_coverage_histograms(self):
+        """test coverage_histograms"""
+        cov = allele_coverage.AlleleCoverage.from_lists(
+            [{}, {}], [[[1, 2, 1], [0, 0, 3]], [[], [4, 0, 4, 4], [5]]]
+        )
+        expect = [[[1, 2, 2, 1], [0, 2, 3, 1]], [[], [0, 1, 4, 3], [5, 1]]]
+        self.assertEqual(expect, genotyping_inputs.coverage_histograms(cov))
+
+    def test_non_zeros_from_histogram(self):
+        """test non_zeros_from_histogram"""
+        cov = allele_coverage.AlleleCoverage.from_lists(
+            [{}, {}], [[[1, 2], [0, 0, 1]], [[], [4, 0, 2], [5]]]
+        )
+        histograms = [
+            x for site in genotyping_inputs.coverage_histograms(cov) for x in site
+        ]
+        for min_cov in range(7):
+            expect = cov.allele_non_zeros(min_cov).tolist()
+            got = [
+                genotyping_inputs.non_zeros_from_histogram(x, min_cov)
+                for x in histograms
+            ]
+            self.assertEqual(expect, got)
+
+    def test_write_and_load_file(self):
+        """test write_file and load_file"""
+        cov = allele_coverage.AlleleCoverage.from_lists(
+            [{"1": 3, "2": 1}, {"3": 2}], [[[1, 2], [0, 0, 1]], [[0], [4, 0], [5]]]
+        )
+        allele_groups = {"1": {0}, "2": {0, 1}, "3": {2}}
+        tmp_file = "tmp.genotyping_inputs.write_and_load_file.jsonl"
+        genotyping_inputs.write_file(
+            tmp_file, cov, allele_groups, 1.5, 2.0, read_error_rate=0.001, ploidy=2
+        )
+        got_header, got_sites = genotyping_inputs.load_file(tmp_file)
+        os.unlink(tmp_file)
+        expect_header = {"depths": [[1.5, 2.0]], "read_error_rate": 0.001, "ploidy": 2}
+        expect_sites = [
+            [0, [[1, 3], [3, 1]], [2, 3], [[1, 1, 2, 1], [0, 2, 1, 1]]],
+            [0, [[4, 2]], [1, 2, 1], [[0, 1], [0, 1, 4, 1], [5, 1]]],
+        ]
+        self.assertEqual(expect_header, got_header)
+        self.assertEqual(expect_sites, got_sites)
+
+    def test_write_windows(self):
+        """test write_windows"""
+        cov = allele_coverage.AlleleCoverage.from_lists(
+            [{"1": 3, "2": 1}, {"3": 2}], [[[1, 2], [0, 0, 1]], [[0], [4, 0], [5]]]
+        )
+        allele_groups = {"1": {0}, "2": {0, 1}, "3": {2}}
+        tmp_expect = "tmp.genotyping_inputs.write_windows.expect.jsonl"
+        genotyping_inputs.write_file(
+            tmp_expect, cov, allele_groups, 1.5, 2.0, read_error_rate=0.001
+        )
+        windows = [
+            (
+                ["record1"],
+                allele_coverage.AlleleCoverage.from_lists([cov[0][0]], [cov[0][1]]),
+            ),
+            (["record2"], [cov[1]]),
+        ]
+        tmp_got = "tmp.genotyping_inputs.write_windows.got.jsonl"
+        with open(tmp_got, "w") as f:
+            genotyping_inputs.write_header(f, 1.5, 2.0, read_error_rate=0.001)
+            got_windows = list(
+                genotyping_inputs.write_windows(f, windows, allele_groups)
+            )
+        self.assertEqual(windows, got_windows)
+        self.assertEqual(
+            genotyping_inputs.load_file(tmp_expect),
+            genotyping_inputs.load_file(tmp_got),
+        )
+        os.unlink(tmp_expect)
+        os.unlink(tmp_got)
+
+    def test_merge_files(self):
+        """test merge_files"""
+
+        class FakeSplitFile:
+            def __init__(self, file_start_index, use_start_index, use_end_index):
+                self.file_start_index = file_start_index
+                self.use_start_index = use_start_index
+                self.use_end_index = use_end_index
+
+        class FakeChunker:
+            def __init__(self, vcf_split_files, total_input_records):
+                self.vcf_split_files = vcf_split_files
+                self.total_input_records = total_input_records
+
+        # Records 0-3 are in split 1, records 2-6 are in split 2.
+        # Use 0-2 from split 1 and 3-6 from split 2
+        chunker = FakeChunker(
+            {"ref": [FakeSplitFile(0, 0, 2), FakeSplitFile(2, 3, 6)]}, 7
+        )
+        tmp_prefix = "tmp.genotyping_inputs.merge_files"
+        to_merge = {"ref": []}
+        for i, split_file in enumerate(chunker.vcf_split_files["ref"]):
+            cov = allele_coverage.AlleleCoverage.from_lists(
+                [{"1": j} for j in range(split_file.file_start_index, 4 + 3 * i)],
+                [[[1], [1]] for j in range(split_file.file_start_index, 4 + 3 * i)],
+            )
+            filename = f"{tmp_prefix}.{i}.jsonl"
+            genotyping_inputs.write_file(
+                filename, cov, {"1": {0}}, 10 + i, 20 + i, read_error_rate=0.01
+            )
+            to_merge["ref"].append(filename)
+
+        tmp_out = f"{tmp_prefix}.out.jsonl"
+        genotyping_inputs.merge_files(chunker, to_merge, tmp_out)
+        got_header, got_sites = genotyping_inputs.load_file(tmp_out)
+        expect_header = {"depths": [[10, 20], [11, 21]], "read_error_rate": 0.01}
+        self.assertEqual(expect_header, got_header)
+        self.assertEqual([[[1, i]] for i in range(7)], [x[1] for x in got_sites])
+        self.assertEqual([0, 0, 0, 1, 1, 1, 1], [x[0] for x in got_sites])
+
+        chunker.total_input_records = 8
+        with self.assertRaises(Exception):
+            genotyping_inputs.merge_files(chunker, to_merge, tmp_out)
+
+        for filename in to_merge["ref"] + [tmp_out]:
+            os.unlink(filename)
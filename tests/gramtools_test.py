@@ -1,11 +1,14 @@
 import datetime
+import filecmp
+import json
 import shutil
 import os
+import statistics
 import unittest
 
 from cluster_vcf_records import vcf_file_read, vcf_record
 
-from minos import gramtools
+from minos import disk_cache, genotyper, gramtools
 from minos import __version__ as minos_version
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
@@ -39,6 +42,113 @@ class TestGramtools(unittest.TestCase):
         self.assertTrue(os.path.exists(tmp_out_build))
         shutil.rmtree(tmp_out_build)
 
+    def test_run_gramtools_build_with_cache(self):
+        """test run_gramtools_build with cache_dir"""
+        tmp_out_build = "tmp.run_gramtools_build_with_cache.out.build"
+        tmp_cache_dir = "tmp.run_gramtools_build_with_cache.cache"
+        for dirname in tmp_out_build, tmp_cache_dir:
+            if os.path.exists(dirname):
+                shutil.rmtree(dirname)
+        vcf_file = os.path.join(data_dir, "run_gramtools.calls.vcf")
+        ref_file = os.path.join(data_dir, "run_gramtools.ref.fa")
+        gramtools.run_gramtools_build(
+            tmp_out_build, vcf_file, ref_file, 150, kmer_size=5, cache_dir=tmp_cache_dir
+        )
+        cached_builds = os.listdir(os.path.join(tmp_cache_dir, "gramtools_builds"))
+        self.assertEqual(1, len(cached_builds))
+        shutil.rmtree(tmp_out_build)
+
+        # Second run should copy the build from the cache
+        gramtools.run_gramtools_build(
+            tmp_out_build, vcf_file, ref_file, 150, kmer_size=5, cache_dir=tmp_cache_dir
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(tmp_out_build, "build_report.json"))
+        )
+        self.assertEqual(
+            cached_builds, os.listdir(os.path.join(tmp_cache_dir, "gramtools_builds"))
+        )
+        shutil.rmtree(tmp_out_build)
+
+        # Different kmer size is a different build
+        gramtools.run_gramtools_build(
+            tmp_out_build, vcf_file, ref_file, 150, kmer_size=6, cache_dir=tmp_cache_dir
+        )
+        self.assertEqual(
+            2, len(os.listdir(os.path.join(tmp_cache_dir, "gramtools_builds")))
+        )
+        shutil.rmtree(tmp_out_build)
+        shutil.rmtree(tmp_cache_dir)
+
+    def test_relocate_build_report(self):
+        """test _relocate_build_report on a build copied from the cache"""
+        tmp_dir = "tmp.relocate_build_report"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        original_build = os.path.abspath(os.path.join(tmp_dir, "original.build"))
+        os.makedirs(os.path.join(original_build, "kmers"))
+        for filename in "prg", "fm_index", os.path.join("kmers", "kmer_index_5"):
+            with open(os.path.join(original_build, filename), "w") as f:
+                print(filename, file=f)
+        build_report = {
+            "success": True,
+            "paths": {
+                "project": original_build,
+                "vcf": "/original/calls.vcf",
+                "reference": "/original/ref.fa",
+                "prg": os.path.join(original_build, "prg"),
+                "fm_index": os.path.join(original_build, "fm_index"),
+                "kmer_index": os.path.join(original_build, "kmers", "kmer_index_5"),
+                "build_report": os.path.join(original_build, "build_report.json"),
+            },
+        }
+        with open(os.path.join(original_build, "build_report.json"), "w") as f:
+            json.dump(build_report, f)
+
+        cache = disk_cache.DirectoryCache(
+            os.path.join(tmp_dir, "cache"), max_bytes=1000
+        )
+        cache.put("key", original_build)
+        shutil.rmtree(original_build)
+        new_build = os.path.join(tmp_dir, "new.build")
+        self.assertTrue(cache.get("key", new_build))
+        self.assertTrue(
+            gramtools._relocate_build_report(new_build, "calls.vcf", "ref.fa")
+        )
+        with open(os.path.join(new_build, "build_report.json")) as f:
+            got = json.load(f)
+        new_build = os.path.abspath(new_build)
+        expected = {
+            "project": new_build,
+            "vcf": os.path.abspath("calls.vcf"),
+            "reference": os.path.abspath("ref.fa"),
+            "prg": os.path.join(new_build, "prg"),
+            "fm_index": os.path.join(new_build, "fm_index"),
+            "kmer_index": os.path.join(new_build, "kmers", "kmer_index_5"),
+            "build_report": os.path.join(new_build, "build_report.json"),
+        }
+        self.assertEqual(expected, got["paths"])
+        self.assertTrue(got["success"])
+        shutil.rmtree(new_build)
+
+        # A build in the cache that is missing a file is not good
+        os.unlink(os.path.join(cache.path("key"), "fm_index"))
+        self.assertTrue(cache.get("key", new_build))
+        self.assertFalse(
+            gramtools._relocate_build_report(new_build, "calls.vcf", "ref.fa")
+        )
+        shutil.rmtree(new_build)
+
+        # Adding a build that makes the cache too big evicts the old one
+        os.mkdir(original_build)
+        with open(os.path.join(original_build, "prg"), "w") as f:
+            f.write("x" * 1000)
+        cache.put("key2", original_build)
+        self.assertFalse(cache.get("key", new_build))
+        self.assertEqual(["key2"], os.listdir(cache.cache_dir))
+        shutil.rmtree(tmp_dir)
+
     def test_run_gramtools(self):
         """test run_gramtools"""
         tmp_out_build = "tmp.run_gramtools.out.build"
@@ -172,6 +282,13 @@ class TestGramtools(unittest.TestCase):
         self.assertEqual(10.500, got_mean_depth)
         self.assertEqual(0.5, got_depth_variance)
 
+        got_ragged = gramtools.load_gramtools_vcf_and_allele_coverage_files(
+            vcf_file, quasimap_dir, ragged=True
+        )
+        self.assertEqual(10.500, got_ragged[0])
+        self.assertEqual(0.5, got_ragged[1])
+        self.assertEqual(got_allele_coverage, list(got_ragged[4]))
+
         # now test bad files cause error to be raised
         vcf_file = os.path.join(
             data_dir, "load_gramtools_vcf_and_allele_coverage.short.vcf"
@@ -197,6 +314,63 @@ class TestGramtools(unittest.TestCase):
                 vcf_file, quasimap_dir
             )
 
+    def test_depth_stats_from_sums(self):
+        """test _depth_stats_from_sums"""
+        for coverages in [
+            [3],
+            [1, 2],
+            [10, 11, 0, 5, 100],
+            [7, 7, 7],
+            list(range(1001)),
+        ]:
+            if len(coverages) == 1:
+                expect = (round(statistics.mean(coverages), 3), 1.0)
+            else:
+                expect = (
+                    round(statistics.mean(coverages), 3),
+                    round(statistics.variance(coverages), 3),
+                )
+            got = gramtools._depth_stats_from_sums(
+                len(coverages), sum(coverages), sum(x * x for x in coverages)
+            )
+            self.assertEqual(expect, got)
+
+    def test_load_gramtools_files_streaming(self):
+        """test load_gramtools_files_streaming"""
+        vcf_file = os.path.join(data_dir, "load_gramtools_vcf_and_allele_coverage.vcf")
+        quasimap_dir = os.path.join(
+            data_dir, "load_gramtools_vcf_and_allele_coverage_files.quasimap"
+        )
+        expect_mean, expect_variance, expect_header, expect_records, expect_coverage, expect_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(
+            vcf_file, quasimap_dir
+        )
+
+        for window_size in 1, 2, 1000:
+            got_mean, got_variance, got_header, got_windows, got_groups = gramtools.load_gramtools_files_streaming(
+                vcf_file, quasimap_dir, window_size=window_size
+            )
+            self.assertEqual(expect_mean, got_mean)
+            self.assertEqual(expect_variance, got_variance)
+            self.assertEqual(expect_header, got_header)
+            self.assertEqual(expect_groups, got_groups)
+            got_windows = list(got_windows)
+            self.assertTrue(all(len(x[0]) <= window_size for x in got_windows))
+            self.assertEqual(expect_records, [x for w in got_windows for x in w[0]])
+            self.assertEqual(
+                expect_coverage, [x for w in got_windows for x in list(w[1])]
+            )
+
+        # Bad files should raise an error, when the windows are used
+        for bad in "short", "long", "bad_allele_count":
+            vcf_file = os.path.join(
+                data_dir, f"load_gramtools_vcf_and_allele_coverage.{bad}.vcf"
+            )
+            windows = gramtools.load_gramtools_files_streaming(vcf_file, quasimap_dir)[
+                3
+            ]
+            with self.assertRaises(Exception):
+                list(windows)
+
     def test_update_vcf_record_using_gramtools_allele_depths_heterozygous(self):
         """test update_using_gramtools_allele_depths heterozygous"""
         record = vcf_record.VcfRecord(
@@ -275,6 +449,17 @@ class TestGramtools(unittest.TestCase):
         self.assertEqual(expected, record)
         self.assertEqual(expected, got_filtered)
 
+    def test_null_vcf_line(self):
+        """test _null_vcf_line"""
+        line = "ref\t4\tid1\tT\tG,TC\t228\tPASS\tDP=61;MQ=57\tGT:PL\t1/1:255,163,0"
+        record = vcf_record.VcfRecord(line)
+        got = gramtools._null_vcf_line(record)
+        self.assertEqual(vcf_record.VcfRecord(line), record)
+        gramtools.update_vcf_record_using_gramtools_allele_depths(
+            record, {}, [[0], [0], [0, 0]], {}, 85, 0.001
+        )
+        self.assertEqual(str(record), got)
+
     def test_write_vcf_annotated_using_coverage_from_gramtools(self):
         """test write_vcf_annotated_using_coverage_from_gramtools"""
         vcf_file_in = os.path.join(
@@ -331,6 +516,88 @@ class TestGramtools(unittest.TestCase):
         os.unlink(tmp_outfile)
         os.unlink(tmp_outfile_filtered)
 
+        # Streaming the sites a window at a time should give the same output
+        _, _, _, windows, _ = gramtools.load_gramtools_files_streaming(
+            vcf_file_in, quasimap_dir, window_size=2
+        )
+        gramtools.write_vcf_annotated_using_coverage_windows_from_gramtools(
+            mean_depth,
+            windows,
+            allele_groups,
+            error_rate,
+            tmp_outfile,
+            sample_name="sample_42",
+            max_read_length=200,
+            filtered_outfile=tmp_outfile_filtered,
+        )
+        check_vcfs(expected_vcf, tmp_outfile)
+        check_vcfs(expected_vcf_filtered, tmp_outfile_filtered)
+
+        # Genotyping in parallel should give exactly the same files. Use
+        # windows of more than one site, so that they get split into blocks
+        for threads in 2, 3:
+            _, _, _, windows, _ = gramtools.load_gramtools_files_streaming(
+                vcf_file_in, quasimap_dir, window_size=5
+            )
+            tmp_outfile_threads = f"{tmp_outfile}.threads.vcf"
+            tmp_outfile_threads_filtered = tmp_outfile_threads + ".filter.vcf"
+            gramtools.write_vcf_annotated_using_coverage_windows_from_gramtools(
+                mean_depth,
+                windows,
+                allele_groups,
+                error_rate,
+                tmp_outfile_threads,
+                sample_name="sample_42",
+                max_read_length=200,
+                filtered_outfile=tmp_outfile_threads_filtered,
+                threads=threads,
+            )
+            self.assertTrue(
+                filecmp.cmp(tmp_outfile, tmp_outfile_threads, shallow=False)
+            )
+            self.assertTrue(
+                filecmp.cmp(
+                    tmp_outfile_filtered, tmp_outfile_threads_filtered, shallow=False
+                )
+            )
+            os.unlink(tmp_outfile_threads)
+            os.unlink(tmp_outfile_threads_filtered)
+
+        os.unlink(tmp_outfile)
+        os.unlink(tmp_outfile_filtered)
+
+    def test_write_vcf_annotated_using_coverage_from_gramtools_slow_sites(self):
+        """test write_vcf_annotated_using_coverage_from_gramtools with slow_sites"""
+        vcf_file_in = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.in.vcf"
+        )
+        quasimap_dir = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.quasimap"
+        )
+        mean_depth, depth_variance, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(
+            vcf_file_in, quasimap_dir
+        )
+        positions = {(x.CHROM, x.POS + 1) for x in vcf_records}
+        tmp_outfile = "tmp.gramtools.write_vcf_annotated_using_coverage_from_gramtools.slow_sites.vcf"
+        slow_sites = genotyper.SlowSiteReport(max_sites=2)
+        gramtools.write_vcf_annotated_using_coverage_from_gramtools(
+            mean_depth,
+            vcf_records,
+            allele_coverage,
+            allele_groups,
+            0.001,
+            tmp_outfile,
+            genotype_cache_size=None,
+            slow_sites=slow_sites,
+        )
+        os.unlink(tmp_outfile)
+        self.assertEqual(2, len(slow_sites))
+        got_sites = slow_sites.slowest_sites()
+        self.assertGreaterEqual(got_sites[0][-1], got_sites[1][-1])
+        for chrom, pos, alleles, allele_groups, het_pairs, seconds in got_sites:
+            self.assertIn((chrom, pos), positions)
+            self.assertLessEqual(het_pairs, alleles * (alleles - 1) // 2)
+
     def test_load_allele_files(self):
         """test load_allele_files"""
         expected_counts_list = [
@@ -351,3 +618,9 @@ class TestGramtools(unittest.TestCase):
         )
         self.assertEqual(expected_counts_list, got_counts_list)
         self.assertEqual(expected_groups_dict, got_groups_dict)
+
+        got_counts, got_groups_dict = gramtools.load_allele_files(
+            allele_base_counts_file, grouped_allele_counts_file, ragged=True
+        )
+        self.assertEqual(expected_counts_list, list(got_counts))
+        self.assertEqual(expected_groups_dict, got_groups_dict)
@@ -0,0 +1,43 @@
+import json
+import os
+import unittest
+
+from minos import json_stream
+
+
+class TestJsonStream(unittest.TestCase):
+    def test_iter_array(self):
+        """test iter_array"""
+        data = {
+            "first": {"skip": [[1, 2], {"x": "]}"}], "a": [0.5]},
+            "x": {
+                "b": 12345,
+                "c": [],
+                "wanted": [
+                    {"0": 1, "12": 34},
+                    [[123456789], [], [1, 22, 333]],
+                    "string with [brackets], and {braces}",
+                    -1.5e10,
+                    None,
+                    True,
+                ],
+                "d": "end",
+            },
+        }
+        tmp_file = "tmp.json_stream.iter_array.json"
+        for indent in None, 4:
+            with open(tmp_file, "w") as f:
+                json.dump(data, f, indent=indent)
+            for chunk_size in 1, 2, 3, 7, 1000:
+                got = list(
+                    json_stream.iter_array(tmp_file, ["x", "wanted"], chunk_size)
+                )
+                self.assertEqual(data["x"]["wanted"], got)
+                got = list(json_stream.iter_array(tmp_file, ["x", "c"], chunk_size))
+                self.assertEqual([], got)
+                got = list(json_stream.iter_array(tmp_file, ["first", "a"], chunk_size))
+                self.assertEqual([0.5], got)
+
+        with self.assertRaises(Exception):
+            list(json_stream.iter_array(tmp_file, ["x", "not_there"]))
+        os.unlink(tmp_file)
@@ -0,0 +1,101 @@
+import os
+import unittest
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import multi_sample_genotyper
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "gramtools")
+
+
+class TestMultiSampleGenotyper(unittest.TestCase):
+    def test_site_genotypes(self):
+        """test site_genotypes"""
+        self.assertEqual(
+            [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)],
+            multi_sample_genotyper.MultiSampleGenotyper.site_genotypes(3),
+        )
+
+    def test_run(self):
+        """test run"""
+        # Use the same quasimap output for both samples, so the results
+        # should be the same as in the test of
+        # gramtools.write_vcf_annotated_using_coverage_from_gramtools()
+        vcf_file_in = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.in.vcf"
+        )
+        quasimap_dir = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.quasimap"
+        )
+        genotyper = multi_sample_genotyper.MultiSampleGenotyper.from_quasimap_dirs(
+            vcf_file_in, [quasimap_dir, quasimap_dir], ["sample1", "sample2"], 0.001
+        )
+        tmp_prefix = "tmp.multi_sample_genotyper.run"
+        tmp_cohort = tmp_prefix + ".cohort.vcf"
+        tmp_samples = [tmp_prefix + ".1.vcf", tmp_prefix + ".2.vcf"]
+        tmp_filtered = [tmp_prefix + ".1.filter.vcf", tmp_prefix + ".2.filter.vcf"]
+        genotyper.run(
+            cohort_vcf=tmp_cohort,
+            sample_vcfs=tmp_samples,
+            filtered_sample_vcfs=tmp_filtered,
+        )
+
+        expected_vcf = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.out.vcf"
+        )
+        expected_vcf_filtered = os.path.join(
+            data_dir,
+            "write_vcf_annotated_using_coverage_from_gramtools.out.vcf.filter.vcf",
+        )
+        _, expected_records = vcf_file_read.vcf_file_to_list(expected_vcf)
+        _, expected_filtered = vcf_file_read.vcf_file_to_list(expected_vcf_filtered)
+        for i in range(2):
+            got_header, got_records = vcf_file_read.vcf_file_to_list(tmp_samples[i])
+            self.assertEqual(expected_records, got_records)
+            self.assertEqual(
+                "sample" + str(i + 1), got_header[-1].rstrip().split("\t")[-1]
+            )
+            _, got_records = vcf_file_read.vcf_file_to_list(tmp_filtered[i])
+            self.assertEqual(expected_filtered, got_records)
+            os.unlink(tmp_samples[i])
+            os.unlink(tmp_filtered[i])
+
+        with open(tmp_cohort) as f:
+            got_lines = [x.rstrip().split("\t") for x in f]
+        os.unlink(tmp_cohort)
+        self.assertEqual(["sample1", "sample2"], got_lines[7][-2:])
+        got_lines = got_lines[8:]
+        self.assertEqual(len(expected_records), len(got_lines))
+        for expected, got in zip(expected_records, got_lines):
+            expected = str(expected).split("\t")
+            self.assertEqual(expected + expected[-1:], got)
+
+    def test_run_deletes_files_on_error(self):
+        """test run deletes the output files if genotyping fails"""
+        vcf_file_in = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.in.vcf"
+        )
+        quasimap_dir = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.quasimap"
+        )
+        genotyper = multi_sample_genotyper.MultiSampleGenotyper.from_quasimap_dirs(
+            vcf_file_in, [quasimap_dir], ["sample1"], 0.001
+        )
+
+        def genotype_site(site):
+            raise Exception("Oops")
+
+        genotyper.genotype_site = genotype_site
+        tmp_prefix = "tmp.multi_sample_genotyper.run_deletes_files_on_error"
+        tmp_cohort = tmp_prefix + ".cohort.vcf"
+        tmp_samples = [tmp_prefix + ".1.vcf"]
+        tmp_filtered = [tmp_prefix + ".1.filter.vcf"]
+        with self.assertRaises(Exception):
+            genotyper.run(
+                cohort_vcf=tmp_cohort,
+                sample_vcfs=tmp_samples,
+                filtered_sample_vcfs=tmp_filtered,
+            )
+        for filename in [tmp_cohort, *tmp_samples, *tmp_filtered]:
+            self.assertFalse(os.path.exists(filename))
@@ -0,0 +1,117 @@
+import os
+import shutil
+import unittest
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import genotyping_inputs, gramtools, regenotyper
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "gramtools")
+
+
+class TestRegenotyper(unittest.TestCase):
+    def test_run(self):
+        """test run"""
+        # Make an adjudicate output directory from the gramtools test data.
+        # Regenotyping with the same error rate should give the same calls
+        # as gramtools.write_vcf_annotated_using_coverage_from_gramtools()
+        vcf_file_in = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.in.vcf"
+        )
+        quasimap_dir = os.path.join(
+            data_dir, "write_vcf_annotated_using_coverage_from_gramtools.quasimap"
+        )
+        mean_depth, depth_variance, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(
+            vcf_file_in, quasimap_dir, ragged=True
+        )
+        tmp_adjudicate_dir = "tmp.regenotyper.run.adjudicate"
+        if os.path.exists(tmp_adjudicate_dir):
+            shutil.rmtree(tmp_adjudicate_dir)
+        os.mkdir(tmp_adjudicate_dir)
+        genotyping_inputs.write_file(
+            os.path.join(tmp_adjudicate_dir, "genotyping_inputs.jsonl"),
+            allele_coverage,
+            allele_groups,
+            mean_depth,
+            depth_variance,
+            read_error_rate=0.001,
+            max_read_length=200,
+            ploidy=2,
+        )
+        shutil.copy(
+            os.path.join(
+                data_dir, "write_vcf_annotated_using_coverage_from_gramtools.out.vcf"
+            ),
+            os.path.join(tmp_adjudicate_dir, "debug.calls_with_zero_cov_alleles.vcf"),
+        )
+
+        def check_vcfs(expected_vcf, got_vcf):
+            _, expected_records = vcf_file_read.vcf_file_to_list(expected_vcf)
+            got_header, got_records = vcf_file_read.vcf_file_to_list(got_vcf)
+            self.assertEqual(expected_records, got_records)
+            self.assertIn("##minos_max_read_length=200", got_header)
+            self.assertEqual("sample_42", got_header[-1].split("\t")[-1])
+
+        tmp_outdir = "tmp.regenotyper.run.out"
+        if os.path.exists(tmp_outdir):
+            shutil.rmtree(tmp_outdir)
+        regenotype = regenotyper.Regenotyper(tmp_adjudicate_dir, tmp_outdir)
+        regenotype.build_output_dir()
+        regenotype.write_vcf_files()
+        check_vcfs(
+            os.path.join(
+                data_dir, "write_vcf_annotated_using_coverage_from_gramtools.out.vcf"
+            ),
+            regenotype.unfiltered_vcf_file,
+        )
+        check_vcfs(
+            os.path.join(
+                data_dir,
+                "write_vcf_annotated_using_coverage_from_gramtools.out.vcf.filter.vcf",
+            ),
+            regenotype.final_vcf,
+        )
+
+        with self.assertRaises(Exception):
+            regenotype.build_output_dir()
+
+        # Changing the error rate should give the same as running gramtools
+        # genotyping with that error rate
+        tmp_expected = "tmp.regenotyper.run.expect.vcf"
+        gramtools.write_vcf_annotated_using_coverage_from_gramtools(
+            mean_depth,
+            vcf_records,
+            allele_coverage,
+            allele_groups,
+            0.05,
+            tmp_expected,
+            sample_name="sample_42",
+            max_read_length=200,
+            filtered_outfile=tmp_expected + ".filter.vcf",
+            ploidy=1,
+        )
+        regenotype = regenotyper.Regenotyper(
+            tmp_adjudicate_dir,
+            tmp_outdir,
+            read_error_rate=0.05,
+            ploidy=1,
+            overwrite_outdir=True,
+            genotype_simulation_iterations=100,
+        )
+        regenotype.run()
+        for expected_vcf, got_vcf in (
+            (tmp_expected, regenotype.unfiltered_vcf_file),
+            (tmp_expected + ".filter.vcf", regenotype.final_vcf),
+        ):
+            _, expected_records = vcf_file_read.vcf_file_to_list(expected_vcf)
+            _, got_records = vcf_file_read.vcf_file_to_list(got_vcf)
+            self.assertEqual(len(expected_records), len(got_records))
+            for expected, got in zip(expected_records, got_records):
+                self.assertEqual(expected.FORMAT["GT"], got.FORMAT["GT"])
+                self.assertEqual(expected.FORMAT["GT_CONF"], got.FORMAT["GT_CONF"])
+                self.assertIn("GT_CONF_PERCENTILE", got.FORMAT)
+            os.unlink(expected_vcf)
+
+        shutil.rmtree(tmp_adjudicate_dir)
+        shutil.rmtree(tmp_outdir)
@@ -0,0 +1,47 @@
+import os
+import unittest
+
+from cluster_vcf_records import vcf_record
+
+from minos import vcf_writer
+
+
+class TestVcfWriter(unittest.TestCase):
+    def test_write(self):
+        """test write"""
+        outfile = "tmp.vcf_writer.vcf"
+        filtered_outfile = "tmp.vcf_writer.filtered.vcf"
+        for filename in outfile, filtered_outfile:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+        header = ["##fileformat=VCFv4.2", "#CHROM\tPOS"]
+        record1 = vcf_record.VcfRecord("ref\t1\t.\tA\tG,T\t.\t.\t.\tGT\t1/1")
+        record2 = vcf_record.VcfRecord("ref\t1\t.\tA\tG\t.\t.\t.\tGT\t1/1")
+        line = "ref\t2\t.\tC\tG\t.\t.\t.\tGT\t./."
+
+        # Use small buffer so that the lines get written in more than one go
+        with vcf_writer.VcfWriter(
+            outfile, filtered_outfile=filtered_outfile, buffer_lines=2
+        ) as writer:
+            writer.write_header(header)
+            writer.write(record1, record2)
+            writer.write(line)
+
+        with open(outfile) as f:
+            got = f.read()
+        self.assertEqual("\n".join(header + [str(record1), line]) + "\n", got)
+        with open(filtered_outfile) as f:
+            got = f.read()
+        self.assertEqual("\n".join(header + [str(record2), line]) + "\n", got)
+        os.unlink(outfile)
+        os.unlink(filtered_outfile)
+
+        # Same again, but with no filtered file
+        with vcf_writer.VcfWriter(outfile) as writer:
+            writer.write_header(header)
+            writer.write(record1, record2)
+        with open(outfile) as f:
+            got = f.read()
+        self.assertEqual("\n".join(header + [str(record1)]) + "\n", got)
+        os.unlink(outfile)